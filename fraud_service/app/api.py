@@ -2,9 +2,13 @@ import logging
 import io
 import json
 import asyncio 
+import time
 import sys 
+import shutil
+import tempfile
 from pathlib import Path 
 from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status 
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm  
 from pydantic import BaseModel, constr  
 import pandas as pd
@@ -13,20 +17,26 @@ from sqlalchemy import func, select
 from sqlalchemy.orm import Session  
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from app.model_io import load_model_and_artifacts
+from app.model_io import load_model_and_artifacts, resolve_registry_version
+from app.bundle import ScoringBundle
 from app.preprocess import prepare_features_for_inference
-from app.scoring import score_decide_with_explanations
+from app.batching import MicroBatcher
+from app.executor import ScoringExecutor, ScoringOverloaded
+from app.velocity import VelocityStore
+from app.metrics import METRICS
 from app.config import settings
 from app.auth import (
     AuthContext,
-    authenticate_user,
-    hash_password,
+    authenticate_user_async,
+    hash_password_async,
     issue_token,
     optional_active_user,
+    password_executor_stats,
     require_active_user,
     revoke_token,
+    shutdown_password_executor,
 )
-from app.database import get_db  
+from app.database import get_db, get_engine
 from app.models_auth import AuthUser
 from utils.logging_utils import configure_logging
 
@@ -67,12 +77,27 @@ PYTHON_BIN = sys.executable
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 scheduler = AsyncIOScheduler()
 
+# Nạp + warm-up một ScoringBundle mới (chạy ngoài event loop); chưa đụng tới bundle đang phục vụ
+def _load_bundle() -> ScoringBundle:
+    model, encoders, schema_pack, th = load_model_and_artifacts()
+    bundle = ScoringBundle.from_artifacts(
+        model, encoders, schema_pack, th,
+        alias=settings.MLFLOW_MODEL_ALIAS if settings.MLFLOW_MODEL_NAME else None,
+        model_handles=settings.SCORING_MODEL_HANDLES,
+    )
+    LOGGER.info("Warmed up model %s (registry %s) in %.3fs",
+                bundle.model_version, bundle.registry_version, bundle.warm_up(settings.EXPLAIN_MODE))
+    return bundle
+
+# Gauge model_info{model_version, registry_version} = 1 cho bundle đang phục vụ
+def _publish_model_info(b: ScoringBundle) -> None:
+    METRICS.clear_gauge("model_info")
+    METRICS.set("model_info", 1, model_version=b.model_version, registry_version=b.registry_version or "")
+
 def _hydrate():
-    global _model, _encoders, _schema_pack, _th, _alias, _registry_version, _feat_cols, _medians, _train_like, _clipping_bounds
-    _model, _encoders, _schema_pack, _th = load_model_and_artifacts()
-    _feat_cols, _medians, _clipping_bounds, _train_like = _schema_pack
-    _alias = settings.MLFLOW_MODEL_ALIAS if settings.MLFLOW_MODEL_NAME else None
-    _registry_version = _th.get("model_version_registry") or _th.get("registry_version")
+    global _bundle
+    _bundle = _load_bundle()  # một phép gán tham chiếu: request đang chạy vẫn giữ bundle cũ
+    _publish_model_info(_bundle)
 
 _hydrate()
 
@@ -121,6 +146,7 @@ _hydrate()
 
 class Tx(BaseModel):
     transaction_seq: int
+    user_seq: Optional[int] = None
     deposit_amount: float
     receiving_country: str
     country_code: Optional[str] = None
@@ -154,15 +180,49 @@ class RegisterRequest(BaseModel):
     username: constr(min_length=3, max_length=150)  
     password: constr(min_length=8, max_length=128)  
 
+# Velocity store trong process: khi bật và Tx có user_seq, 6 feature transaction_* do service tự tính
+_velocity = VelocityStore(
+    max_users=settings.VELOCITY_MAX_USERS,
+    max_events_per_user=settings.VELOCITY_MAX_EVENTS_PER_USER,
+) if settings.VELOCITY_STORE_ENABLED else None
+_velocity_task: Optional[asyncio.Task] = None
+# Store đã có lịch sử (snapshot / warm-up từ transaction_info); chưa có thì giữ giá trị velocity client gửi
+_velocity_ready = False
+
+# Điền velocity features từ store rồi ghi nhận giao dịch (chạy trên event loop, O(1) mỗi giao dịch)
+def _with_velocity(tx: Tx) -> Tx:
+    if _velocity is None or tx.user_seq is None:
+        return tx
+    feats = _velocity.observe(tx.user_seq, tx.create_dt, tx.deposit_amount, tx.transaction_seq)
+    if not _velocity_ready:
+        return tx
+    return tx.copy(update=feats)
+
+# Tiền xử lý Tx bằng bộ compiled (tương đương prepare_features_for_inference)
+def _features_from_txs(b: ScoringBundle, txs: List[Tx]) -> pd.DataFrame:
+    with METRICS.time("preprocess_compiled"):
+        return b.scoring.features(b.compiled_pre, [tx.dict() for tx in txs])
+
 def _jwt_ttl_seconds() -> int:
     return settings.JWT_ACCESS_EXPIRE_MINUTES * 60  
 
+# Chạy coroutine xác thực mật khẩu; executor auth quá tải -> 503
+async def _password_work(coro):
+    try:
+        return await coro
+    except ScoringOverloaded as exc:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(exc),
+            headers={"Retry-After": "1"},
+        ) from exc
+
 @app.post("/auth/login", tags=["Auth"], response_model=TokenResponse, summary="Login and obtain JWT")
-def login(
+async def login(
     form_data: OAuth2PasswordRequestForm = Depends(),  
     db: Session = Depends(get_db), 
 ):
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await _password_work(authenticate_user_async(db, form_data.username, form_data.password))
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -170,7 +230,7 @@ def login(
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    token = issue_token(db, user)
+    token = await asyncio.to_thread(issue_token, db, user)
     return TokenResponse(  
         access_token=token,
         expires_in=_jwt_ttl_seconds(),
@@ -186,6 +246,23 @@ def logout(
     revoke_token(db, auth.token_jti)
     return {"status": "logged_out"} 
 
+# Kiểm tra username đã tồn tại chưa (chạy trong threadpool); kết thúc transaction để không giữ connection lúc băm
+def _username_taken(db: Session, username: str) -> bool:
+    stmt = select(AuthUser).where(AuthUser.username == username)
+    taken = db.execute(stmt).scalar_one_or_none() is not None
+    db.commit()
+    return taken
+
+# Tạo user mới với hash đã tính sẵn (chạy trong threadpool)
+def _create_user(db: Session, username: str, password_hash: str) -> AuthUser:
+    new_user = AuthUser(  
+        username=username,
+        password_hash=password_hash,
+    )
+    db.add(new_user) 
+    db.commit()  
+    db.refresh(new_user) 
+    return new_user
 
 @app.post(
     "/auth/register",
@@ -193,7 +270,7 @@ def logout(
     status_code=status.HTTP_201_CREATED,
     summary="Register a new user"
 )
-def register(
+async def register(
     payload: RegisterRequest,  
     db: Session = Depends(get_db), 
     auth: Optional[AuthContext] = Depends(optional_active_user), 
@@ -206,8 +283,7 @@ def register(
     #         detail="Registration is disabled for unauthenticated users.",
     #     )
 
-    stmt = select(AuthUser).where(AuthUser.username == payload.username)  # Kiểm tra username đã tồn tại chưa
-    if db.execute(stmt).scalar_one_or_none(): 
+    if await asyncio.to_thread(_username_taken, db, payload.username):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Username has been taken.")
 
     password_bytes = payload.password.encode("utf-8")
@@ -217,33 +293,172 @@ def register(
             detail="Password is too long (maximum 72 bytes when UTF-8 encoded).",
         )
 
-    new_user = AuthUser(  
-        username=payload.username,
-        password_hash=hash_password(payload.password),
-    )
-    db.add(new_user) 
-    db.commit()  
-    db.refresh(new_user) 
+    password_hash = await _password_work(hash_password_async(payload.password))
+    new_user = await asyncio.to_thread(_create_user, db, payload.username, password_hash)
     return {"id": new_user.id, "username": new_user.username}  
 
+class _RequestLatencyMiddleware:
+    """
+    Latency theo route (template path, không phải URL thực) để giữ số label ổn định. Middleware ASGI thuần:
+    thời gian tính tới khi gửi xong body (gồm cả StreamingResponse như /score/upload/stream), request ném
+    exception trước khi có response được ghi với status 500.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        t0 = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")  # router ghi route đã khớp vào chính scope này
+            METRICS.observe(
+                "http_request_seconds", time.perf_counter() - t0,
+                method=scope["method"], path=getattr(route, "path", "unmatched"), status=status_code,
+            )
+
+app.add_middleware(_RequestLatencyMiddleware)
+
+@app.get("/metrics", tags=["Health"], summary="Prometheus metrics (text exposition format)")
+def metrics():
+    for name, stats in (("scoring", _scoring_executor.stats()), ("auth", password_executor_stats())):
+        METRICS.set("executor_inflight", stats["inflight"], executor=name)
+        METRICS.set("executor_rejected", stats["rejected"], executor=name)
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/health", tags=["Health"], summary="Check service health")
 def health():
-    payload = {"status": "ok", "model_version": _th.get("model_version")}
-    if _registry_version:
-        payload["registry_version"] = _registry_version
-    if _alias:
-        payload["alias"] = _alias
+    b = _bundle
+    payload = {"status": "ok", "model_version": b.model_version}
+    if b.registry_version:
+        payload["registry_version"] = b.registry_version
+    if b.alias:
+        payload["alias"] = b.alias
+    if _reload_task is not None and not _reload_task.done():
+        payload["reloading"] = True
     return payload
 
+# Khởi tạo worker process của scoring executor: import app.api đã gọi _hydrate() nên model có sẵn
+def _init_scoring_worker():
+    METRICS.drain()  # bỏ số liệu warm-up của worker, process cha đã có warm-up của chính nó
+    LOGGER.info("Scoring worker ready (model_version=%s)", _bundle.model_version)
+
+_scoring_executor = ScoringExecutor(
+    kind=settings.SCORING_EXECUTOR,
+    max_workers=settings.SCORING_WORKERS,
+    max_pending=settings.SCORING_MAX_PENDING,
+    initializer=_init_scoring_worker,
+)
+
+# Chạy fn trong worker process và trả kèm metric worker ghi được (như _score_shard của batch job)
+def _call_with_metrics(fn, *args):
+    return fn(*args), METRICS.drain()
+
+# Chạy hàm trên scoring executor; kind="process" thì merge metric của worker vào registry của /metrics
+async def _run_scoring(fn, *args):
+    if _scoring_executor.kind != "process":
+        return await _scoring_executor.run(fn, *args)
+    result, worker_metrics = await _scoring_executor.run(_call_with_metrics, fn, *args)
+    METRICS.merge(worker_metrics)
+    return result
+
+# Chạy hàm CPU-bound qua scoring executor, hàng đợi đầy -> 503
+async def _dispatch(fn, *args):
+    try:
+        return await _run_scoring(fn, *args)
+    except ScoringOverloaded as exc:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(exc),
+            headers={"Retry-After": "1"},
+        ) from exc
+
+_reload_task: Optional[asyncio.Task] = None
+_alias_poll_task: Optional[asyncio.Task] = None
+
+# Nạp bundle mới trong thread rồi hoán đổi; lỗi thì giữ nguyên bundle đang phục vụ
+async def _reload_bundle(reason: str) -> None:
+    global _bundle
+    old = _bundle
+    try:
+        new = await asyncio.to_thread(_load_bundle)
+    except Exception:
+        LOGGER.exception("Model reload (%s) failed; keeping model %s", reason, old.model_version)
+        raise
+    _bundle = new
+    _publish_model_info(new)
+    if _scoring_executor.kind == "process":
+        _scoring_executor.restart()
+    LOGGER.info("Model hot-swapped (%s): %s (registry %s) -> %s (registry %s)", reason,
+                old.model_version, old.registry_version, new.model_version, new.registry_version)
+
+# Chỉ một reload chạy tại một thời điểm; gọi lại khi đang reload thì dùng chung task đó
+def _start_reload(reason: str) -> asyncio.Task:
+    global _reload_task
+    if _reload_task is None or _reload_task.done():
+        _reload_task = asyncio.get_running_loop().create_task(_reload_bundle(reason))
+        _reload_task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return _reload_task
+
+# Theo dõi alias trên registry: alias trỏ sang version khác -> hot-swap
+async def _alias_poll_loop():
+    while True:
+        await asyncio.sleep(settings.MODEL_ALIAS_POLL_SECONDS)
+        try:
+            version = await asyncio.to_thread(resolve_registry_version)
+        except Exception as exc:
+            LOGGER.warning("Registry alias poll failed: %s", exc)
+            continue
+        if version is not None and version != _bundle.registry_version:
+            LOGGER.info("Alias %s moved to version %s (serving %s); reloading",
+                        settings.MLFLOW_MODEL_ALIAS, version, _bundle.registry_version)
+            try:
+                await asyncio.shield(_start_reload(f"alias -> v{version}"))
+            except Exception:
+                pass
+
+@app.on_event("startup")
+async def _start_alias_poller():
+    global _alias_poll_task
+    if settings.MODEL_ALIAS_POLL_SECONDS > 0 and settings.MLFLOW_MODEL_NAME:
+        _alias_poll_task = asyncio.get_running_loop().create_task(_alias_poll_loop())
+
+@app.on_event("shutdown")
+async def _stop_alias_poller():
+    if _alias_poll_task is not None:
+        _alias_poll_task.cancel()
+
 @app.post(
     "/reload",
     tags=["Admin"],
-    summary="Reload model and artifacts from disk or MLflow Registry",
+    summary="Reload model and artifacts in the background (wait=true blocks until swapped)",
     dependencies=[Depends(require_active_user)], 
 )
-def reload_model():
-    _hydrate()
-    return {"status": "reloaded", "model_version": _th.get("model_version"), "registry_version": _registry_version}
+async def reload_model(wait: bool = False):
+    task = _start_reload("api")
+    if wait:
+        try:
+            await asyncio.shield(task)
+        except Exception as exc:
+            raise HTTPException(status_code=500, detail=f"Model reload failed, previous model kept: {exc}")
+    b = _bundle
+    return {
+        "status": "reloaded" if task.done() else "reloading",
+        "model_version": b.model_version,
+        "registry_version": b.registry_version,
+    }
 
 @app.post(
     "/score",
@@ -251,40 +466,160 @@ def reload_model():
     summary="Score a single transaction",
     dependencies=[Depends(require_active_user)],  
 )
-def score(tx: Tx):
-    df = pd.DataFrame([tx.dict()])
+async def score(tx: Tx):
+    try:
+        return await _score_batcher.submit(_with_velocity(tx))
+    except ScoringOverloaded as exc:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail=str(exc),
+            headers={"Retry-After": "1"},
+        ) from exc
 
-    Xs = prepare_features_for_inference(
-        df_raw=df,
-        feat_cols=_feat_cols,
-        encoders=_encoders,
-        medians=_medians,
-        maybe_cats=["receiving_country","country_code","id_type","stay_qualify","payment_method", "payment_method_filled"],
-        clipping_bounds=_clipping_bounds 
+# Chấm điểm một nhóm Tx đã gom bởi micro-batcher, trả kết quả theo đúng thứ tự đầu vào
+def _score_txs(txs: List[Tx]) -> List[dict]:
+    b = _bundle
+    Xs = _features_from_txs(b, txs)
+
+    scores, decisions, details = b.scoring.score_decide_with_explanations(
+        Xs,
+        b.thresholds["threshold_low"],
+        b.thresholds["threshold_high"],
+        b.feat_cols,
+        b.medians,
+        key_values=[tx.transaction_seq for tx in txs],
+        include_allow=True,
+        top_k=3,
+        explain_mode=settings.EXPLAIN_MODE,
+        zscore_scope="row",
     )
+    METRICS.observe("batch_rows", len(txs), source="score")
+    METRICS.count_decisions(decisions, b.model_version, "score")
+
+    results = []
+    with METRICS.time("serialize"):
+        for i, tx in enumerate(txs):
+            reasons_json = details["reasons_json"].iloc[i]
+            results.append({
+                "transaction_seq": tx.transaction_seq,
+                "score": float(scores[i]),
+                "decision": decisions[i],
+                "threshold_low": b.thresholds["threshold_low"],
+                "threshold_high": b.thresholds["threshold_high"],
+                "model_version": b.model_version,
+                "reasons": json.loads(reasons_json) if reasons_json else []
+            })
+    return results
+
+_score_batcher = MicroBatcher(
+    _score_txs,
+    max_wait_ms=settings.SCORE_BATCH_MAX_WAIT_MS,
+    max_batch_size=settings.SCORE_BATCH_MAX_SIZE,
+    runner=_run_scoring,
+)
+
+@app.get(
+    "/score/batcher/stats",
+    tags=["Admin"],
+    summary="Micro-batcher queue depth and batch-size histograms",
+    dependencies=[Depends(require_active_user)],
+)
+def score_batcher_stats():
+    return {
+        **_score_batcher.stats(),
+        "executor": _scoring_executor.stats(),
+        "auth_executor": password_executor_stats(),
+        "model": _bundle.scoring.stats(),
+    }
+
+@app.on_event("shutdown")
+async def _close_score_batcher():
+    await _score_batcher.close()
+    _scoring_executor.shutdown()
+    shutdown_password_executor()
 
-    scores, decisions, details = score_decide_with_explanations(
-        _model,
+# Ghi snapshot velocity store (nếu có cấu hình đường dẫn)
+async def _snapshot_velocity():
+    if _velocity is None or not settings.VELOCITY_SNAPSHOT_PATH:
+        return
+    try:
+        await asyncio.to_thread(_velocity.prune)
+        n_users = await asyncio.to_thread(_velocity.snapshot, settings.VELOCITY_SNAPSHOT_PATH)
+        LOGGER.info("Velocity snapshot written to %s (%s users)", settings.VELOCITY_SNAPSHOT_PATH, n_users)
+    except Exception as exc:
+        LOGGER.warning("Velocity snapshot to %s failed: %s", settings.VELOCITY_SNAPSHOT_PATH, exc)
+
+async def _velocity_snapshot_loop():
+    while True:
+        await asyncio.sleep(settings.VELOCITY_SNAPSHOT_INTERVAL_SECONDS)
+        await _snapshot_velocity()
+
+@app.on_event("startup")
+async def _start_velocity_store():
+    global _velocity_task, _velocity_ready
+    if _velocity is None:
+        return
+    path = settings.VELOCITY_SNAPSHOT_PATH
+    if path and Path(path).exists():
+        try:
+            n_users = await asyncio.to_thread(_velocity.restore, path)
+            _velocity_ready = True
+            LOGGER.info("Velocity store restored from %s (%s users)", path, n_users)
+        except Exception as exc:
+            LOGGER.warning("Could not restore velocity snapshot %s: %s", path, exc)
+    if not _velocity_ready and settings.VELOCITY_WARMUP_FROM_DB:
+        # chạy trước khi nhận traffic để giao dịch warm-up (cũ hơn) không phải chèn muộn vào lịch sử
+        try:
+            t0 = time.perf_counter()
+            n_events = await asyncio.to_thread(_velocity.warm_up_from_db, get_engine())
+            _velocity_ready = True
+            LOGGER.info("Velocity store warmed up from transaction_info (%s transactions) in %.1fs",
+                        n_events, time.perf_counter() - t0)
+        except Exception as exc:
+            LOGGER.error("Velocity warm-up from transaction_info failed: %s", exc)
+    if not _velocity_ready:
+        LOGGER.warning("Velocity store has no history; keeping client-supplied velocity features")
+    if path and settings.VELOCITY_SNAPSHOT_INTERVAL_SECONDS > 0:
+        _velocity_task = asyncio.get_running_loop().create_task(_velocity_snapshot_loop())
+
+@app.on_event("shutdown")
+async def _stop_velocity_store():
+    if _velocity_task is not None:
+        _velocity_task.cancel()
+    await _snapshot_velocity()
+
+# Chấm điểm payload /score/batch (chạy trong scoring executor)
+def _score_batch_payload(payload: TxBatch) -> dict:
+    b = _bundle
+    Xs = _features_from_txs(b, payload.transactions)
+
+    key_vals = [int(tx.transaction_seq) for tx in payload.transactions]
+    _, decisions, details = b.scoring.score_decide_with_explanations(
         Xs,
-        _th["threshold_low"],
-        _th["threshold_high"],
-        _feat_cols,
-        _medians,
-        key_values=[tx.transaction_seq],
+        b.thresholds["threshold_low"],
+        b.thresholds["threshold_high"],
+        b.feat_cols,
+        b.medians,
+        key_values=key_vals,
         include_allow=True,
         top_k=3,
+        explain_mode=settings.EXPLAIN_MODE,
     )
+    METRICS.observe("batch_rows", len(key_vals), source="score_batch")
+    METRICS.count_decisions(decisions, b.model_version, "score_batch")
+
+    with METRICS.time("serialize"):
+        detail_rows = details.copy()
+        detail_rows["reasons"] = detail_rows["reasons_json"].apply(lambda x: json.loads(x) if x else [])
+        detail_rows.drop(columns=["reasons_json"], inplace=True)
+        results = detail_rows.to_dict(orient="records")
 
-    reasons_json = details.loc[details["transaction_seq"] == tx.transaction_seq, "reasons_json"].iloc[0]
-    reasons = json.loads(reasons_json) if reasons_json else []
     return {
-        "transaction_seq": tx.transaction_seq,
-        "score": float(scores[0]),
-        "decision": decisions[0],
-        "threshold_low": _th["threshold_low"],
-        "threshold_high": _th["threshold_high"],
-        "model_version": _th["model_version"],
-        "reasons": reasons
+        "count": len(results),
+        "threshold_low": b.thresholds["threshold_low"],
+        "threshold_high": b.thresholds["threshold_high"],
+        "model_version": b.model_version,
+        "results": results,
     }
 
 @app.post(
@@ -293,51 +628,90 @@ def score(tx: Tx):
     summary="Score a batch of transactions",
     dependencies=[Depends(require_active_user)],  
 )
-def score_batch(payload: TxBatch):
+async def score_batch(payload: TxBatch):
     if not payload.transactions:
+        b = _bundle
         return {
             "count": 0,
             "results": [],
-            "threshold_low": _th["threshold_low"],
-            "threshold_high": _th["threshold_high"],
-            "model_version": _th["model_version"],
+            "threshold_low": b.thresholds["threshold_low"],
+            "threshold_high": b.thresholds["threshold_high"],
+            "model_version": b.model_version,
         }
+    if _velocity is not None:
+        payload = TxBatch(transactions=[_with_velocity(tx) for tx in payload.transactions])
+    return await _dispatch(_score_batch_payload, payload)
 
-    df = pd.DataFrame([tx.dict() for tx in payload.transactions])
+# Chấm điểm + giải thích một DataFrame giao dịch thô, trả về list kết quả theo dòng
+def _score_frame(b: ScoringBundle, df: pd.DataFrame, include_allow: bool, top_k: int) -> List[dict]:
     Xs = prepare_features_for_inference(
         df_raw=df,
-        feat_cols=_feat_cols,
-        encoders=_encoders,
-        medians=_medians,
+        feat_cols=b.feat_cols,
+        encoders=b.encoders,
+        medians=b.medians,
         maybe_cats=["receiving_country","country_code","id_type","stay_qualify","payment_method", "payment_method_filled"],
-        clipping_bounds=_clipping_bounds
+        clipping_bounds=b.clipping_bounds
     )
 
     key_vals = df["transaction_seq"].astype(int).tolist()
-    _, _, details = score_decide_with_explanations(
-        _model,
+    _, decisions, details = b.scoring.score_decide_with_explanations(
         Xs,
-        _th["threshold_low"],
-        _th["threshold_high"],
-        _feat_cols,
-        _medians,
+        b.thresholds["threshold_low"],
+        b.thresholds["threshold_high"],
+        b.feat_cols,
+        b.medians,
         key_values=key_vals,
-        include_allow=True,
-        top_k=3,
+        include_allow=include_allow,
+        top_k=top_k,
+        explain_mode=settings.EXPLAIN_MODE,
     )
+    METRICS.observe("batch_rows", len(key_vals), source="upload")
+    METRICS.count_decisions(decisions, b.model_version, "upload")
+
+    with METRICS.time("serialize"):
+        detail_rows = details.copy()
+        detail_rows["reasons"] = detail_rows["reasons_json"].apply(lambda x: json.loads(x) if x else [])
+        detail_rows.drop(columns=["reasons_json"], inplace=True)
+        return detail_rows.to_dict(orient="records")
+
+class InvalidUpload(Exception):
+    """File CSV upload không hợp lệ (lỗi của client -> 400); lỗi khác khi chấm điểm vẫn là 500."""
 
-    detail_rows = details.copy()
-    detail_rows["reasons"] = detail_rows["reasons_json"].apply(lambda x: json.loads(x) if x else [])
-    detail_rows.drop(columns=["reasons_json"], inplace=True)
 
+# Kiểm tra cột bắt buộc của file CSV upload
+def _check_upload_columns(df: pd.DataFrame) -> None:
+    required_cols = {"transaction_seq"}
+    missing = required_cols - set(df.columns)
+    if missing:
+        raise InvalidUpload(f"Missing required columns in CSV: {', '.join(missing)}")
+    if pd.to_numeric(df["transaction_seq"], errors="coerce").isna().any():
+        raise InvalidUpload("Column transaction_seq must be an integer on every row.")
+
+# Đọc CSV và chấm điểm (chạy trong scoring executor); lỗi dữ liệu -> InvalidUpload
+def _score_csv_bytes(content: bytes, include_allow: bool, top_k: int) -> dict:
+    try:
+        df = pd.read_csv(io.StringIO(content.decode("utf-8-sig")))
+    except Exception as exc:
+        raise InvalidUpload(f"Failed to read CSV file: {exc}")
+    _check_upload_columns(df)
+
+    b = _bundle
+    results = _score_frame(b, df, include_allow, top_k)
     return {
-        "count": len(detail_rows),
-        "threshold_low": _th["threshold_low"],
-        "threshold_high": _th["threshold_high"],
-        "model_version": _th["model_version"],
-        "results": detail_rows.to_dict(orient="records"),
+        "count": len(results),
+        "threshold_low": b.thresholds["threshold_low"],
+        "threshold_high": b.thresholds["threshold_high"],
+        "model_version": b.model_version,
+        "results": results,
     }
 
+# Chấm điểm một chunk và serialize thành các dòng NDJSON (chạy trong scoring executor)
+def _score_chunk_ndjson(df: pd.DataFrame, include_allow: bool, top_k: int) -> str:
+    # chunk thứ 2 trở đi của read_csv có index bắt đầu từ giữa file; preprocess cần index 0..n-1
+    results = _score_frame(_bundle, df.reset_index(drop=True), include_allow, top_k)
+    with METRICS.time("serialize"):
+        return "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in results)
+
 @app.post(
     "/score/upload",
     tags=["Scoring"],
@@ -348,51 +722,97 @@ async def score_upload(file: UploadFile = File(...), include_allow: bool = True,
     if not file.filename.lower().endswith(".csv"):
         raise HTTPException(status_code=400, detail="Only CSV files are supported.")
 
+    content = await file.read()
     try:
-        content = await file.read()
-        df = pd.read_csv(io.StringIO(content.decode("utf-8-sig")))
-    except Exception as exc:
-        raise HTTPException(status_code=400, detail=f"Failed to read CSV file: {exc}")
+        result = await _dispatch(_score_csv_bytes, content, include_allow, top_k)
+    except InvalidUpload as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    return {"filename": file.filename, **result}
+
+# Ngưỡng RAM của bản spooled (như UploadFile của Starlette); vượt ngưỡng thì ghi ra file tạm
+UPLOAD_SPOOL_MAX_BYTES = 1024 * 1024
+
+# Hàm chép file upload sang SpooledTemporaryFile riêng của stream
+def _spool_upload(src):
+    src.seek(0)
+    spool = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_BYTES)
+    shutil.copyfileobj(src, spool)
+    spool.seek(0)
+    return spool
 
-    required_cols = {"transaction_seq"}
-    missing = required_cols - set(df.columns)
-    if missing:
-        raise HTTPException(status_code=400, detail=f"Missing required columns in CSV: {', '.join(missing)}")
-
-    Xs = prepare_features_for_inference(
-        df_raw=df,
-        feat_cols=_feat_cols,
-        encoders=_encoders,
-        medians=_medians,
-        maybe_cats=["receiving_country","country_code","id_type","stay_qualify","payment_method", "payment_method_filled"],
-        clipping_bounds=_clipping_bounds
-    )
-
-    key_vals = df["transaction_seq"].astype(int).tolist()
-    _, _, details = score_decide_with_explanations(
-        _model,
-        Xs,
-        _th["threshold_low"],
-        _th["threshold_high"],
-        _feat_cols,
-        _medians,
-        key_values=key_vals,
-        include_allow=include_allow,
-        top_k=top_k,
-    )
+@app.post(
+    "/score/upload/stream",
+    tags=["Scoring"],
+    summary="Score a large CSV upload chunk by chunk, streaming NDJSON results",
+    dependencies=[Depends(require_active_user)],
+)
+async def score_upload_stream(
+    file: UploadFile = File(...),
+    include_allow: bool = True,
+    top_k: int = 3,
+    chunk_rows: Optional[int] = None,
+):
+    """
+    Mỗi dòng NDJSON là kết quả của một giao dịch; dòng cuối là {"summary": {...}}.
+    File upload được chép sang một bản spooled riêng (FastAPI đóng UploadFile ngay khi endpoint trả về, trước
+    khi stream chạy) rồi đọc theo từng chunk_rows dòng nên bộ nhớ không tăng theo kích thước file.
+    Lỗi giữa chừng được trả về dưới dạng dòng {"error": "..."} rồi dừng stream.
+    """
+    if not file.filename.lower().endswith(".csv"):
+        raise HTTPException(status_code=400, detail="Only CSV files are supported.")
+    rows_per_chunk = max(1, chunk_rows or settings.UPLOAD_CHUNK_ROWS)
+    filename = file.filename
 
-    detail_rows = details.copy()
-    detail_rows["reasons"] = detail_rows["reasons_json"].apply(lambda x: json.loads(x) if x else [])
-    detail_rows.drop(columns=["reasons_json"], inplace=True)
+    spool = await asyncio.to_thread(_spool_upload, file.file)
+    try:
+        reader = await asyncio.to_thread(
+            pd.read_csv, spool, chunksize=rows_per_chunk, encoding="utf-8-sig"
+        )
+    except Exception as exc:
+        spool.close()
+        raise HTTPException(status_code=400, detail=f"Failed to read CSV file: {exc}")
+    try:
+        first = await asyncio.to_thread(next, reader, None)
+        if first is None:
+            raise HTTPException(status_code=400, detail="CSV file is empty.")
+        try:
+            _check_upload_columns(first)
+        except InvalidUpload as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+    except HTTPException:
+        reader.close()
+        spool.close()
+        raise
+    except Exception as exc:
+        reader.close()
+        spool.close()
+        raise HTTPException(status_code=400, detail=f"Failed to read CSV file: {exc}")
 
-    return {
-        "filename": file.filename,
-        "count": len(detail_rows),
-        "threshold_low": _th["threshold_low"],
-        "threshold_high": _th["threshold_high"],
-        "model_version": _th["model_version"],
-        "results": detail_rows.to_dict(orient="records"),
-    }
+    # generator sở hữu reader + bản spooled và đóng cả hai khi stream kết thúc (kể cả client ngắt giữa chừng)
+    async def body():
+        chunk, count = first, 0
+        try:
+            while chunk is not None:
+                yield await _dispatch(_score_chunk_ndjson, chunk, include_allow, top_k)
+                count += len(chunk)
+                chunk = await asyncio.to_thread(next, reader, None)
+        except Exception as exc:
+            LOGGER.warning("Streaming upload %s failed after %s rows: %s", filename, count, exc)
+            yield json.dumps({"error": str(getattr(exc, "detail", exc)), "rows_scored": count}) + "\n"
+            return
+        finally:
+            reader.close()
+            spool.close()
+        b = _bundle
+        yield json.dumps({"summary": {
+            "filename": filename,
+            "count": count,
+            "threshold_low": b.thresholds["threshold_low"],
+            "threshold_high": b.thresholds["threshold_high"],
+            "model_version": b.model_version,
+        }}) + "\n"
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
 
 
 # loaded_model = mlflow.pyfunc.load_model(logged_model_uri)
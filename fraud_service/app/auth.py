@@ -1,6 +1,10 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Annotated, Optional
+from typing import Annotated, Optional, Tuple
 
 import jwt
 from fastapi import Depends, HTTPException, Security, status
@@ -11,6 +15,8 @@ from sqlalchemy.orm import Session
 
 from app.config import settings
 from app.database import Base, get_db, get_engine
+from app.executor import ScoringExecutor
+from app.metrics import METRICS
 from app.models_auth import AuthToken, AuthUser
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -27,6 +33,114 @@ class AuthContext:
     username: str
     token_jti: str
 
+@dataclass(frozen=True)
+class _CachedToken:
+    token_jti: str
+    user_id: int
+    username: Optional[str]  # None: token còn nhưng user không còn tồn tại
+    is_active: bool
+    expires_at: datetime
+
+class TokenCache:
+    """
+    Cache LRU các jti đã xác thực với DB (user_id, is_active, expires_at), giới hạn theo số entry và TTL.
+    Entry hết hạn ở min(TTL, expires_at của token); revoke_token() xoá entry ngay trong process hiện tại,
+    các worker khác thấy thu hồi qua sync_revocations() (nếu bật) hoặc chậm nhất sau TTL. sync_revocations()
+    cũng đối chiếu lại is_active của các user đang có trong cache nên user bị khoá / xoá bị chặn cùng nhịp sync.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float, revocation_sync_seconds: float = 0.0):
+        self.max_size = max(0, int(max_size))
+        self.ttl = max(0.0, float(ttl_seconds))
+        self.revocation_sync_seconds = max(0.0, float(revocation_sync_seconds))
+        self._entries: "OrderedDict[str, Tuple[float, _CachedToken]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._revoked_since: Optional[datetime] = None
+        self._next_sync = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0 and self.ttl > 0
+
+    def get(self, jti: str) -> Optional[_CachedToken]:
+        with self._lock:
+            item = self._entries.get(jti)
+            if item is not None and item[0] > time.monotonic():
+                self._entries.move_to_end(jti)
+                self.hits += 1
+                return item[1]
+            if item is not None:
+                del self._entries[jti]
+            self.misses += 1
+            return None
+
+    def put(self, entry: _CachedToken) -> None:
+        if not self.enabled:
+            return
+        remaining = (entry.expires_at - datetime.now(tz=timezone.utc)).total_seconds()
+        valid_until = time.monotonic() + min(self.ttl, remaining)
+        with self._lock:
+            self._entries[entry.token_jti] = (valid_until, entry)
+            self._entries.move_to_end(entry.token_jti)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, jti: str) -> None:
+        with self._lock:
+            self._entries.pop(jti, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    # Đọc các token bị thu hồi (bởi bất kỳ worker nào) kể từ lần sync trước và xoá khỏi cache, rồi bỏ entry
+    # của user có is_active trong DB khác với lúc cache (bị khoá, mở lại hoặc đã xoá);
+    # tối đa một lượt sync (hai truy vấn) mỗi revocation_sync_seconds trong mỗi process
+    def sync_revocations(self, db: Session) -> None:
+        if not (self.enabled and self.revocation_sync_seconds > 0):
+            return
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_sync:
+                return
+            self._next_sync = now + self.revocation_sync_seconds
+            since = self._revoked_since
+        if since is None:
+            # lần đầu: entry trong cache đều được nạp sau thời điểm này nên chỉ cần theo dõi từ bây giờ
+            since = datetime.now(tz=timezone.utc) - timedelta(seconds=self.ttl)
+        rows = db.execute(
+            select(AuthToken.token_jti, AuthToken.revoked_at).where(AuthToken.revoked_at >= since)
+        ).all()
+        with self._lock:
+            for jti, _ in rows:
+                self._entries.pop(jti, None)
+            latest = max((revoked_at for _, revoked_at in rows), default=since)
+            # lùi một khoảng nhỏ để không bỏ sót thu hồi commit muộn / lệch đồng hồ giữa các máy
+            self._revoked_since = max(since, latest - timedelta(seconds=5))
+            user_ids = list({entry.user_id for _, entry in self._entries.values()})
+        if not user_ids:
+            return
+        active = set(db.execute(
+            select(AuthUser.id).where(AuthUser.id.in_(user_ids), AuthUser.is_active.is_(True))
+        ).scalars())
+        with self._lock:
+            stale = [jti for jti, (_, entry) in self._entries.items() if (entry.user_id in active) != entry.is_active]
+            for jti in stale:
+                del self._entries[jti]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "max_size": self.max_size, "ttl_seconds": self.ttl,
+                    "hits": self.hits, "misses": self.misses}
+
+_token_cache = TokenCache(
+    settings.AUTH_TOKEN_CACHE_SIZE,
+    settings.AUTH_TOKEN_CACHE_TTL_SECONDS,
+    settings.AUTH_REVOCATION_SYNC_SECONDS,
+)
+
 # Hàm đảm bảo schema auth_users và auth_tokens được tạo trong DB
 def _ensure_schema() -> None:
     global _schema_initialized
@@ -44,14 +158,54 @@ def hash_password(password: str) -> str:
 def verify_password(password: str, password_hash: str) -> bool:
     return pwd_context.verify(password, password_hash)
 
-# Hàm đăng nhập: xác thực username/password và trả về đối tượng user nếu hợp lệ
-def authenticate_user(db: Session, username: str, password: str) -> Optional[AuthUser]:
+# Executor riêng cho bcrypt (~100-300ms CPU mỗi lần): burst đăng nhập không chiếm threadpool của scoring;
+# hàng đợi đầy -> ScoringOverloaded (API trả 503)
+_password_executor = ScoringExecutor(
+    kind=settings.AUTH_EXECUTOR,
+    max_workers=settings.AUTH_WORKERS,
+    max_pending=settings.AUTH_MAX_PENDING,
+    name="auth",
+)
+
+async def hash_password_async(password: str) -> str:
+    return await _password_executor.run(hash_password, password)
+
+async def verify_password_async(password: str, password_hash: str) -> bool:
+    return await _password_executor.run(verify_password, password, password_hash)
+
+def password_executor_stats() -> dict:
+    return _password_executor.stats()
+
+def shutdown_password_executor() -> None:
+    _password_executor.shutdown()
+
+# Hàm tra user còn hoạt động theo username
+def _find_active_user(db: Session, username: str) -> Optional[AuthUser]:
     _ensure_schema()
     stmt = select(AuthUser).where(AuthUser.username == username)
     user = db.execute(stmt).scalar_one_or_none()
     if not user or not user.is_active:
         return None
-    if not verify_password(password, user.password_hash):
+    return user
+
+# Hàm đăng nhập: xác thực username/password và trả về đối tượng user nếu hợp lệ
+def authenticate_user(db: Session, username: str, password: str) -> Optional[AuthUser]:
+    user = _find_active_user(db, username)
+    if user is None or not verify_password(password, user.password_hash):
+        return None
+    return user
+
+# Tra user rồi kết thúc transaction để trả connection về pool trong lúc chờ bcrypt
+# (session dùng expire_on_commit=False nên thuộc tính của user vẫn còn nguyên)
+def _find_active_user_released(db: Session, username: str) -> Optional[AuthUser]:
+    user = _find_active_user(db, username)
+    db.commit()
+    return user
+
+# Bản async cho request handler: truy vấn DB trong threadpool, bcrypt trên executor riêng
+async def authenticate_user_async(db: Session, username: str, password: str) -> Optional[AuthUser]:
+    user = await asyncio.to_thread(_find_active_user_released, db, username)
+    if user is None or not await verify_password_async(password, user.password_hash):
         return None
     return user
 
@@ -86,8 +240,8 @@ def issue_token(db: Session, user: AuthUser) -> str:
     db.commit()
     return encoded
 
-# Hàm đọc JWT gửi lên và đối chiếu với bản ghi lưu trong DB
-def _load_token_record(db: Session, token: str) -> AuthToken:
+# Hàm giải mã + kiểm tra chữ ký JWT, trả về (user_id, jti)
+def _decode_token(token: str):
     if not settings.JWT_SECRET_KEY:
         raise AuthError("JWT_SECRET_KEY not configured.")
     try:
@@ -104,11 +258,15 @@ def _load_token_record(db: Session, token: str) -> AuthToken:
     jti = payload.get("jti")
     if not sub or not jti:
         raise AuthError("Token is missing required information.")
+    return int(sub), jti
+
+# Hàm tra bản ghi AuthToken theo jti và kiểm tra thu hồi / hết hạn
+def _fetch_token_record(db: Session, user_id: int, jti: str) -> AuthToken:
     stmt = select(AuthToken).where(AuthToken.token_jti == jti)
     db_token = db.execute(stmt).scalar_one_or_none()
     if db_token is None:
         raise AuthError("Token does not exist or has been revoked.")
-    if db_token.user_id != int(sub):
+    if db_token.user_id != user_id:
         raise AuthError("Token does not match user.")
     if db_token.revoked_at is not None:
         raise AuthError("Token has been revoked.")
@@ -116,6 +274,30 @@ def _load_token_record(db: Session, token: str) -> AuthToken:
         raise AuthError("Token has expired.")
     return db_token
 
+# Hàm đọc JWT gửi lên và đối chiếu với bản ghi lưu trong DB
+def _load_token_record(db: Session, token: str) -> AuthToken:
+    user_id, jti = _decode_token(token)
+    return _fetch_token_record(db, user_id, jti)
+
+# Hàm xác thực token qua cache jti; cache miss -> đối chiếu DB (token + user) rồi lưu vào cache
+def _validated_token(db: Session, token: str) -> _CachedToken:
+    user_id, jti = _decode_token(token)
+    _token_cache.sync_revocations(db)
+    cached = _token_cache.get(jti)
+    if cached is not None and cached.user_id == user_id and cached.expires_at >= datetime.now(tz=timezone.utc):
+        return cached
+    db_token = _fetch_token_record(db, user_id, jti)
+    user = db_token.user
+    entry = _CachedToken(
+        token_jti=db_token.token_jti,
+        user_id=db_token.user_id,
+        username=user.username if user is not None else None,
+        is_active=bool(user is not None and user.is_active),
+        expires_at=db_token.expires_at,
+    )
+    _token_cache.put(entry)
+    return entry
+
 # Dependency FastAPI đọc bearer token và trả về bản ghi AuthToken
 def get_current_auth_token(
     bearer_token: str = Depends(oauth2_scheme),
@@ -132,20 +314,32 @@ def get_current_auth_token(
         ) from exc
     return token
 
-# Dependency buộc người dùng phải còn hoạt động và trả về AuthContext gọn nhẹ
-def require_active_user(token: AuthToken = Depends(get_current_auth_token)) -> AuthContext:
-    user = token.user
-    if user is None:
+# Dependency buộc người dùng phải còn hoạt động và trả về AuthContext gọn nhẹ (token hợp lệ được cache theo jti)
+def require_active_user(
+    bearer_token: str = Depends(oauth2_scheme),
+    db: Session = Depends(get_db),
+) -> AuthContext:
+    _ensure_schema()
+    try:
+        with METRICS.time("auth"):
+            token = _validated_token(db, bearer_token)
+    except AuthError as exc:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail=str(exc),
+            headers={"WWW-Authenticate": "Bearer"},
+        ) from exc
+    if token.username is None:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Unable to retrieve user information.",
         )
-    if not user.is_active:
+    if not token.is_active:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Account has been disabled.",
         )
-    return AuthContext(user_id=user.id, username=user.username, token_jti=token.token_jti)
+    return AuthContext(user_id=token.user_id, username=token.username, token_jti=token.token_jti)
 
 # Hàm thu hồi token bằng cách set revoked_at trong DB
 def revoke_token(db: Session, token_jti: str) -> None:
@@ -156,6 +350,7 @@ def revoke_token(db: Session, token_jti: str) -> None:
     )
     db.execute(stmt)
     db.commit()
+    _token_cache.invalidate(token_jti)
 
 # Dependency tùy chọn: chỉ trả về AuthContext khi header Bearer hợp lệ
 def optional_active_user(
@@ -165,17 +360,16 @@ def optional_active_user(
     if not authorization:
         return None
     try:
-        db_token = _load_token_record(db, authorization)
+        token = _validated_token(db, authorization)
     except AuthError as exc:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=str(exc),
             headers={"WWW-Authenticate": "Bearer"},
         ) from exc
-    user = db_token.user
-    if user is None or not user.is_active:
+    if token.username is None or not token.is_active:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Account has been disabled.",
         )
-    return AuthContext(user_id=user.id, username=user.username, token_jti=db_token.token_jti)
+    return AuthContext(user_id=token.user_id, username=token.username, token_jti=token.token_jti)
\ No newline at end of file
@@ -1,101 +1,191 @@
 import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))
 
+import argparse
+import io
 import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, List, Optional, Tuple
 import pandas as pd
 import numpy as np
 from pathlib import Path
 from sqlalchemy import create_engine, text
 from app.config import settings
-from app.model_io import load_model_and_artifacts
+from app.model_io import load_model_and_artifacts, resolve_registry_version
+from app.bundle import ScoringBundle
 from app.preprocess import prepare_features_for_inference
 from app.scoring import score_and_decide
 from app.explain import batch_explanations
+from app.metrics import METRICS, export_batch_metrics
+from data.sql import build_feature_sql
 from utils.logging_utils import configure_logging
 LOGGER = logging.getLogger(__name__)
 
-SQL_RECENT = """
-WITH recent AS (
-  SELECT t.seq AS transaction_seq, u.seq AS user_seq, t.create_dt,
-         t.deposit_amount, t.receiving_country, p.country_code, p.id_type,
-         p.stay_qualify, p.visa_expire_date, u.name AS user_name,
-         COALESCE(
-           (SELECT deposit_name FROM kibnet_account_issued k WHERE ukey = t.seq::text),
-           (SELECT account_holder_name FROM op_withdraw o2 WHERE transaction_seq = t.seq),
-           (SELECT account_holder FROM account_transfer_issued 
-            WHERE remittance_type = 'OVERSEA_TRANSACTION' AND related_seq = t.seq)
-         ) AS sender_name,
-         t.recipient_name, pi.method AS payment_method,
-         (SELECT DISTINCT ON (user_seq_no) account_number
-            FROM op_log_user_register
-           WHERE rsp_code='A0000' AND user_seq_no=o.user_seq_no
-           ORDER BY user_seq_no, seq DESC) AS autodebit_account,
-         (SELECT DISTINCT ON (user_seq) update_dt::date
-            FROM id_approval
-           WHERE user_seq = u.seq
-           ORDER BY user_seq, seq) AS register_date,
-         (SELECT t2.create_dt::date
-            FROM transaction_info t2
-           WHERE t2.user_seq=u.seq AND t2.category=3
-           ORDER BY t2.seq LIMIT 1) AS first_transaction_date,
-         u.birth_date,
-         (SELECT approve_dt::date
-            FROM idcard_recheck
-           WHERE uid = p.uid AND status='APPROVED'
-           ORDER BY uid, seq DESC LIMIT 1) AS recheck_date,
-         u.invite_code,
-         (SELECT DISTINCT ON (user_seq) update_dt::date
-            FROM face_pin
-           WHERE user_seq=u.seq AND active
-           ORDER BY user_seq, seq DESC) AS face_pin_date,
-         (SELECT COUNT(*) FROM transaction_info
-           WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '24 hour') AS transaction_count_24hour,
-         (SELECT COALESCE(SUM(deposit_amount),0) FROM transaction_info
-           WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '24 hour') AS transaction_amount_24hour,
-         (SELECT COUNT(*) FROM transaction_info
-           WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '1 week') AS transaction_count_1week,
-         (SELECT COALESCE(SUM(deposit_amount),0) FROM transaction_info
-           WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '1 week') AS transaction_amount_1week,
-         (SELECT COUNT(*) FROM transaction_info
-           WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '1 month') AS transaction_count_1month,
-         (SELECT COALESCE(SUM(deposit_amount),0) FROM transaction_info
-           WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '1 month') AS transaction_amount_1month
-    FROM transaction_info t
-    JOIN user_info u ON u.seq=t.user_seq
-    JOIN personal_identification p ON p.uid=u.uid
-    LEFT JOIN payment_info pi ON pi.transaction_seq=t.seq
-    LEFT JOIN op_token o ON o.user_seq=u.seq
-   WHERE t.create_dt >= NOW() - (:mins * INTERVAL '1 minute')
+CHECKPOINT_JOB = "batch_job"
+
+# Một page = các giao dịch có seq trong (after_seq, upto_seq]; cận trên lấy từ SQL_PAGE_BOUNDS
+SQL_PAGE = build_feature_sql("t.seq > :after_seq AND t.seq <= :upto_seq")
+
+# Page = tối đa page_size giao dịch liên tiếp theo seq sau checkpoint, dừng trước giao dịch đầu tiên
+# còn quá mới (create_dt trong settle giây gần nhất) để không vượt qua các transaction chưa kịp commit
+SQL_PAGE_BOUNDS = """
+WITH page AS (
+  SELECT seq, create_dt
+  FROM transaction_info
+  WHERE seq > :after_seq
+  ORDER BY seq
+  LIMIT :page_size
+),
+fresh AS (
+  SELECT MIN(seq) AS seq FROM page WHERE create_dt > NOW() - (:settle * INTERVAL '1 second')
+)
+SELECT COUNT(*), MAX(p.seq), MAX(p.create_dt)
+FROM page p, fresh f
+WHERE f.seq IS NULL OR p.seq < f.seq
+"""
+
+# Chia backlog đã settle sau checkpoint thành các shard liên tiếp shard_size giao dịch (chế độ partitioned)
+SQL_SHARD_BOUNDS = """
+WITH page AS (
+  SELECT seq, create_dt
+  FROM transaction_info
+  WHERE seq > :after_seq
+  ORDER BY seq
+  LIMIT :max_rows
+),
+fresh AS (
+  SELECT MIN(seq) AS seq FROM page WHERE create_dt > NOW() - (:settle * INTERVAL '1 second')
+),
+settled AS (
+  SELECT p.seq, p.create_dt, (ROW_NUMBER() OVER (ORDER BY p.seq) - 1) / :shard_size AS shard
+  FROM page p, fresh f
+  WHERE f.seq IS NULL OR p.seq < f.seq
 )
-SELECT r.*
-FROM recent r
-LEFT JOIN fraud_scores fs ON fs.transaction_seq = r.transaction_seq
-WHERE fs.transaction_seq IS NULL;
+SELECT shard, COUNT(*), MAX(seq), MAX(create_dt)
+FROM settled
+GROUP BY shard
+ORDER BY shard
 """
 
 MIGRATION_PATH = Path(__file__).resolve().parents[1] / "migrations" / "001_create_fraud_tables.sql"
+CHECKPOINT_MIGRATION_PATH = Path(__file__).resolve().parents[1] / "migrations" / "004_create_batch_checkpoint.sql"
 LOGGER = logging.getLogger(__name__)
 
 def ensure_tables(conn):
     """
-    Đảm bảo các bảng fraud_scores / fraud_explanations tồn tại trước khi ghi dữ liệu.
+    Đảm bảo các bảng fraud_scores / fraud_explanations / fraud_batch_checkpoint tồn tại trước khi ghi dữ liệu.
     """
-    sql = MIGRATION_PATH.read_text(encoding="utf-8")
-    conn.execute(text(sql))
+    for path in (MIGRATION_PATH, CHECKPOINT_MIGRATION_PATH):
+        conn.execute(text(path.read_text(encoding="utf-8")))
 
+# Hàm đọc + khóa (FOR UPDATE) checkpoint; lần chạy đầu tiên khởi tạo từ fraud_scores hoặc cửa sổ lookback
+def lock_checkpoint(conn, job_name: str = CHECKPOINT_JOB) -> int:
+    conn.execute(text("""
+    INSERT INTO fraud_batch_checkpoint (job_name, last_transaction_seq)
+    SELECT :job_name, COALESCE(
+      (SELECT MAX(transaction_seq) FROM fraud_scores),
+      (SELECT MIN(seq) - 1 FROM transaction_info WHERE create_dt >= NOW() - (:mins * INTERVAL '1 minute')),
+      (SELECT MAX(seq) FROM transaction_info),
+      0
+    )
+    ON CONFLICT (job_name) DO NOTHING
+    """), {"job_name": job_name, "mins": settings.BATCH_LOOKBACK_MINUTES})
+    return int(conn.execute(
+        text("SELECT last_transaction_seq FROM fraud_batch_checkpoint WHERE job_name = :job_name FOR UPDATE"),
+        {"job_name": job_name},
+    ).scalar_one())
 
-def upsert_scores(conn, df, model_version, th_low, th_high):
-    sql = """
-    INSERT INTO fraud_scores (transaction_seq, scored_at, model_version, score, decision, threshold_low, threshold_high)
-    VALUES (:transaction_seq, NOW(), :model_version, :score, :decision, :th_low, :th_high)
-    ON CONFLICT (transaction_seq) DO UPDATE
-      SET scored_at=EXCLUDED.scored_at,
-          model_version=EXCLUDED.model_version,
-          score=EXCLUDED.score,
-          decision=EXCLUDED.decision,
-          threshold_low=EXCLUDED.threshold_low,
-          threshold_high=EXCLUDED.threshold_high;
-    """
+# Hàm dời checkpoint (cùng transaction với các upsert của page)
+def advance_checkpoint(conn, upto_seq: int, upto_create_dt, job_name: str = CHECKPOINT_JOB):
+    conn.execute(text("""
+    UPDATE fraud_batch_checkpoint
+       SET last_transaction_seq = :upto_seq, last_create_dt = :upto_create_dt, updated_at = NOW()
+     WHERE job_name = :job_name
+    """), {"upto_seq": int(upto_seq), "upto_create_dt": upto_create_dt, "job_name": job_name})
+
+
+SQL_UPSERT_SCORES_ROW = """
+INSERT INTO fraud_scores (transaction_seq, scored_at, model_version, score, decision, threshold_low, threshold_high)
+VALUES (:transaction_seq, NOW(), :model_version, :score, :decision, :th_low, :th_high)
+ON CONFLICT (transaction_seq) DO UPDATE
+  SET scored_at=EXCLUDED.scored_at,
+      model_version=EXCLUDED.model_version,
+      score=EXCLUDED.score,
+      decision=EXCLUDED.decision,
+      threshold_low=EXCLUDED.threshold_low,
+      threshold_high=EXCLUDED.threshold_high;
+"""
+
+SQL_UPSERT_EXPL_ROW = """
+INSERT INTO fraud_explanations (transaction_seq, scored_at, model_version, reasons_json)
+VALUES (:transaction_seq, NOW(), :model_version, CAST(:reasons_json AS jsonb))
+ON CONFLICT (transaction_seq) DO UPDATE
+  SET scored_at=EXCLUDED.scored_at,
+      model_version=EXCLUDED.model_version,
+      reasons_json=EXCLUDED.reasons_json;
+"""
+
+# Bulk path: COPY vào bảng tạm rồi merge bằng một câu INSERT ... SELECT ... ON CONFLICT.
+# DISTINCT ON (..., ord DESC) giữ dòng cuối cùng của mỗi transaction_seq như khi upsert từng dòng.
+SQL_STAGE_SCORES = """
+CREATE TEMP TABLE IF NOT EXISTS stage_fraud_scores (
+  ord BIGINT, transaction_seq BIGINT, score DOUBLE PRECISION, decision TEXT
+) ON COMMIT DROP;
+TRUNCATE stage_fraud_scores;
+"""
+
+SQL_MERGE_SCORES = """
+INSERT INTO fraud_scores (transaction_seq, scored_at, model_version, score, decision, threshold_low, threshold_high)
+SELECT DISTINCT ON (transaction_seq) transaction_seq, NOW(), :model_version, score, decision, :th_low, :th_high
+FROM stage_fraud_scores
+ORDER BY transaction_seq, ord DESC
+ON CONFLICT (transaction_seq) DO UPDATE
+  SET scored_at=EXCLUDED.scored_at,
+      model_version=EXCLUDED.model_version,
+      score=EXCLUDED.score,
+      decision=EXCLUDED.decision,
+      threshold_low=EXCLUDED.threshold_low,
+      threshold_high=EXCLUDED.threshold_high;
+"""
+
+SQL_STAGE_EXPL = """
+CREATE TEMP TABLE IF NOT EXISTS stage_fraud_explanations (
+  ord BIGINT, transaction_seq BIGINT, reasons_json TEXT
+) ON COMMIT DROP;
+TRUNCATE stage_fraud_explanations;
+"""
+
+SQL_MERGE_EXPL = """
+INSERT INTO fraud_explanations (transaction_seq, scored_at, model_version, reasons_json)
+SELECT DISTINCT ON (transaction_seq) transaction_seq, NOW(), :model_version, CAST(reasons_json AS jsonb)
+FROM stage_fraud_explanations
+ORDER BY transaction_seq, ord DESC
+ON CONFLICT (transaction_seq) DO UPDATE
+  SET scored_at=EXCLUDED.scored_at,
+      model_version=EXCLUDED.model_version,
+      reasons_json=EXCLUDED.reasons_json;
+"""
+
+# Hàm trả về cursor DBAPI hỗ trợ COPY (psycopg2) dùng chung transaction với conn; None nếu driver không hỗ trợ
+def _copy_cursor(conn):
+    cur = conn.connection.cursor()
+    if not hasattr(cur, "copy_expert"):
+        cur.close()
+        return None
+    return cur
+
+# Hàm COPY một DataFrame (đúng thứ tự cột của bảng tạm) vào bảng tạm dạng CSV
+def _copy_frame(cur, table: str, frame: pd.DataFrame):
+    buf = io.StringIO()
+    frame.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} FROM STDIN WITH (FORMAT csv)", buf)
+
+# Hàm upsert từng dòng qua executemany (fallback khi driver không có COPY)
+def _upsert_scores_rows(conn, df, model_version, th_low, th_high):
     payload = []
     for rec in df.to_dict(orient="records"):
         payload.append({
@@ -104,67 +194,327 @@ def upsert_scores(conn, df, model_version, th_low, th_high):
             "th_low": float(th_low),
             "th_high": float(th_high),
         })
-    conn.execute(text(sql), payload)
+    if payload:
+        conn.execute(text(SQL_UPSERT_SCORES_ROW), payload)
 
-def upsert_expl(conn, expl_df, model_version):
-    sql = """
-    INSERT INTO fraud_explanations (transaction_seq, scored_at, model_version, reasons_json)
-    VALUES (:transaction_seq, NOW(), :model_version, CAST(:reasons_json AS jsonb))
-    ON CONFLICT (transaction_seq) DO UPDATE
-      SET scored_at=EXCLUDED.scored_at,
-          model_version=EXCLUDED.model_version,
-          reasons_json=EXCLUDED.reasons_json;
-    """
+def _upsert_expl_rows(conn, expl_df, model_version):
     payload = []
     for _, r in expl_df.iterrows():
         payload.append({"transaction_seq": int(r["id"]), "model_version": model_version, "reasons_json": r["reasons_json"]})
     if payload:
-        conn.execute(text(sql), payload)
+        conn.execute(text(SQL_UPSERT_EXPL_ROW), payload)
+
+def upsert_scores(conn, df, model_version, th_low, th_high):
+    if df.empty:
+        return
+    cur = _copy_cursor(conn)
+    if cur is None:
+        return _upsert_scores_rows(conn, df, model_version, th_low, th_high)
+    try:
+        cur.execute(SQL_STAGE_SCORES)
+        _copy_frame(cur, "stage_fraud_scores", pd.DataFrame({
+            "ord": np.arange(len(df)),
+            "transaction_seq": df["transaction_seq"].astype("int64").to_numpy(),
+            "score": df["score"].astype(float).to_numpy(),
+            "decision": df["decision"].astype(str).to_numpy(),
+        }))
+    finally:
+        cur.close()
+    conn.execute(text(SQL_MERGE_SCORES), {
+        "model_version": model_version, "th_low": float(th_low), "th_high": float(th_high),
+    })
+
+def upsert_expl(conn, expl_df, model_version):
+    if expl_df.empty:
+        return
+    cur = _copy_cursor(conn)
+    if cur is None:
+        return _upsert_expl_rows(conn, expl_df, model_version)
+    try:
+        cur.execute(SQL_STAGE_EXPL)
+        _copy_frame(cur, "stage_fraud_explanations", pd.DataFrame({
+            "ord": np.arange(len(expl_df)),
+            "transaction_seq": expl_df["id"].astype("int64").to_numpy(),
+            "reasons_json": expl_df["reasons_json"].to_numpy(),
+        }))
+    finally:
+        cur.close()
+    conn.execute(text(SQL_MERGE_EXPL), {"model_version": model_version})
+
+# Hàm chấm điểm + giải thích một page giao dịch và ghi kết quả
+def score_page(conn, raw, model, encoders, feat_cols, medians, clipping_bounds, th):
+    Xs = prepare_features_for_inference(
+      df_raw=raw.copy(),
+      feat_cols=feat_cols,
+      encoders=encoders,
+      medians=medians,
+      maybe_cats=["receiving_country","country_code","id_type","stay_qualify","payment_method"],
+      clipping_bounds=clipping_bounds 
+    )
+
+    scores, decisions = score_and_decide(model, Xs, th["threshold_low"], th["threshold_high"])
+    METRICS.observe("batch_rows", len(raw), source="batch_job")
+    METRICS.count_decisions(decisions, th["model_version"], "batch_job")
+    out = pd.DataFrame({
+        "transaction_seq": raw["transaction_seq"].astype(int).values,
+        "score": scores.astype(float),
+        "decision": decisions
+    })
+
+    with METRICS.time("db_write"):
+        upsert_scores(conn, out, th["model_version"], th["threshold_low"], th["threshold_high"])
+
+    need_expl_idx = np.arange(len(decisions))
+    if need_expl_idx.size:
+        LOGGER.info("Generating explanations for %s transactions", need_expl_idx.size)
+        subset = Xs.iloc[need_expl_idx].copy()
+        subset["transaction_seq"] = raw.iloc[need_expl_idx]["transaction_seq"].values
+        subset["is_fraud"] = "NO_FRAUD"       
+        with METRICS.time("explain"):
+            expl_df = batch_explanations(model, subset, key_col="transaction_seq", top_k=6,
+                                         feat_cols=feat_cols, medians=medians, mode=settings.EXPLAIN_MODE)
+
+        with METRICS.time("db_write"):
+            upsert_expl(conn, expl_df, th["model_version"])
+        LOGGER.info("Stored %s explanations", len(expl_df))
+
+# Hàm chạy vòng page cho tới khi hết giao dịch đã settle; should_stop được kiểm tra giữa các page
+def run_batch(eng, bundle: ScoringBundle, should_stop: Optional[Callable[[], bool]] = None) -> int:
+    page_size = max(1, settings.BATCH_PAGE_SIZE)
+    total = 0
+    while not (should_stop and should_stop()):
+        # Mỗi page một transaction: upsert + dời checkpoint cùng commit (hoặc cùng rollback)
+        with eng.begin() as conn:
+            after_seq = lock_checkpoint(conn)
+            n_page, upto_seq, upto_create_dt = conn.execute(text(SQL_PAGE_BOUNDS), {
+                "after_seq": after_seq, "settle": settings.BATCH_SETTLE_SECONDS, "page_size": page_size,
+            }).one()
+            if not n_page:
+                break
+
+            with METRICS.time("db_fetch"):
+                raw = pd.read_sql(text(SQL_PAGE), conn, params={"after_seq": after_seq, "upto_seq": upto_seq})
+            LOGGER.info("Fetched %s transactions with seq in (%s, %s]", len(raw), after_seq, upto_seq)
+            if not raw.empty:
+                score_page(conn, raw, bundle.model, bundle.encoders, bundle.feat_cols, bundle.medians,
+                           bundle.clipping_bounds, bundle.thresholds)
+            advance_checkpoint(conn, upto_seq, upto_create_dt)
+        total += len(raw)
+        if n_page < page_size:
+            break
+    return total
+
+
+# Trạng thái riêng của mỗi process trong pool partitioned: engine + model nạp một lần bởi initializer
+_SHARD_STATE: dict = {}
+
+def _init_shard_worker(db_url: str) -> None:
+    configure_logging()
+    _SHARD_STATE["engine"] = create_engine(db_url, pool_size=1, max_overflow=0)
+    _SHARD_STATE["bundle"] = ScoringBundle.from_artifacts(*load_model_and_artifacts())
+    LOGGER.info("Shard worker %s ready (model %s)", os.getpid(), _SHARD_STATE["bundle"].model_version)
+
+# Hàm chấm điểm một shard seq trong (after_seq, upto_seq], commit riêng (chạy trong worker process).
+# Trả về (số dòng, metric của shard) để process cha merge vào registry của nó.
+def _score_shard(after_seq: int, upto_seq: int) -> Tuple[int, dict]:
+    bundle = _SHARD_STATE["bundle"]
+    with _SHARD_STATE["engine"].begin() as conn:
+        with METRICS.time("db_fetch"):
+            raw = pd.read_sql(text(SQL_PAGE), conn, params={"after_seq": after_seq, "upto_seq": upto_seq})
+        if not raw.empty:
+            score_page(conn, raw, bundle.model, bundle.encoders, bundle.feat_cols, bundle.medians,
+                       bundle.clipping_bounds, bundle.thresholds)
+    LOGGER.info("Shard (%s, %s] scored %s transactions", after_seq, upto_seq, len(raw))
+    return len(raw), METRICS.drain()
+
+def make_shard_pool(n_workers: int, db_url: Optional[str] = None) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(
+        max_workers=n_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_shard_worker,
+        initargs=(db_url or settings.DB_URL,),
+    )
+
+# Hàm chia backlog sau after_seq thành tối đa max_shards shard [(after_seq, upto_seq, n_rows, upto_create_dt)]
+def plan_shards(conn, after_seq: int, shard_size: int, max_shards: int) -> List[Tuple[int, int, int, object]]:
+    rows = conn.execute(text(SQL_SHARD_BOUNDS), {
+        "after_seq": after_seq, "max_rows": shard_size * max_shards,
+        "settle": settings.BATCH_SETTLE_SECONDS, "shard_size": shard_size,
+    }).all()
+    shards, lo = [], after_seq
+    for _, n_rows, hi, hi_create_dt in rows:
+        shards.append((lo, int(hi), int(n_rows), hi_create_dt))
+        lo = int(hi)
+    return shards
+
+def run_batch_partitioned(eng, pool: ProcessPoolExecutor, n_workers: int,
+                          should_stop: Optional[Callable[[], bool]] = None) -> int:
+    """
+    Chấm backlog song song: mỗi vòng giữ khoá checkpoint, chia tối đa 4 * n_workers shard BATCH_PAGE_SIZE dòng
+    cho pool; mỗi shard commit riêng nên shard lỗi không rollback các shard khác. Checkpoint chỉ dời tới hết
+    dãy shard thành công liên tiếp đầu tiên — các shard sau shard lỗi được chấm lại (upsert idempotent) lần sau.
+    Pool hỏng (worker chết / initializer lỗi) -> BrokenProcessPool để caller thay pool mới.
+    """
+    shard_size = max(1, settings.BATCH_PAGE_SIZE)
+    max_shards = 4 * max(1, n_workers)
+    total = 0
+    while not (should_stop and should_stop()):
+        with eng.begin() as conn:
+            after_seq = lock_checkpoint(conn)
+            shards = plan_shards(conn, after_seq, shard_size, max_shards)
+            if not shards:
+                break
+            t0 = time.perf_counter()
+            futures = [pool.submit(_score_shard, lo, hi) for lo, hi, _, _ in shards]
+            done_upto, failed, broken = None, [], None
+            for (lo, hi, _, hi_create_dt), fut in zip(shards, futures):
+                try:
+                    n_scored, shard_metrics = fut.result()
+                except BrokenProcessPool as exc:
+                    broken = exc
+                    failed.append((lo, hi))
+                    continue
+                except Exception as exc:
+                    LOGGER.error("Shard (%s, %s] failed: %s", lo, hi, exc)
+                    failed.append((lo, hi))
+                    continue
+                total += n_scored
+                METRICS.merge(shard_metrics)
+                if not failed:
+                    done_upto = (hi, hi_create_dt)
+            if done_upto is not None:
+                advance_checkpoint(conn, *done_upto)
+            n_rows = sum(n for _, _, n, _ in shards)
+            LOGGER.info("Scored %s shards (%s rows) on %s workers in %.2fs", len(shards), n_rows, n_workers,
+                        time.perf_counter() - t0)
+        if broken is not None:
+            raise broken
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {len(shards)} shards failed, first: {failed[0]}")
+        if n_rows < shard_size * max_shards:
+            break
+    return total
+
+
+# Hàm ghi metric của một chu kỳ batch thành công rồi xuất ra textfile / pushgateway (nếu cấu hình)
+def record_cycle_metrics(total: int, elapsed: float) -> None:
+    METRICS.set("batch_cycle_seconds", elapsed)
+    METRICS.set("batch_last_success_timestamp_seconds", time.time())
+    METRICS.inc("batch_transactions_total", total)
+    export_batch_metrics(settings.BATCH_METRICS_PATH, settings.BATCH_PUSHGATEWAY_URL, "fraud_batch_job")
+
+
+class BatchWorker:
+    """
+    Chế độ worker chạy lâu dài (scripts/scheduler.py --mode worker): model, engine (pool) và DDL chỉ làm
+    một lần; mỗi chu kỳ chỉ hỏi registry alias (reload khi alias đổi version) rồi chạy run_batch.
+    """
+
+    def __init__(self, db_url: Optional[str] = None):
+        self.engine = create_engine(db_url or settings.DB_URL, pool_pre_ping=True)
+        with self.engine.begin() as conn:
+            LOGGER.info("Using migration scripts %s, %s", MIGRATION_PATH, CHECKPOINT_MIGRATION_PATH)
+            ensure_tables(conn)
+        self.bundle: Optional[ScoringBundle] = None
+        self.n_workers = max(1, settings.BATCH_WORKERS)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._shard_version: Optional[str] = None  # version registry mà worker process của pool đang nạp
+
+    def _load_bundle(self) -> None:
+        t0 = time.perf_counter()
+        self.bundle = ScoringBundle.from_artifacts(*load_model_and_artifacts())
+        LOGGER.info("Batch worker loaded model %s (registry %s) in %.2fs",
+                    self.bundle.model_version, self.bundle.registry_version, time.perf_counter() - t0)
+        self._close_pool()  # worker process của pool nạp lại model mới ở lần dùng tới
+
+    def _close_pool(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    # Partitioned: chỉ resolve version trên registry (model nạp trong worker process, không nạp ở process cha);
+    # alias đổi version -> đóng pool để lần dùng tới các worker nạp model mới
+    def _refresh_shard_version(self) -> None:
+        try:
+            version = resolve_registry_version()
+        except Exception as exc:
+            LOGGER.warning("Registry alias check failed, keeping shard workers on %s: %s", self._shard_version, exc)
+            return
+        if version != self._shard_version:
+            if self._pool is not None:
+                LOGGER.info("Registry alias moved %s -> %s; restarting shard workers", self._shard_version, version)
+                self._close_pool()
+            self._shard_version = version
+
+    # Nạp model lần đầu; các lần sau chỉ reload khi alias trên registry trỏ sang version khác
+    def refresh_model(self) -> None:
+        if self.n_workers > 1:
+            self._refresh_shard_version()
+            return
+        if self.bundle is None:
+            self._load_bundle()
+            return
+        try:
+            version = resolve_registry_version()
+        except Exception as exc:
+            LOGGER.warning("Registry alias check failed, keeping model %s: %s", self.bundle.registry_version, exc)
+            return
+        if version is not None and version != self.bundle.registry_version:
+            LOGGER.info("Registry alias moved %s -> %s; reloading model", self.bundle.registry_version, version)
+            try:
+                self._load_bundle()
+            except Exception:
+                LOGGER.exception("Model reload failed; keeping model %s", self.bundle.registry_version)
+
+    def run_cycle(self, should_stop: Optional[Callable[[], bool]] = None) -> int:
+        t0 = time.perf_counter()
+        self.refresh_model()
+        overhead = time.perf_counter() - t0
+        if self.n_workers > 1:
+            if self._pool is None:
+                self._pool = make_shard_pool(self.n_workers)
+            try:
+                total = run_batch_partitioned(self.engine, self._pool, self.n_workers, should_stop)
+            except BrokenProcessPool:
+                # worker chết (OOM, segfault) hoặc initializer lỗi: bỏ pool hỏng, chu kỳ sau tạo pool mới
+                LOGGER.error("Shard pool is broken; it will be recreated on the next cycle")
+                self._pool.shutdown(wait=False)
+                self._pool = None
+                raise
+        else:
+            total = run_batch(self.engine, self.bundle, should_stop)
+        elapsed = time.perf_counter() - t0
+        record_cycle_metrics(total, elapsed)
+        LOGGER.info("Batch cycle scored %s transactions in %.3fs (model check %.1fms)",
+                    total, elapsed, overhead * 1000.0)
+        return total
+
+    def close(self) -> None:
+        self._close_pool()
+        self.engine.dispose()
+
 
 def main():
     configure_logging()
-    model, encoders, schema_pack, th = load_model_and_artifacts()
-    feat_cols, medians, clipping_bounds, train_like = schema_pack
+    ap = argparse.ArgumentParser(description="Score settled transactions after the batch checkpoint")
+    ap.add_argument("--workers", type=int, default=settings.BATCH_WORKERS,
+                    help="Số process chấm điểm song song (1 = tuần tự trong process hiện tại)")
+    args = ap.parse_args()
 
     eng = create_engine(settings.DB_URL)
     with eng.begin() as conn:
-        LOGGER.info("Using migration script at %s", MIGRATION_PATH)
+        LOGGER.info("Using migration scripts %s, %s", MIGRATION_PATH, CHECKPOINT_MIGRATION_PATH)
         ensure_tables(conn)
 
-        raw = pd.read_sql(text(SQL_RECENT), conn, params={"mins": settings.BATCH_LOOKBACK_MINUTES})
-        LOGGER.info("Fetched %s new transactions to score", len(raw))
-        if raw.empty: return
-
-        Xs = prepare_features_for_inference(
-          df_raw=raw.copy(),
-          feat_cols=feat_cols,
-          encoders=encoders,
-          medians=medians,
-          maybe_cats=["receiving_country","country_code","id_type","stay_qualify","payment_method"],
-          clipping_bounds=clipping_bounds 
-        )
-
-        scores, decisions = score_and_decide(model, Xs, th["threshold_low"], th["threshold_high"])
-        out = pd.DataFrame({
-            "transaction_seq": raw["transaction_seq"].astype(int).values,
-            "score": scores.astype(float),
-            "decision": decisions
-        })
-
-        upsert_scores(conn, out, th["model_version"], th["threshold_low"], th["threshold_high"])
+    t0 = time.perf_counter()
+    if args.workers > 1:
+        with make_shard_pool(args.workers) as pool:
+            total = run_batch_partitioned(eng, pool, args.workers)
+    else:
+        total = run_batch(eng, ScoringBundle.from_artifacts(*load_model_and_artifacts()))
+    record_cycle_metrics(total, time.perf_counter() - t0)
+    LOGGER.info("Batch run scored %s transactions", total)
 
-        need_expl_idx = np.arange(len(decisions))
-        if need_expl_idx.size:
-            LOGGER.info("Generating explanations for %s transactions", need_expl_idx.size)
-            subset = Xs.iloc[need_expl_idx].copy()
-            subset["transaction_seq"] = raw.iloc[need_expl_idx]["transaction_seq"].values
-            subset["is_fraud"] = "NO_FRAUD"       
-            expl_df = batch_explanations(model, subset, key_col="transaction_seq", top_k=6,
-                                         feat_cols=feat_cols, medians=medians)
-            
-            upsert_expl(conn, expl_df, th["model_version"])
-            LOGGER.info("Stored %s explanations", len(expl_df))
-            
 
 if __name__ == "__main__":
     main()
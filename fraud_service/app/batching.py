@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Histogram đơn giản (bucket theo cận trên, kiểu Prometheus) cho batch size / queue depth."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = sorted(float(b) for b in buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> Dict[str, Any]:
+        cumulative, acc = {}, 0
+        for bound, c in zip([*self.buckets, float("inf")], self.counts):
+            acc += c
+            cumulative["+Inf" if bound == float("inf") else f"{bound:g}"] = acc
+        return {"count": self.count, "sum": self.sum, "buckets": cumulative}
+
+
+class MicroBatcher:
+    """
+    Gom các request đơn lẻ đồng thời thành một batch: chờ tối đa max_wait_ms hoặc đủ
+    max_batch_size phần tử, gọi batch_fn(items) một lần qua runner (mặc định: executor
+    mặc định của event loop) rồi trả kết quả (theo đúng thứ tự) về cho từng request đang await.
+    """
+
+    def __init__(self, batch_fn: Callable[[List[Any]], List[Any]], max_wait_ms: float, max_batch_size: int,
+                 runner: Optional[Callable[..., Awaitable[Any]]] = None):
+        self.batch_fn = batch_fn
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.runner = runner
+        self.batch_size_hist = Histogram([1, 2, 4, 8, 16, 32, 64, 128, 256])
+        self.queue_depth_hist = Histogram([0, 1, 2, 4, 8, 16, 32, 64, 128, 256])
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._inflight: Set[asyncio.Task] = set()
+
+    def _ensure_started(self) -> None:
+        if self._task is None or self._task.done():
+            self._queue = asyncio.Queue()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def submit(self, item: Any) -> Any:
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, fut))
+        return await fut
+
+    async def _collect(self) -> List[Tuple[Any, asyncio.Future]]:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect()
+            self.queue_depth_hist.observe(self._queue.qsize())
+            self.batch_size_hist.observe(len(batch))
+            # Không chờ batch trước xong mới gom batch sau: executor tự giới hạn song song
+            task = asyncio.get_running_loop().create_task(self._dispatch(batch))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _dispatch(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        items = [item for item, _ in batch]
+        try:
+            if self.runner is not None:
+                results = await self.runner(self.batch_fn, items)
+            else:
+                results = await asyncio.get_running_loop().run_in_executor(None, self.batch_fn, items)
+        except Exception as exc:
+            LOGGER.warning("Micro-batch of %s items failed: %s", len(items), exc)
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+            return
+        for (_, fut), res in zip(batch, results):
+            if not fut.done():
+                fut.set_result(res)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_wait_ms": self.max_wait * 1000.0,
+            "max_batch_size": self.max_batch_size,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "batch_size": self.batch_size_hist.snapshot(),
+            "queue_depth_at_dispatch": self.queue_depth_hist.snapshot(),
+        }
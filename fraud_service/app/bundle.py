@@ -0,0 +1,76 @@
+import logging
+import time
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Any, Dict, List, Mapping, Optional
+
+import pandas as pd
+
+from app.preprocess import CompiledPreprocessor
+from app.scoring import ScoringService, score_decide_with_explanations
+
+LOGGER = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ScoringBundle:
+    """
+    Toàn bộ trạng thái cần để chấm điểm (model + encoders + schema + medians + clipping + thresholds).
+    Bất biến: request đọc tham chiếu bundle một lần rồi dùng suốt, reload chỉ thay tham chiếu
+    nên không bao giờ thấy model mới đi kèm thresholds cũ.
+    """
+
+    model: Any
+    encoders: Any
+    feat_cols: List[str]
+    medians: Mapping[str, float]
+    clipping_bounds: Any
+    train_like: pd.DataFrame
+    thresholds: Mapping[str, Any]
+    compiled_pre: CompiledPreprocessor
+    scoring: ScoringService
+    alias: Optional[str] = None
+    loaded_at: float = field(default_factory=time.time)
+
+    @classmethod
+    def from_artifacts(cls, model, encoders, schema_pack, thresholds: Dict[str, Any],
+                       alias: Optional[str] = None, model_handles: int = 1) -> "ScoringBundle":
+        feat_cols, medians, clipping_bounds, train_like = schema_pack
+        for key in ("threshold_low", "threshold_high"):
+            if thresholds.get(key) is None:
+                raise ValueError(f"Loaded thresholds are missing {key!r}")
+        return cls(
+            model=model,
+            encoders=encoders,
+            feat_cols=list(feat_cols),
+            medians=MappingProxyType(dict(medians or {})),
+            clipping_bounds=clipping_bounds,
+            train_like=train_like,
+            thresholds=MappingProxyType(dict(thresholds)),
+            compiled_pre=CompiledPreprocessor(list(feat_cols), encoders, medians, clipping_bounds),
+            scoring=ScoringService(model, model_handles),
+            alias=alias,
+        )
+
+    @property
+    def model_version(self):
+        return self.thresholds.get("model_version")
+
+    @property
+    def registry_version(self) -> Optional[str]:
+        version = self.thresholds.get("model_version_registry") or self.thresholds.get("registry_version")
+        return str(version) if version is not None else None
+
+    def warm_up(self, explain_mode: str = "perturbation") -> float:
+        """Chạy một lượt predict + explain giả lập trên dòng median (mỗi model handle) để nạp lazy state trước khi nhận traffic."""
+        t0 = time.perf_counter()
+        X = self.train_like.reindex(columns=self.feat_cols).fillna(0.0)
+        for model in self.scoring.handles:
+            scores, _, _ = score_decide_with_explanations(
+                model, X, self.thresholds["threshold_low"], self.thresholds["threshold_high"],
+                self.feat_cols, self.medians, key_values=[0], include_allow=True, top_k=3,
+                explain_mode=explain_mode,
+            )
+            if len(scores) != len(X):
+                raise RuntimeError(f"Warm-up predict returned {len(scores)} scores for {len(X)} rows")
+        return time.perf_counter() - t0
@@ -56,15 +56,29 @@ class Settings:
     MLFLOW_TRACKING_URI: Optional[str] = _get_optional_str("MLFLOW_TRACKING_URI")
     MLFLOW_MODEL_NAME: Optional[str] = _get_optional_str("MLFLOW_MODEL_NAME")
     MLFLOW_MODEL_ALIAS: str = _get_str("MLFLOW_MODEL_ALIAS", "production")
+    MODEL_CACHE_DIR: str = _get_str("MODEL_CACHE_DIR", "models/mlflow_cache")
+    MODEL_CACHE_MAX_VERSIONS: int = _get_int("MODEL_CACHE_MAX_VERSIONS", 3)
+    MODEL_ALIAS_POLL_SECONDS: int = _get_int("MODEL_ALIAS_POLL_SECONDS", 0)
     AZURE_TENANT_ID: Optional[str] = _get_optional_str("AZURE_TENANT_ID")
     AZURE_CLIENT_ID: Optional[str] = _get_optional_str("AZURE_CLIENT_ID")
     AZURE_CLIENT_SECRET: Optional[str] = _get_optional_str("AZURE_CLIENT_SECRET")
     JWT_SECRET_KEY: Optional[str] = _get_optional_str("JWT_SECRET_KEY")
     JWT_ALGORITHM: str = _get_str("JWT_ALGORITHM", "HS256")
     JWT_ACCESS_EXPIRE_MINUTES: int = _get_int("JWT_ACCESS_EXPIRE_MINUTES", 60)
+    AUTH_EXECUTOR: str = _get_str("AUTH_EXECUTOR", "thread")
+    AUTH_WORKERS: int = _get_int("AUTH_WORKERS", 2)
+    AUTH_MAX_PENDING: int = _get_int("AUTH_MAX_PENDING", 32)
+    AUTH_TOKEN_CACHE_SIZE: int = _get_int("AUTH_TOKEN_CACHE_SIZE", 10000)
+    AUTH_TOKEN_CACHE_TTL_SECONDS: float = _get_float("AUTH_TOKEN_CACHE_TTL_SECONDS", 30.0)
+    AUTH_REVOCATION_SYNC_SECONDS: float = _get_float("AUTH_REVOCATION_SYNC_SECONDS", 2.0)
     PORT: int = _get_int("PORT", 8080)
     BATCH_LOOKBACK_MINUTES: int = _get_int("BATCH_LOOKBACK_MINUTES", 15)
     BATCH_INTERVAL_SECONDS: int = _get_int("BATCH_INTERVAL_SECONDS", 900)
+    BATCH_PAGE_SIZE: int = _get_int("BATCH_PAGE_SIZE", 5000)
+    BATCH_SETTLE_SECONDS: int = _get_int("BATCH_SETTLE_SECONDS", 60)
+    BATCH_WORKERS: int = _get_int("BATCH_WORKERS", 1)
+    BATCH_METRICS_PATH: str = _get_str("BATCH_METRICS_PATH", "")
+    BATCH_PUSHGATEWAY_URL: str = _get_str("BATCH_PUSHGATEWAY_URL", "")
     RETRAIN_EVERY_N_BATCHES: int = _get_int("RETRAIN_EVERY_N_BATCHES", 1)
     FPR_CAP: float = _get_float("FPR_CAP", 0.0)
     RECALL_TGT: float = _get_float("RECALL_TGT", 0.0)
@@ -80,6 +94,20 @@ class Settings:
     FRAUD_SEQS_CSV: str = _get_str("FRAUD_SEQS_CSV", "")
     MLFLOW_EXPERIMENT_NAME: str = _get_str("MLFLOW_EXPERIMENT_NAME", "default")
     MLFLOW_TAGS: Optional[str] = _get_optional_str("MLFLOW_TAGS")
+    EXPLAIN_MODE: str = _get_str("EXPLAIN_MODE", "perturbation")
+    SCORE_BATCH_MAX_WAIT_MS: float = _get_float("SCORE_BATCH_MAX_WAIT_MS", 2.0)
+    SCORE_BATCH_MAX_SIZE: int = _get_int("SCORE_BATCH_MAX_SIZE", 64)
+    SCORING_EXECUTOR: str = _get_str("SCORING_EXECUTOR", "thread")
+    SCORING_WORKERS: int = _get_int("SCORING_WORKERS", 4)
+    SCORING_MAX_PENDING: int = _get_int("SCORING_MAX_PENDING", 64)
+    SCORING_MODEL_HANDLES: int = _get_int("SCORING_MODEL_HANDLES", 1)
+    UPLOAD_CHUNK_ROWS: int = _get_int("UPLOAD_CHUNK_ROWS", 50000)
+    VELOCITY_STORE_ENABLED: bool = _get_bool("VELOCITY_STORE_ENABLED", False)
+    VELOCITY_MAX_USERS: int = _get_int("VELOCITY_MAX_USERS", 200000)
+    VELOCITY_MAX_EVENTS_PER_USER: int = _get_int("VELOCITY_MAX_EVENTS_PER_USER", 5000)
+    VELOCITY_SNAPSHOT_PATH: str = _get_str("VELOCITY_SNAPSHOT_PATH", "")
+    VELOCITY_SNAPSHOT_INTERVAL_SECONDS: int = _get_int("VELOCITY_SNAPSHOT_INTERVAL_SECONDS", 300)
+    VELOCITY_WARMUP_FROM_DB: bool = _get_bool("VELOCITY_WARMUP_FROM_DB", True)
 
 
 settings = Settings()
@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+from app.batching import Histogram
+
+LOGGER = logging.getLogger(__name__)
+
+
+class ScoringOverloaded(RuntimeError):
+    """Hàng đợi của scoring executor đã đầy; API trả 503 để client thử lại sau."""
+
+
+# Chạy fn trong worker, trả kèm thời điểm bắt đầu (time.time() để so sánh được giữa các process)
+def _run_timed(fn: Callable[..., Any], *args: Any):
+    started = time.time()
+    return started, fn(*args)
+
+
+class ScoringExecutor:
+    """
+    Executor riêng cho các tác vụ CPU-bound (pandas + YDF), tách khỏi threadpool mặc định của Starlette.
+
+    - kind="thread": ThreadPoolExecutor giới hạn max_workers thread.
+    - kind="process": ProcessPoolExecutor (spawn); initializer chạy một lần mỗi worker để nạp sẵn model.
+    Số tác vụ đang chạy + đang chờ bị chặn ở max_workers + max_pending; vượt quá -> ScoringOverloaded.
+    Thời gian chờ trong hàng đợi và thời gian chạy được ghi vào histogram (stats()).
+    Pool process hỏng (worker bị OOM kill, initializer lỗi) được thay pool mới và tác vụ trả ScoringOverloaded
+    để client thử lại.
+    """
+
+    def __init__(self, kind: str = "thread", max_workers: int = 4, max_pending: int = 64,
+                 initializer: Optional[Callable[[], None]] = None, name: str = "scoring"):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown scoring executor kind: {kind}")
+        self.kind = kind
+        self.max_workers = max(1, int(max_workers))
+        self.max_pending = max(0, int(max_pending))
+        self.initializer = initializer
+        self.name = name
+        self._pool: Optional[Executor] = None
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self.rejected = 0
+        self.restarts = 0
+        self.queue_wait_hist = Histogram([0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30])
+        self.run_time_hist = Histogram([0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5])
+
+    def _create_pool(self) -> Executor:
+        if self.kind == "process":
+            return ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=self.initializer,
+            )
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+
+    def _get_pool(self) -> Executor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = self._create_pool()
+                LOGGER.info("Started %s %s executor with %s workers", self.kind, self.name, self.max_workers)
+            return self._pool
+
+    def _try_acquire(self) -> bool:
+        with self._lock:
+            if self._inflight >= self.max_workers + self.max_pending:
+                self.rejected += 1
+                return False
+            self._inflight += 1
+            return True
+
+    def _release(self) -> None:
+        with self._lock:
+            self._inflight -= 1
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        if not self._try_acquire():
+            raise ScoringOverloaded(f"{self.name.capitalize()} queue is full, retry later.")
+        submitted = time.time()
+        try:
+            pool = self._get_pool()
+            started, result = await asyncio.get_running_loop().run_in_executor(pool, _run_timed, fn, *args)
+            # histogram chỉ được ghi từ event loop nên không cần khoá
+            self.queue_wait_hist.observe(max(0.0, started - submitted))
+            self.run_time_hist.observe(max(0.0, time.time() - started))
+            return result
+        except BrokenProcessPool as exc:
+            self._replace_broken(pool)
+            raise ScoringOverloaded(f"{self.name.capitalize()} worker pool crashed and was restarted, retry later.") from exc
+        finally:
+            self._release()
+
+    def _replace_broken(self, pool: Executor) -> None:
+        """Bỏ pool hỏng (chỉ khi chưa có request nào khác thay); lần dùng tới tạo pool mới."""
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+            self.restarts += 1
+        LOGGER.error("%s %s executor pool is broken; starting a new one", self.kind, self.name)
+        pool.shutdown(wait=False)
+
+    def restart(self) -> None:
+        """Thay pool mới (vd. sau /reload để các worker process nạp lại model); tác vụ đang chạy vẫn hoàn tất."""
+        with self._lock:
+            old, self._pool = self._pool, None
+        if old is not None:
+            old.shutdown(wait=False)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            old, self._pool = self._pool, None
+        if old is not None:
+            old.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "inflight": self._inflight,
+            "rejected": self.rejected,
+            "restarts": self.restarts,
+            "queue_wait_seconds": self.queue_wait_hist.snapshot(),
+            "run_seconds": self.run_time_hist.snapshot(),
+        }
@@ -1,4 +1,4 @@
-import json, numpy as np, pandas as pd
+import json, threading, weakref, numpy as np, pandas as pd
 from typing import Dict, Any, List, Tuple
 from sklearn.metrics import precision_recall_curve, roc_auc_score, auc, confusion_matrix
 from app.scoring import fraud_scores_from_model
@@ -23,6 +23,16 @@ def fit_numeric_stats(feat_cols: List[str], medians: Dict[str,float], X_sample:
         stats[c] = (float(np.mean(s)), float(np.std(s) + 1e-9)) 
     return stats
 
+# Hàm tính (mean, std) theo từng dòng, tương đương fit_numeric_stats trên batch chỉ có một dòng
+def _row_numeric_stats(feat_cols: List[str], medians: Dict[str,float], X_sample: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    med = np.array([float(medians.get(c, 0.0)) for c in feat_cols], dtype=float)
+    raw = np.column_stack([
+        pd.to_numeric(X_sample[c], errors="coerce").to_numpy(dtype=float) if c in X_sample.columns else np.full(len(X_sample), np.nan)
+        for c in feat_cols
+    ]) if feat_cols else np.empty((len(X_sample), 0))
+    missing = np.isnan(raw)
+    return np.where(missing, med, raw), np.where(missing, 1.0, 1e-9)
+
 # Hàm giải thích một giao dịch
 def explain_one_transaction(model, row: pd.Series, baselines, num_stats, top_k: int, feat_cols: List[str], medians: Dict[str,float]): 
     row = row.drop(labels=[c for c in ["is_fraud"] if c in row.index])
@@ -46,21 +56,202 @@ def explain_one_transaction(model, row: pd.Series, baselines, num_stats, top_k:
     top = [r for r in sorted(reasons, key=lambda r: r["delta_score"], reverse=True) if r["delta_score"]>0][:top_k]
     return {"base_score": base_score, "top_reasons": top}
 
+# Số dòng tối đa của ma trận nhiễu trong một lần predict (giới hạn bộ nhớ)
+PERTURB_CHUNK_ROWS = 65536
+
+# Hàm tính delta điểm của mọi cặp (giao dịch, đặc trưng) bằng ma trận nhiễu
+def perturbation_deltas(model, X: pd.DataFrame, baseline_values: np.ndarray, chunk_rows: int = PERTURB_CHUNK_ROWS) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Dựng ma trận nhiễu (n_rows × n_features, n_features): khối thứ i gồm n_features bản sao
+    của giao dịch i, bản sao thứ j có đặc trưng j thay bằng baseline (median).
+    Ma trận được predict theo từng chunk và reshape lại thành deltas (n_rows, n_features).
+    Trả về (base_scores, deltas) với delta = base_score - score_sau_khi_thay.
+    """
+    cols = list(X.columns)
+    values = X.to_numpy(dtype=float)
+    n, f = values.shape
+    base_scores = fraud_scores_from_model(model, X)
+    deltas = np.empty((n, f), dtype=float)
+    if n == 0 or f == 0:
+        return base_scores, deltas
+
+    rows_per_chunk = max(1, chunk_rows // f)
+    for start in range(0, n, rows_per_chunk):
+        block = values[start:start + rows_per_chunk]
+        m = block.shape[0]
+        perturbed = np.repeat(block, f, axis=0)
+        pos = np.arange(m * f)
+        perturbed[pos, pos % f] = np.tile(baseline_values, m)
+        new_scores = fraud_scores_from_model(model, pd.DataFrame(perturbed, columns=cols))
+        deltas[start:start + m] = base_scores[start:start + m, None] - new_scores.reshape(m, f)
+    return base_scores, deltas
+
+# Hàm chọn top_k lý do (delta > 0) cho một giao dịch từ vector delta và zscore
+def _top_reasons(feat_cols: List[str], deltas: np.ndarray, zscores: np.ndarray, top_k: int) -> List[Dict[str, Any]]:
+    order = np.argsort(-deltas, kind="stable")
+    reasons = []
+    for j in order:
+        delta = float(deltas[j])
+        if delta <= 0:
+            break
+        reasons.append({"feature": feat_cols[j], "delta_score": delta, "direction": "↑FRAUD", "zscore": float(zscores[j])})
+    return reasons[:top_k]
+
+# Cache cấu trúc rừng đã làm phẳng theo model, tránh duyệt lại cây Python mỗi lần gọi. Key yếu: model của
+# bundle cũ bị thu hồi thì entry tự mất. Giá trị {tuple(feat_cols): forest}, dùng chung giữa các handle clone.
+_FOREST_CACHE: "weakref.WeakKeyDictionary[Any, Dict[Tuple[str, ...], Dict[str, np.ndarray]]]" = weakref.WeakKeyDictionary()
+_FOREST_CACHE_LOCK = threading.Lock()
+
+# Hàm lấy (tạo nếu chưa có) entry cache của model
+def _forest_entry(model) -> Dict[Tuple[str, ...], Dict[str, np.ndarray]]:
+    with _FOREST_CACHE_LOCK:
+        return _FOREST_CACHE.setdefault(model, {})
+
+# Hàm cho các bản clone (cùng cây với model gốc, vd. handle của ScoringService) dùng chung rừng đã làm phẳng
+def share_forest_cache(model, clones: List[Any]) -> None:
+    if not hasattr(model, "iter_trees"):
+        return
+    entry = _forest_entry(model)
+    with _FOREST_CACHE_LOCK:
+        for clone in clones:
+            _FOREST_CACHE[clone] = entry
+
+# Hàm làm phẳng toàn bộ cây của model YDF RandomForest thành các mảng NumPy
+def _flatten_forest(model, feat_cols: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Mỗi node (của mọi cây) có: feature (-1 nếu là lá), threshold, pos/neg (chỉ số node con),
+    value = P(FRAUD) tại node. Với winner_takes_all, giá trị lá là phiếu 0/1
+    để tổng đóng góp khớp đúng với điểm model trả về.
+    """
+    if not hasattr(model, "iter_trees"):
+        raise ValueError("tree_path explanations require a YDF decision forest model.")
+    entry = _forest_entry(model)
+    cached = entry.get(tuple(feat_cols))
+    if cached is not None:
+        return cached
+
+    spec_names = [c.name for c in model.data_spec().columns]
+    col_pos = {c: j for j, c in enumerate(feat_cols)}
+    fraud_idx = list(model.label_classes()).index("FRAUD")
+    wta = bool(getattr(model, "winner_takes_all", lambda: False)())
+
+    feature, threshold, pos, neg, value, roots = [], [], [], [], [], []
+
+    def node_value(node) -> float:
+        proba = np.asarray(node.value.probability, dtype=float)
+        if node.is_leaf and wta:
+            return 1.0 if int(np.argmax(proba)) == fraud_idx else 0.0
+        return float(proba[fraud_idx])
+
+    for tree in model.iter_trees():
+        roots.append(len(feature))
+        stack = [(tree.root, None, None)]
+        while stack:
+            node, parent, is_pos = stack.pop()
+            idx = len(feature)
+            if parent is not None:
+                (pos if is_pos else neg)[parent] = idx
+            value.append(node_value(node))
+            pos.append(-1); neg.append(-1)
+            if node.is_leaf:
+                feature.append(-1); threshold.append(0.0)
+                continue
+            cond = node.condition
+            if not hasattr(cond, "threshold"):
+                raise ValueError(f"Unsupported YDF condition for tree_path explanations: {type(cond).__name__}")
+            feature.append(col_pos[spec_names[cond.attribute]])
+            threshold.append(cond.threshold)
+            stack.append((node.neg_child, idx, False))
+            stack.append((node.pos_child, idx, True))
+
+    forest = {
+        "feat_cols": list(feat_cols),
+        "feature": np.asarray(feature, dtype=np.int64),
+        "threshold": np.asarray(threshold, dtype=np.float32),
+        "pos": np.asarray(pos, dtype=np.int64),
+        "neg": np.asarray(neg, dtype=np.int64),
+        "value": np.asarray(value, dtype=float),
+        "roots": np.asarray(roots, dtype=np.int64),
+    }
+    entry[tuple(feat_cols)] = forest
+    return forest
+
+# Số cặp (giao dịch, cây) tối đa được duyệt đồng thời trong tree_path_contributions (giới hạn bộ nhớ)
+TREE_PATH_CHUNK_PAIRS = 65536
+
+# Hàm tính đóng góp từng đặc trưng theo đường đi trên cây (kiểu Saabas) cho cả batch
+def tree_path_contributions(model, X: pd.DataFrame, chunk_pairs: int = TREE_PATH_CHUNK_PAIRS) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Duyệt đồng thời mọi (giao dịch, cây) của một khối dòng: tại mỗi split, đặc trưng được dùng nhận
+    value(node con) - value(node cha). Các dòng được xử lý theo khối chunk_pairs // n_trees dòng.
+    Trả về (bias, contributions (n_rows, n_features)) với bias + contributions.sum(1) = điểm P(FRAUD) của rừng.
+    """
+    feat_cols = list(X.columns)
+    forest = _flatten_forest(model, feat_cols)
+    values = X.to_numpy(dtype=np.float32)
+    n, f = values.shape
+    roots = forest["roots"]
+    n_trees = len(roots)
+    contrib = np.zeros(n * f, dtype=float)
+    bias = float(forest["value"][roots].mean()) if n_trees else 0.0
+    if n == 0 or n_trees == 0:
+        return bias, contrib.reshape(n, f)
+
+    feature, threshold = forest["feature"], forest["threshold"]
+    pos, neg, value = forest["pos"], forest["neg"], forest["value"]
+    rows_per_chunk = max(1, chunk_pairs // n_trees)
+    for start in range(0, n, rows_per_chunk):
+        block = values[start:start + rows_per_chunk]
+        m = block.shape[0]
+        rows = np.repeat(np.arange(m), n_trees)
+        node = np.tile(roots, m)
+        active = feature[node] >= 0
+        block_contrib = contrib[start * f:(start + m) * f]
+        while active.any():
+            r, cur = rows[active], node[active]
+            feat = feature[cur]
+            child = np.where(block[r, feat] >= threshold[cur], pos[cur], neg[cur])
+            block_contrib += np.bincount(r * f + feat, weights=value[child] - value[cur], minlength=m * f)
+            node[active] = child
+            active[active] = feature[child] >= 0
+    return bias, contrib.reshape(n, f) / n_trees
+
 # Hàm giải thích hàng loạt giao dịch
-def batch_explanations(model, test_ds: pd.DataFrame, key_col: str, top_k: int, feat_cols: List[str], medians: Dict[str,float]) -> pd.DataFrame:
+def batch_explanations(model, test_ds: pd.DataFrame, key_col: str, top_k: int, feat_cols: List[str], medians: Dict[str,float], mode: str = "perturbation", zscore_scope: str = "batch") -> pd.DataFrame:
+    """
+    mode="perturbation": delta khi thay từng đặc trưng bằng median (mặc định).
+    mode="tree_path": đóng góp theo đường đi trên cây YDF, một lần duyệt rừng cho cả batch.
+    zscore_scope="row": zscore của mỗi dòng tính như khi dòng đó được giải thích riêng lẻ
+    (dùng khi nhiều request đơn được gom chung một batch).
+    """
     baselines = compute_baselines(feat_cols, medians)
     num_stats = fit_numeric_stats(feat_cols, medians, X_sample=test_ds.drop(columns=[c for c in ["is_fraud"] if c in test_ds.columns], errors="ignore"))
 
     X = sanitize_for_model(test_ds.drop(columns=["is_fraud"], errors="ignore"), feat_cols, medians)
-    scores = fraud_scores_from_model(model, X)
+    if mode == "tree_path":
+        scores = fraud_scores_from_model(model, X)
+        _, deltas = tree_path_contributions(model, X)
+    elif mode == "perturbation":
+        baseline_values = np.array([float(baselines.get(c, ("num", medians.get(c, 0.0)))[1]) for c in feat_cols], dtype=float)
+        scores, deltas = perturbation_deltas(model, X, baseline_values)
+    else:
+        raise ValueError(f"Unknown explanation mode: {mode}")
 
-    rows = []
-    for i in range(len(test_ds)):
-        row = test_ds.iloc[i]
-        rid = int(test_ds.iloc[i][key_col]) if (key_col and key_col in test_ds.columns) else int(test_ds.index[i])
-        expl = explain_one_transaction(model, row, baselines, num_stats, top_k, feat_cols, medians)
-        rows.append({"id": rid, "score": float(expl["base_score"]), "reasons": expl["top_reasons"]})
-    out = pd.DataFrame(rows)
-    out["reasons_json"] = out["reasons"].apply(lambda r: json.dumps(r, ensure_ascii=False))
-    return out[["id","score","reasons_json"]].sort_values("score", ascending=False)
+    if zscore_scope == "row":
+        mu, sd = _row_numeric_stats(feat_cols, medians, test_ds)
+    else:
+        mu = np.array([num_stats.get(c, (0.0, 1.0))[0] for c in feat_cols], dtype=float)
+        sd = np.array([num_stats.get(c, (0.0, 1.0))[1] for c in feat_cols], dtype=float)
+    zscores = (X.to_numpy(dtype=float) - mu) / np.where(sd > 0, sd, 1.0)
 
+    if key_col and key_col in test_ds.columns:
+        ids = [int(v) for v in test_ds[key_col].tolist()]
+    else:
+        ids = [int(v) for v in test_ds.index]
+
+    rows = []
+    for i, rid in enumerate(ids):
+        reasons = _top_reasons(feat_cols, deltas[i], zscores[i], top_k)
+        rows.append({"id": rid, "score": float(scores[i]), "reasons_json": json.dumps(reasons, ensure_ascii=False)})
+    out = pd.DataFrame(rows, columns=["id", "score", "reasons_json"])
+    return out.sort_values("score", ascending=False)
@@ -0,0 +1,189 @@
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib.request
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+from app.batching import Histogram
+
+LOGGER = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROW_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 1024, 4096, 16384, 65536)
+
+_Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> _Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(labels: _Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    items = (*labels, *extra)
+    if not items:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in items)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(items, escaped)) + "}"
+
+
+class MetricsRegistry:
+    """
+    Registry metric tối giản theo định dạng text của Prometheus (counter / gauge / histogram có label),
+    dùng lại Histogram của app.batching. Thread-safe; số liệu là theo process: worker process (scoring
+    executor kind="process", shard của batch job) trả drain() về để process cha merge().
+    """
+
+    def __init__(self, namespace: str = "fraud"):
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._meta: Dict[str, Tuple[str, str, Sequence[float]]] = {}
+        self._counters: Dict[Tuple[str, _Labels], float] = {}
+        self._gauges: Dict[Tuple[str, _Labels], float] = {}
+        self._hists: Dict[Tuple[str, _Labels], Histogram] = {}
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        self._meta[name] = (kind, help_text, tuple(buckets))
+
+    def inc(self, name: str, amount: float = 1.0, **labels) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0.0) + amount
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._gauges[(name, _labels(labels))] = float(value)
+
+    def clear_gauge(self, name: str) -> None:
+        with self._lock:
+            for key in [k for k in self._gauges if k[0] == name]:
+                del self._gauges[key]
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, _labels(labels))
+        with self._lock:
+            hist = self._hists.get(key)
+            if hist is None:
+                hist = self._hists[key] = Histogram(self._meta.get(name, ("", "", LATENCY_BUCKETS))[2])
+            hist.observe(value)
+
+    @contextmanager
+    def time(self, stage: str, **labels) -> Iterator[None]:
+        """Đo thời gian một stage của pipeline vào histogram stage_seconds{stage=...}."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - t0, stage=stage, **labels)
+
+    def count_decisions(self, decisions, model_version, source: str) -> None:
+        counts: Dict[str, int] = {}
+        for d in decisions:
+            counts[d] = counts.get(d, 0) + 1
+        for decision, n in counts.items():
+            self.inc("decisions_total", n, decision=decision, model_version=model_version, source=source)
+
+    # Lấy toàn bộ số liệu rồi reset (worker process gửi về process cha để merge)
+    def drain(self) -> dict:
+        with self._lock:
+            state = {
+                "counters": dict(self._counters),
+                "hists": {k: (list(h.counts), h.count, h.sum) for k, h in self._hists.items()},
+            }
+            self._counters.clear()
+            self._hists.clear()
+        return state
+
+    def merge(self, state: dict) -> None:
+        with self._lock:
+            for key, value in state["counters"].items():
+                self._counters[key] = self._counters.get(key, 0.0) + value
+            for key, (counts, count, total) in state["hists"].items():
+                hist = self._hists.get(key)
+                if hist is None:
+                    hist = self._hists[key] = Histogram(self._meta.get(key[0], ("", "", LATENCY_BUCKETS))[2])
+                hist.counts = [a + b for a, b in zip(hist.counts, counts)]
+                hist.count += count
+                hist.sum += total
+
+    def render(self) -> str:
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            hists = sorted((k, h.snapshot()) for k, h in self._hists.items())
+        lines, seen = [], set()
+
+        def header(name: str, kind: str) -> str:
+            full = f"{self.namespace}_{name}"
+            if full not in seen:
+                seen.add(full)
+                help_text = self._meta.get(name, ("", name, ()))[1] or name
+                lines.append(f"# HELP {full} {help_text}")
+                lines.append(f"# TYPE {full} {kind}")
+            return full
+
+        for (name, labels), value in counters:
+            lines.append(f"{header(name, 'counter')}{_fmt_labels(labels)} {float(value)!r}")
+        for (name, labels), value in gauges:
+            lines.append(f"{header(name, 'gauge')}{_fmt_labels(labels)} {float(value)!r}")
+        for (name, labels), snap in hists:
+            full = header(name, "histogram")
+            for bound, cumulative in snap["buckets"].items():
+                lines.append(f"{full}_bucket{_fmt_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{full}_sum{_fmt_labels(labels)} {float(snap['sum'])!r}")
+            lines.append(f"{full}_count{_fmt_labels(labels)} {snap['count']}")
+        return "\n".join(lines) + "\n"
+
+    # Ghi file text (node_exporter textfile collector) nguyên tử
+    def write_textfile(self, path: str) -> None:
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".metrics.")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(self.render())
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    # Đẩy lên Pushgateway (PUT /metrics/job/<job>: thay toàn bộ nhóm metric của job)
+    def push(self, gateway_url: str, job: str, timeout: float = 5.0) -> None:
+        req = urllib.request.Request(
+            f"{gateway_url.rstrip('/')}/metrics/job/{job}",
+            data=self.render().encode("utf-8"),
+            method="PUT",
+            headers={"Content-Type": "text/plain; version=0.0.4"},
+        )
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            resp.read()
+
+
+METRICS = MetricsRegistry()
+METRICS.describe("stage_seconds", "histogram", "Latency of each scoring pipeline stage in seconds")
+METRICS.describe("batch_rows", "histogram", "Rows per scored batch", ROW_BUCKETS)
+METRICS.describe("decisions_total", "counter", "Scoring decisions by outcome and model version")
+METRICS.describe("http_request_seconds", "histogram", "HTTP request latency in seconds")
+METRICS.describe("model_info", "gauge", "Model currently used for scoring (value is always 1)")
+METRICS.describe("batch_cycle_seconds", "gauge", "Duration of the last batch job cycle")
+METRICS.describe("batch_last_success_timestamp_seconds", "gauge", "Unix time of the last successful batch cycle")
+METRICS.describe("batch_transactions_total", "counter", "Transactions scored by the batch job")
+METRICS.describe("executor_inflight", "gauge", "Jobs running or queued on an executor")
+METRICS.describe("executor_rejected", "gauge", "Jobs rejected by a full executor queue since start")
+
+
+# Ghi / đẩy metric của một chu kỳ batch theo cấu hình (lỗi chỉ log, không làm hỏng batch)
+def export_batch_metrics(textfile_path: Optional[str], pushgateway_url: Optional[str], job: str) -> None:
+    if textfile_path:
+        try:
+            METRICS.write_textfile(textfile_path)
+        except Exception as exc:
+            LOGGER.warning("Writing batch metrics to %s failed: %s", textfile_path, exc)
+    if pushgateway_url:
+        try:
+            METRICS.push(pushgateway_url, job)
+        except Exception as exc:
+            LOGGER.warning("Pushing batch metrics to %s failed: %s", pushgateway_url, exc)
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+MANIFEST_NAME = "cache_manifest.json"
+ALIAS_INDEX_NAME = "aliases.json"
+
+
+# Hàm tính sha256 của một file (đọc theo block để không nạp cả model vào RAM)
+def file_sha256(path: Path, block_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Hàm ghi JSON nguyên tử (file tạm + os.replace) để process khác không đọc phải file dở dang
+def _write_json_atomic(path: Path, payload: dict) -> None:
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ModelCache:
+    """
+    Cache model MLflow trên đĩa local, khoá theo (model name, version, run_id).
+    Mỗi entry là một thư mục <root>/<name>/v<version>-<run_id>/ kèm cache_manifest.json (sha256 từng file);
+    lookup() kiểm tra checksum trước khi trả về, entry hỏng bị xoá. Giữ tối đa max_versions entry mỗi model (LRU).
+    """
+
+    def __init__(self, root: str, max_versions: int = 3):
+        self.root = Path(root)
+        self.max_versions = max(1, int(max_versions))
+
+    def _model_dir(self, name: str) -> Path:
+        return self.root / re.sub(r"[^A-Za-z0-9._-]+", "_", name)
+
+    def entry_dir(self, name: str, version, run_id: str) -> Path:
+        return self._model_dir(name) / f"v{version}-{run_id}"
+
+    def lookup(self, name: str, version, run_id: str) -> Optional[Path]:
+        entry = self.entry_dir(name, version, run_id)
+        manifest_path = entry / MANIFEST_NAME
+        if not manifest_path.is_file():
+            return None
+        try:
+            manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+            for rel, digest in manifest["files"].items():
+                if file_sha256(entry / rel) != digest:
+                    raise ValueError(f"checksum mismatch for {rel}")
+        except Exception as exc:
+            LOGGER.warning("Model cache entry %s is corrupt (%s); discarding it", entry, exc)
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+        os.utime(manifest_path)  # đánh dấu lần dùng gần nhất cho LRU
+        return entry
+
+    def store(self, name: str, version, run_id: str, populate: Callable[[Path], None]) -> Path:
+        """Gọi populate(tmp_dir) để tải artifact vào thư mục tạm, ghi manifest rồi đổi tên nguyên tử thành entry."""
+        model_dir = self._model_dir(name)
+        model_dir.mkdir(parents=True, exist_ok=True)
+        entry = self.entry_dir(name, version, run_id)
+        tmp = Path(tempfile.mkdtemp(dir=model_dir, prefix=f".{entry.name}."))
+        try:
+            populate(tmp)
+            files = {
+                p.relative_to(tmp).as_posix(): file_sha256(p)
+                for p in sorted(tmp.rglob("*")) if p.is_file()
+            }
+            _write_json_atomic(tmp / MANIFEST_NAME, {
+                "name": name, "version": str(version), "run_id": run_id,
+                "created_at": time.time(), "files": files,
+            })
+            shutil.rmtree(entry, ignore_errors=True)
+            try:
+                os.replace(tmp, entry)
+            except OSError:
+                # process khác vừa ghi xong cùng entry: dùng bản của nó
+                if not (entry / MANIFEST_NAME).is_file():
+                    raise
+                shutil.rmtree(tmp, ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        self.evict(name, keep=entry)
+        return entry
+
+    def evict(self, name: str, keep: Optional[Path] = None) -> None:
+        model_dir = self._model_dir(name)
+        if not model_dir.is_dir():
+            return
+        entries = [p for p in model_dir.iterdir() if p.is_dir() and (p / MANIFEST_NAME).is_file()]
+        entries.sort(key=lambda p: (p == keep, (p / MANIFEST_NAME).stat().st_mtime), reverse=True)
+        for old in entries[self.max_versions:]:
+            LOGGER.info("Evicting cached model %s", old)
+            shutil.rmtree(old, ignore_errors=True)
+
+    def remember_alias(self, name: str, alias: str, version, run_id: str) -> None:
+        path = self._model_dir(name) / ALIAS_INDEX_NAME
+        path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            index: Dict[str, dict] = json.loads(path.read_text(encoding="utf-8")) if path.is_file() else {}
+        except ValueError:
+            index = {}
+        index[alias] = {"version": str(version), "run_id": run_id}
+        _write_json_atomic(path, index)
+
+    def resolve_alias(self, name: str, alias: str) -> Optional[Tuple[str, str]]:
+        """(version, run_id) mà alias trỏ tới ở lần resolve thành công gần nhất — dùng khi registry không truy cập được."""
+        path = self._model_dir(name) / ALIAS_INDEX_NAME
+        try:
+            hit = json.loads(path.read_text(encoding="utf-8")).get(alias)
+        except (OSError, ValueError):
+            return None
+        return (hit["version"], hit["run_id"]) if hit else None
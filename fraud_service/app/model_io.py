@@ -1,9 +1,13 @@
+import json
 import logging
+import shutil
+import time
 import yaml, pandas as pd, os, tempfile
 import mlflow
 from mlflow.tracking import MlflowClient
 from mlflow.store.artifact.azure_blob_artifact_repo import AzureBlobArtifactRepository
 from app.config import settings
+from app.model_cache import ModelCache
 
 LOGGER = logging.getLogger(__name__)
 
@@ -11,6 +15,46 @@ LOGGER = logging.getLogger(__name__)
 def load_thresholds():
     return load_thresholds_from_file(os.path.join(settings.ARTIFACTS_DIR_USE, "thresholds.yaml"))
 
+# Tải thresholds.yaml của run vào dst_dir (fallback Azure Blob khi client không tải được)
+def _download_thresholds(client, run, dst_dir: str) -> str:
+    try:
+        return client.download_artifacts(run.info.run_id, "artifacts/thresholds.yaml", dst_dir)
+    except mlflow.exceptions.MlflowException:
+        repo = AzureBlobArtifactRepository(run.info.artifact_uri)
+        return repo.download_artifacts("artifacts/thresholds.yaml", dst_dir)
+
+# Cache model local (None nếu MODEL_CACHE_DIR để trống)
+def _model_cache():
+    if not settings.MODEL_CACHE_DIR:
+        return None
+    return ModelCache(settings.MODEL_CACHE_DIR, settings.MODEL_CACHE_MAX_VERSIONS)
+
+# Resolve alias -> (version, run_id); registry lỗi thì dùng alias đã ghi nhớ trong cache (nếu có)
+def _resolve_model_version(client, cache, alias: str):
+    try:
+        mv = client.get_model_version_by_alias(settings.MLFLOW_MODEL_NAME, alias)
+    except Exception as exc:
+        hit = cache.resolve_alias(settings.MLFLOW_MODEL_NAME, alias) if cache else None
+        if hit is None:
+            raise
+        LOGGER.warning("Registry unavailable (%s); using cached %s@%s -> version %s", exc,
+                       settings.MLFLOW_MODEL_NAME, alias, hit[0])
+        return hit
+    if cache:
+        cache.remember_alias(settings.MLFLOW_MODEL_NAME, alias, mv.version, mv.run_id)
+    return str(mv.version), mv.run_id
+
+# Tải model + thresholds + metrics của một version vào cache (cache miss)
+def _populate_cache_entry(client, version: str, run_id: str):
+    def populate(dst):
+        run = client.get_run(run_id)
+        mlflow.artifacts.download_artifacts(
+            artifact_uri=f"models:/{settings.MLFLOW_MODEL_NAME}/{version}", dst_path=str(dst / "model"))
+        with tempfile.TemporaryDirectory() as tmp:
+            shutil.copyfile(_download_thresholds(client, run, tmp), dst / "thresholds.yaml")
+        (dst / "metrics.json").write_text(json.dumps(dict(run.data.metrics)), encoding="utf-8")
+    return populate
+
 # Load model and artifacts from MLflow Registry
 def _load_from_mlflow():
     mlflow.set_tracking_uri(settings.MLFLOW_TRACKING_URI)
@@ -18,28 +62,39 @@ def _load_from_mlflow():
     model_uri = f"models:/{settings.MLFLOW_MODEL_NAME}@{alias}"
     LOGGER.info("Loading model URI: %s", model_uri)
 
-    pyfunc_model = mlflow.pyfunc.load_model(model_uri)
+    client = MlflowClient()
+    cache = _model_cache()
+    t0 = time.perf_counter()
+    if cache is not None:
+        version, run_id = _resolve_model_version(client, cache, alias)
+        entry = cache.lookup(settings.MLFLOW_MODEL_NAME, version, run_id)
+        cache_state = "hit" if entry is not None else "miss"
+        if entry is None:
+            entry = cache.store(settings.MLFLOW_MODEL_NAME, version, run_id,
+                                _populate_cache_entry(client, version, run_id))
+        # ydf_model + artifacts/ nằm trong thư mục model đã cache: không cần mạng
+        pyfunc_model = mlflow.pyfunc.load_model(str(entry / "model"))
+        thresholds = load_thresholds_from_file(str(entry / "thresholds.yaml"))
+        metrics = json.loads((entry / "metrics.json").read_text(encoding="utf-8"))
+        LOGGER.info("Model cache %s for %s v%s (run %s): loaded from %s in %.2fs",
+                    cache_state, settings.MLFLOW_MODEL_NAME, version, run_id, entry, time.perf_counter() - t0)
+    else:
+        pyfunc_model = mlflow.pyfunc.load_model(model_uri)
+        mv = client.get_model_version_by_alias(settings.MLFLOW_MODEL_NAME, alias)
+        version, run_id = str(mv.version), mv.run_id
+        run = client.get_run(run_id)
+        with tempfile.TemporaryDirectory() as tmp:
+            thresholds = load_thresholds_from_file(_download_thresholds(client, run, tmp))
+        metrics = run.data.metrics
+        LOGGER.info("Model cache disabled: downloaded %s in %.2fs", model_uri, time.perf_counter() - t0)
     if not pyfunc_model:
         raise RuntimeError(f"Failed to load model from URI: {model_uri}")
     LOGGER.info("Loaded pyfunc model successfully from MLflow.")
+    LOGGER.info("Loaded model version: %s, run_id: %s", version, run_id)
 
-    client = MlflowClient()
-    mv = client.get_model_version_by_alias(settings.MLFLOW_MODEL_NAME, alias)
-    LOGGER.info("Loaded model version: %s, run_id: %s", mv.version, mv.run_id)
-    run = client.get_run(mv.run_id)
-   
-    # Tải thresholdsl
-    with tempfile.TemporaryDirectory() as tmp:
-        try:
-            th_path = client.download_artifacts(mv.run_id, "artifacts/thresholds.yaml", tmp)
-        except mlflow.exceptions.MlflowException:
-            repo = mlflow.store.artifact.azure_blob_artifact_repo.AzureBlobArtifactRepository(run.info.artifact_uri)
-            th_path = repo.download_artifacts("artifacts/thresholds.yaml", tmp)
-        thresholds = load_thresholds_from_file(th_path)
-
-    thresholds.setdefault("registry_version", mv.version)
-    thresholds.setdefault("run_id", mv.run_id)
-    thresholds["model_version_registry"] = str(mv.version)
+    thresholds.setdefault("registry_version", version)
+    thresholds.setdefault("run_id", run_id)
+    thresholds["model_version_registry"] = str(version)
 
     # Trích xuất đối tượng PythonModel (FraudYDFPythonModel)
     py_model = getattr(pyfunc_model, "_model_impl", None)
@@ -69,7 +124,7 @@ def _load_from_mlflow():
     train_like = pd.DataFrame({c: [medians.get(c, 0.0)] for c in feat_cols})
 
     schema_pack = (feat_cols, medians, clipping_bounds, train_like)
-    return model, encoders, schema_pack, thresholds, run.data.metrics
+    return model, encoders, schema_pack, thresholds, metrics
 
    
 # Load thresholds from a YAML file
@@ -77,6 +132,14 @@ def load_thresholds_from_file(path: str):
     with open(path, "r") as f:
         return yaml.safe_load(f)
 
+# Version hiện tại mà alias trỏ tới trên registry (một lời gọi metadata, không tải artifact)
+def resolve_registry_version():
+    if not (settings.MLFLOW_MODEL_NAME and settings.MLFLOW_TRACKING_URI):
+        return None
+    mlflow.set_tracking_uri(settings.MLFLOW_TRACKING_URI)
+    alias = settings.MLFLOW_MODEL_ALIAS or "Production"
+    return str(MlflowClient().get_model_version_by_alias(settings.MLFLOW_MODEL_NAME, alias).version)
+
 # Load model and artifacts (either from MLflow)
 def load_model_and_artifacts():
     LOGGER.info("load_model_and_artifacts() called")
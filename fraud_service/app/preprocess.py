@@ -1,6 +1,95 @@
 import numpy as np, pandas as pd
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, Optional, Sequence
+import re
 import unicodedata
+from datetime import datetime
+from functools import lru_cache
+from collections import OrderedDict
+import threading
+import weakref
+
+from app.metrics import METRICS
+
+# Các cột dùng chung giữa df_align và CompiledPreprocessor
+TEXT_COLS = ["stay_qualify", 'user_name', 'sender_name']
+DATE_COLS = ['create_dt', 'register_date', 'first_transaction_date', 'birth_date', 'visa_expire_date', 'recheck_date', 'face_pin_date']
+SAFE_VISAS = ['특정활동(E-7)', '결혼이민(F-6)', '재외동포(F-4)']
+PII_COLS = ["user_name","sender_name","recipient_name","autodebit_account","invite_code","user_seq"]
+
+# Các cột ngày ít giá trị khác nhau: kết quả parse được cache theo chuỗi gốc
+CACHED_DATE_COLS = {"birth_date", "register_date", "visa_expire_date"}
+_DATE_SENTINELS = ["9999-01-01", "9999-12-31"]
+# Các định dạng thực tế có trong dữ liệu (sau khi thay '/' bằng '-'), thử lần lượt trước khi rơi về format='mixed'
+_DATE_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%Y-%m-%d %H:%M:%S.%f"]
+
+class _DateCache:
+    """LRU cache có giới hạn: chuỗi ngày (đã thay '/' bằng '-') -> datetime64[ns] (NaT nếu không hợp lệ)."""
+
+    def __init__(self, maxsize: int = 65536):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[str, np.datetime64]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys) -> Tuple[np.ndarray, np.ndarray]:
+        values = np.full(len(keys), np.datetime64("NaT"), dtype="datetime64[ns]")
+        hit = np.zeros(len(keys), dtype=bool)
+        with self._lock:
+            for i, k in enumerate(keys):
+                v = self._data.get(k)
+                if v is not None:
+                    self._data.move_to_end(k)
+                    values[i], hit[i] = v, True
+        return values, hit
+
+    def put_many(self, keys, values) -> None:
+        with self._lock:
+            for k, v in zip(keys, values):
+                self._data[k] = v
+                self._data.move_to_end(k)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+_DATE_CACHE = _DateCache()
+
+# Hàm parse các chuỗi ngày khác nhau: mỗi nhóm định dạng parse vectorized với format cố định (exact),
+# chuỗi không khớp định dạng nào (hoặc không hợp lệ, vd. tháng 13) mới qua format='mixed' như trước
+def _parse_unique_dates(texts: pd.Series) -> Optional[np.ndarray]:
+    out = np.full(len(texts), np.datetime64("NaT"), dtype="datetime64[ns]")
+    pending = ~texts.isin(_DATE_SENTINELS).to_numpy()
+    for fmt in _DATE_FORMATS:
+        idx = np.flatnonzero(pending)
+        if not idx.size:
+            break
+        parsed = pd.to_datetime(texts.iloc[idx], format=fmt, errors="coerce").to_numpy(dtype="datetime64[ns]")
+        ok = ~np.isnat(parsed)
+        out[idx[ok]] = parsed[ok]
+        pending[idx[ok]] = False
+    if pending.any():
+        parsed = pd.to_datetime(texts[pending], format='mixed', dayfirst=False, errors='coerce')
+        if not pd.api.types.is_datetime64_ns_dtype(parsed) or getattr(parsed.dt, "tz", None) is not None:
+            return None  # có timezone / kiểu lạ: trả về None để parse cả cột theo đường cũ
+        out[pending] = parsed.to_numpy(dtype="datetime64[ns]")
+    return out
+
+# Hàm parse một cột ngày theo đúng quy tắc df_align: '/' -> '-', 9999-* -> NaT, còn lại như format='mixed'.
+# Chỉ parse các giá trị khác nhau rồi map ngược lại; cache (nếu có) giữ kết quả giữa các lần gọi.
+def parse_date_series(values: pd.Series, cache: Optional[_DateCache] = None) -> pd.Series:
+    codes, uniques = pd.factorize(values.astype(str))
+    texts = pd.Series(np.asarray(uniques, dtype=object)).str.replace('/', '-', regex=False)
+    if cache is not None:
+        parsed, hit = cache.get_many(texts.tolist())
+    else:
+        parsed, hit = np.full(len(texts), np.datetime64("NaT"), dtype="datetime64[ns]"), np.zeros(len(texts), dtype=bool)
+    miss = np.flatnonzero(~hit)
+    if miss.size:
+        fresh = _parse_unique_dates(texts.iloc[miss].reset_index(drop=True))
+        if fresh is None:
+            text = values.astype(str).str.replace('/', '-', regex=False).replace(_DATE_SENTINELS, pd.NaT)
+            return pd.to_datetime(text, format='mixed', dayfirst=False, errors='coerce')
+        parsed[miss] = fresh
+        if cache is not None:
+            cache.put_many(texts.iloc[miss].tolist(), fresh)
+    return pd.Series(parsed[codes], index=values.index, name=values.name)
 
 # Hàm chuyển đổi cột ngày tháng và tạo các đặc trưng thời gian
 def df_to_date(df, col, compute_time_features=False):
@@ -9,11 +98,7 @@ def df_to_date(df, col, compute_time_features=False):
 
     # Kiểm tra: Nếu chưa phải datetime thì mới convert
     if not pd.api.types.is_datetime64_any_dtype(df[col]):
-        # Clean dữ liệu rác trước
-        s = df[col].astype(str).str.replace('/', '-', regex=False)
-        s = s.replace(["9999-01-01", "9999-12-31", "nan", "None", ""], pd.NaT)
-        # Thêm format='mixed' để tắt Warning
-        df[col] = pd.to_datetime(s, format='mixed', dayfirst=False, errors='coerce', utc=False)
+        df[col] = parse_date_series(df[col], cache=_DATE_CACHE if col in CACHED_DATE_COLS else None)
 
     df[f"{col}_year"] = df[col].dt.year
     df[f"{col}_month"] = df[col].dt.month
@@ -39,8 +124,7 @@ def df_align(df: pd.DataFrame) -> pd.DataFrame:
     df = df.copy()
 
     # Giúp model nhận diện 'ＨＯ ＰＨＩ' chính là 'HO PHI'
-    text_cols = ["stay_qualify", 'user_name', 'sender_name']
-    for col in text_cols:
+    for col in TEXT_COLS:
         if col in df.columns:
             df[col] = df[col].apply(normalize_text)
 
@@ -58,19 +142,10 @@ def df_align(df: pd.DataFrame) -> pd.DataFrame:
 
     # XỬ LÝ NGÀY THÁNG (FIX LỖI WARNING & SAI FORMAT)
     # Thay thế tất cả dấu '/' bằng '-' để thống nhất định dạng trước khi parse
-    date_cols = ['create_dt', 'register_date', 'first_transaction_date', 'birth_date', 'visa_expire_date', 'recheck_date', 'face_pin_date']
-    
-    for col in date_cols:
+    for col in DATE_COLS:
         if col in df.columns:
-            # Ép kiểu string, thay thế /, sau đó mới to_datetime
-            df[col] = df[col].astype(str).str.replace('/', '-', regex=False)
-            df[col] = df[col].replace(["9999-01-01","9999-12-31"], pd.NaT)
-            # df[col] = pd.to_datetime(df[col], errors='coerce', utc=False)
-            df[col] = pd.to_datetime(df[col], format='mixed', dayfirst=False, errors='coerce')
-    
-    if 'create_dt' in df.columns and df['create_dt'].dtype == 'object':
-        df['create_dt'] = pd.to_datetime(df['create_dt'], format='mixed', dayfirst=False, errors='coerce')
-            
+            df[col] = parse_date_series(df[col], cache=_DATE_CACHE if col in CACHED_DATE_COLS else None)
+
     create_dt = df['create_dt']
     register_date = df['register_date']
     first_transaction_date = df['first_transaction_date']
@@ -106,10 +181,9 @@ def df_align(df: pd.DataFrame) -> pd.DataFrame:
     df['is_near_limit'] = (txn_24h >= 9_500_000).astype(int)
 
     # Visa xịn nhưng hành vi đáng ngờ
-    safe_visas = ['특정활동(E-7)', '결혼이민(F-6)', '재외동포(F-4)']
     visa_check = df['stay_qualify'].fillna("Unknown")
     df['is_safe_visa_but_high_amt'] = (
-        visa_check.isin(safe_visas) & (amt >= 5_000_000)
+        visa_check.isin(SAFE_VISAS) & (amt >= 5_000_000)
     ).astype(int)
 
     # Trap 5: VISA HẾT HẠN (Khắc tinh của User #2862) ---
@@ -134,10 +208,48 @@ def df_align(df: pd.DataFrame) -> pd.DataFrame:
         if c in df.columns: df = df_to_date(df, c)
 
     # drop PII
-    pii = ["user_name","sender_name","recipient_name","autodebit_account","invite_code","user_seq"]
-    df.drop(columns=[c for c in pii if c in df.columns], inplace=True, errors="ignore")
+    df.drop(columns=[c for c in PII_COLS if c in df.columns], inplace=True, errors="ignore")
     return df
 
+class OrdinalLookup:
+    """
+    Bảng tra cứu "biên dịch" một lần từ encoders["ordinal"] (OrdinalEncoder đã fit, handle_unknown="use_encoded_value").
+    encode() map giá trị thô -> mã giống hệt enc.transform: batch nhỏ tra dict, batch lớn dùng pd.Categorical;
+    giá trị lạ -> unknown_value (-1).
+    """
+
+    SMALL_BATCH = 256
+
+    def __init__(self, meta: dict):
+        enc = meta["enc"]
+        self.cols = list(meta["cols"])
+        self.unknown_value = float(enc.unknown_value)
+        self.categories = {c: pd.Index(np.asarray(cats, dtype=object)) for c, cats in zip(self.cols, enc.categories_)}
+        self.tables = {c: {v: float(i) for i, v in enumerate(cats)} for c, cats in self.categories.items()}
+
+    def encode(self, col: str, values: np.ndarray) -> np.ndarray:
+        if len(values) <= self.SMALL_BATCH:
+            table, unknown = self.tables[col], self.unknown_value
+            return np.array([table.get(v, unknown) for v in values], dtype=float)
+        codes = pd.Categorical(values, categories=self.categories[col]).codes.astype(float)
+        codes[codes < 0] = self.unknown_value
+        return codes
+
+_ORDINAL_LOOKUPS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+# Hàm lấy (hoặc dựng lần đầu) OrdinalLookup cho encoders; None nếu encoder không hỗ trợ tra cứu trực tiếp
+def compile_ordinal_lookup(encoders) -> Optional[OrdinalLookup]:
+    meta = (encoders or {}).get("ordinal")
+    if not meta:
+        return None
+    enc = meta["enc"]
+    if getattr(enc, "handle_unknown", None) != "use_encoded_value" or not hasattr(enc, "categories_"):
+        return None
+    lookup = _ORDINAL_LOOKUPS.get(enc)
+    if lookup is None or lookup.cols != list(meta["cols"]):
+        lookup = _ORDINAL_LOOKUPS[enc] = OrdinalLookup(meta)
+    return lookup
+
 # Hàm mã hoá các đặc trưng phân loại bằng Ordinal Encoding
 def encode_categoricals(df: pd.DataFrame, cat_cols: List[str], encoders=None):
     df = df.copy()
@@ -152,7 +264,12 @@ def encode_categoricals(df: pd.DataFrame, cat_cols: List[str], encoders=None):
         missing = [c for c in cols if c not in df.columns]
         for c in missing: df[c] = "Unknown"
         df = df.reindex(columns=[*(x for x in df.columns if x not in cols), *cols])
-        df[cols] = enc.transform(df[cols])
+        lookup = compile_ordinal_lookup(encoders)
+        if lookup is None:
+            df[cols] = enc.transform(df[cols])
+        else:
+            for c in cols:
+                df[c] = lookup.encode(c, df[c].to_numpy(dtype=object))
         return df, encoders
     else:
         from sklearn.preprocessing import OrdinalEncoder
@@ -162,13 +279,13 @@ def encode_categoricals(df: pd.DataFrame, cat_cols: List[str], encoders=None):
 
 # Hàm chuẩn hoá dataframe cho việc dự đoán với model đã train: đảm bảo đúng cột, mã hoá, điền thiếu
 def sanitize_for_model(df_like: pd.DataFrame, feat_cols: List[str], medians: Dict[str, float]):
-    X = df_like.copy()
-    for c in feat_cols:
-        if c not in X.columns: X[c] = np.nan # thêm cột thiếu
-    X = X[feat_cols]
-    for c in feat_cols: 
-        X[c] = pd.to_numeric(X[c], errors="coerce") # ép kiểu số
-        X[c] = X[c].fillna(medians.get(c, 0.0)) # điền thiếu bằng median
+    X = df_like.reindex(columns=feat_cols) # thêm cột thiếu (NaN) + đúng thứ tự feat_cols
+    non_numeric = [c for c in feat_cols if not pd.api.types.is_numeric_dtype(X[c])]
+    if non_numeric:
+        X[non_numeric] = X[non_numeric].apply(pd.to_numeric, errors="coerce") # ép kiểu số (cột đã là số giữ nguyên)
+    has_na = X.columns[X.isna().any().to_numpy()] # chỉ fillna các cột thực sự có giá trị thiếu
+    if len(has_na):
+        X[has_na] = X[has_na].fillna({c: medians.get(c, 0.0) for c in has_na}) # điền thiếu bằng median
     return X
 
 def data_imputation_and_clipping(
@@ -203,12 +320,15 @@ def prepare_features_for_inference(
     """FE + encode + align + fillna theo đúng schema đã train"""
     
     # Imputation và Clipping (Sử dụng hàm đã đóng gói)
-    df_processed = data_imputation_and_clipping(df_raw, clipping_bounds)
+    with METRICS.time("data_imputation_and_clipping"):
+        df_processed = data_imputation_and_clipping(df_raw, clipping_bounds)
 
     # Alignment và Encoding
-    df = df_align(df_processed)
+    with METRICS.time("df_align"):
+        df = df_align(df_processed)
     cat_cols = [c for c in maybe_cats if c in df.columns]
-    df_enc, _ = encode_categoricals(df, cat_cols, encoders=encoders)
+    with METRICS.time("encode_categoricals"):
+        df_enc, _ = encode_categoricals(df, cat_cols, encoders=encoders)
 
     # Final Alignment (Thêm cột thiếu và sắp xếp)
     for c in feat_cols:
@@ -221,3 +341,148 @@ def prepare_features_for_inference(
         df_enc[c] = pd.to_numeric(df_enc[c], errors="coerce").fillna(medians.get(c, 0.0))
 
     return df_enc
+
+
+# Định dạng ISO (sau khi thay '/' bằng '-') được parse trực tiếp, không qua dateutil
+_ISO_DATE_RE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})(?:[ T](\d{2}):(\d{2}):(\d{2})(?:\.(\d{1,6}))?)?$")
+_MISSING_DATE_TEXT = {"9999-01-01", "9999-12-31", "Unknown", "nan", "None", "NaT", ""}
+
+# Hàm parse một chuỗi ngày theo đúng quy tắc của df_align (có cache theo chuỗi gốc)
+@lru_cache(maxsize=65536)
+def _parse_date_text(text: str) -> Optional[datetime]:
+    text = text.replace('/', '-')
+    if text in _MISSING_DATE_TEXT:
+        return None
+    m = _ISO_DATE_RE.match(text)
+    # Năm ngoài khoảng datetime64[ns] để pandas quyết định (NaT)
+    if m and 1678 <= int(m.group(1)) <= 2261:
+        y, mo, d, hh, mi, ss, frac = m.groups()
+        try:
+            return datetime(int(y), int(mo), int(d), int(hh or 0), int(mi or 0), int(ss or 0), int((frac or "0").ljust(6, "0")))
+        except ValueError:
+            pass
+    ts = pd.to_datetime(pd.Series([text]), format='mixed', dayfirst=False, errors='coerce').iloc[0]
+    return None if pd.isna(ts) else ts.to_pydatetime()
+
+def _is_missing(v) -> bool:
+    return v is None or v is pd.NaT or (isinstance(v, float) and v != v)
+
+def _to_float(v) -> float:
+    if _is_missing(v):
+        return np.nan
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return np.nan
+
+def _days_between(a: List[Optional[datetime]], b: List[Optional[datetime]]) -> np.ndarray:
+    return np.array([(x - y).days if x is not None and y is not None else np.nan for x, y in zip(a, b)], dtype=float)
+
+class CompiledPreprocessor:
+    """
+    Bản "biên dịch" của prepare_features_for_inference, dựng một lần từ feat_cols, encoders,
+    medians và clipping_bounds. transform() nhận list dict giao dịch thô (ví dụ Tx.dict())
+    và trả về ma trận float32 theo thứ tự feat_cols, không tạo DataFrame trung gian.
+    """
+
+    def __init__(self, feat_cols: List[str], encoders: dict, medians: Dict[str, float],
+                 clipping_bounds: Dict[str, Tuple[float, float]] = None):
+        lookup = compile_ordinal_lookup(encoders)
+        if lookup is None:
+            raise ValueError("CompiledPreprocessor requires fitted encoders['ordinal'] with handle_unknown='use_encoded_value'.")
+        self.feat_cols = list(feat_cols)
+        self.medians = np.array([float(medians.get(c, 0.0)) for c in self.feat_cols], dtype=float)
+        self.clipping_bounds = {c: (float(lo), float(hi)) for c, (lo, hi) in (clipping_bounds or {}).items()}
+        # OrdinalEncoder -> dict {giá trị: mã}; giá trị lạ -> unknown_value (-1)
+        self.cat_lookup = lookup.tables
+        self.unknown_value = lookup.unknown_value
+        self._dropped = set(DATE_COLS) | set(PII_COLS)
+
+    def transform(self, records: Sequence[Dict[str, Any]], out: Optional[np.ndarray] = None) -> np.ndarray:
+        """out: buffer float32 (len(records), len(feat_cols)) để ghi kết quả vào (ví dụ buffer theo thread)."""
+        n = len(records)
+        present = set().union(*(r.keys() for r in records)) if n else set()
+
+        def column(name):
+            return [r.get(name) for r in records]
+
+        def numeric(name):
+            if name not in present:
+                return np.full(n, np.nan)
+            vals = np.array([_to_float(v) for v in column(name)], dtype=float)
+            if name in self.clipping_bounds:
+                lo, hi = self.clipping_bounds[name]
+                vals = np.clip(vals, lo, hi)
+            return vals
+
+        def text(name, normalize=False):
+            # Giá trị thiếu của cột chuỗi được điền 'Unknown' (data_imputation_and_clipping)
+            vals = ["Unknown" if _is_missing(v) else str(v) for v in column(name)]
+            return [normalize_text(v) for v in vals] if normalize else vals
+
+        feats: Dict[str, np.ndarray] = {}
+        dates = {
+            c: [None if _is_missing(v) else _parse_date_text(str(v)) for v in column(c)]
+            for c in DATE_COLS if c in present
+        }
+        nat = [None] * n
+        create_dt = dates.get("create_dt", nat)
+        register_date = dates.get("register_date", nat)
+        first_transaction_date = dates.get("first_transaction_date", nat)
+
+        if "user_name" in present and "sender_name" in present:
+            u, s = np.array(text("user_name", True)), np.array(text("sender_name", True))
+            feats["name_mismatch"] = ((u != "") & (s != "") & (u != s)).astype(float)
+        if "country_code" in present and "receiving_country" in present:
+            feats["country_mismatch"] = (np.array(text("country_code")) != np.array(text("receiving_country"))).astype(float)
+
+        account_age = np.maximum(_days_between(create_dt, register_date), -1)
+        user_seniority = np.maximum(_days_between(create_dt, first_transaction_date), -1)
+        time_to_activate = np.maximum(_days_between(first_transaction_date, register_date), -1)
+        feats["account_age"], feats["user_seniority"], feats["time_to_activate"] = account_age, user_seniority, time_to_activate
+
+        amt = numeric("deposit_amount")
+        amt = np.where(np.isnan(amt), 0.0, amt)
+        txn_count_1m = numeric("transaction_count_1month")
+        txn_count_1m = np.where(np.isnan(txn_count_1m), 0.0, txn_count_1m)
+        txn_24h = numeric("transaction_amount_24hour")
+        txn_24h = np.where(np.isnan(txn_24h), amt, txn_24h)
+        stay = text("stay_qualify", True) if "stay_qualify" in present else ["Unknown"] * n
+        visa = dates.get("visa_expire_date", nat)
+
+        feats["is_new_high_risk"] = ((user_seniority <= 7) & (amt >= 3_000_000)).astype(float)
+        feats["is_fast_actor"] = (time_to_activate <= 1).astype(float)
+        feats["is_near_limit"] = (txn_24h >= 9_500_000).astype(float)
+        feats["is_safe_visa_but_high_amt"] = (np.array([v in SAFE_VISAS for v in stay]) & (amt >= 5_000_000)).astype(float)
+        feats["is_visa_expired"] = np.array([v is not None and c is not None and v < c for v, c in zip(visa, create_dt)], dtype=float)
+        feats["is_zombie_waking_up"] = ((account_age > 180) & (txn_count_1m <= 1) & (amt >= 2_000_000)).astype(float)
+        feats["amount_type"] = np.select([amt < 1_000_000, amt > 4_000_000], [1, 3], default=2).astype(float)
+
+        for c, parsed in dates.items():
+            parts = np.array(
+                [(d.year, d.month, d.day, d.weekday(), d.hour) if d is not None else (np.nan,) * 5 for d in parsed],
+                dtype=float,
+            ).reshape(n, 5)
+            year, month, day, dow, hour = parts.T
+            feats[f"{c}_year"], feats[f"{c}_month"], feats[f"{c}_day"], feats[f"{c}_dayofweek"] = year, month, day, dow
+            feats[f"{c}_month_sin"] = np.sin(2*np.pi*month/12)
+            feats[f"{c}_month_cos"] = np.cos(2*np.pi*month/12)
+            if c == "create_dt":
+                feats[f"{c}_hour"] = hour
+                feats[f"{c}_is_night"] = ((hour < 6) | (hour > 22)).astype(float)
+
+        for c, lookup in self.cat_lookup.items():
+            vals = text(c, normalize=c in TEXT_COLS) if c in present else ["Unknown"] * n
+            feats[c] = np.array([lookup.get(v, self.unknown_value) for v in vals], dtype=float)
+
+        if out is None:
+            out = np.empty((n, len(self.feat_cols)), dtype=np.float32)
+        for j, c in enumerate(self.feat_cols):
+            if c in feats:
+                out[:, j] = feats[c]
+            elif c in present and c not in self._dropped:
+                out[:, j] = numeric(c)
+            else:
+                out[:, j] = np.nan
+        np.copyto(out, self.medians.astype(np.float32), where=np.isnan(out))
+        return out
@@ -1,5 +1,12 @@
+import copy
+import queue
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
 import numpy as np, pandas as pd
-from typing import Optional, Sequence, Tuple
+
+from app.metrics import METRICS
 
 # Hàm tính điểm gian lận từ model YDF đã train
 def fraud_scores_from_model(model, X: pd.DataFrame) -> np.ndarray:
@@ -17,7 +24,8 @@ def decide(scores: np.ndarray, th_low: float, th_high: float) -> np.ndarray:
     return out
 # Hàm tính điểm và quyết định hành động
 def score_and_decide(model, X: pd.DataFrame, th_low: float, th_high: float):
-    s = fraud_scores_from_model(model, X)
+    with METRICS.time("predict"):
+        s = fraud_scores_from_model(model, X)
     d = decide(s, th_low, th_high)
     return s, d
 # Hàm tính điểm, quyết định hành động và giải thích
@@ -33,6 +41,8 @@ def score_decide_with_explanations(
     key_col: str = "transaction_seq", 
     top_k: int = 6, 
     include_allow: bool = False, 
+    explain_mode: str = "perturbation", 
+    zscore_scope: str = "batch", 
 ) -> Tuple[np.ndarray, np.ndarray, pd.DataFrame]:
     scores, decisions = score_and_decide(model, X, th_low, th_high) 
 
@@ -61,20 +71,94 @@ def score_decide_with_explanations(
 
         from app.explain import batch_explanations 
 
-        explanations = batch_explanations(
-            model,
-            explain_df,
-            key_col=key_col,
-            top_k=top_k,
-            feat_cols=list(feat_cols),
-            medians=dict(medians),
-        )
-        reasons_map = dict(zip(explanations["id"], explanations["reasons_json"]))
-
-        target_idx = explain_idx if include_allow else np.where(decisions != "ALLOW")[0]
-        if target_idx.size:
-            mapped = result.loc[target_idx, key_col].map(reasons_map)
-            result.loc[target_idx, "reasons_json"] = mapped.where(pd.notna(mapped), None)
+        with METRICS.time("explain"):
+            explanations = batch_explanations(
+                model,
+                explain_df,
+                key_col=key_col,
+                top_k=top_k,
+                feat_cols=list(feat_cols),
+                medians=dict(medians),
+                mode=explain_mode,
+                zscore_scope=zscore_scope,
+            )
+        # Gán theo vị trí (index gốc của explain_df) để key trùng nhau không lấy nhầm lý do
+        result.loc[explain_idx, "reasons_json"] = explanations.sort_index()["reasons_json"].to_numpy()
 
     return scores, decisions, result
 
+
+
+# Hàm tạo một bản model độc lập (YDF: serialize/deserialize; model khác: deepcopy)
+def _clone_model(model):
+    if hasattr(model, "serialize"):
+        import ydf
+        return ydf.deserialize_model(model.serialize())
+    return copy.deepcopy(model)
+
+
+class ScoringService:
+    """
+    Quyền truy cập model cho nhiều thread chấm điểm đồng thời (thread của ScoringExecutor / threadpool Starlette).
+
+    Bảo đảm:
+    - Đọc không khoá: service thuộc về một ScoringBundle bất biến; request lấy bundle một lần nên reload
+      (gán tham chiếu bundle mới) không bao giờ đổi model, thresholds hay buffer giữa chừng request.
+    - Model handle: n_handles <= 1 dùng chung một handle. predict của YDF chỉ đọc model đã biên dịch
+      (engine dựng lúc load / warm-up) và đã được kiểm chứng cho kết quả bit-identical khi gọi song song
+      (scripts/stress_score_reload.py). n_handles > 1 nạp thêm bản sao và mỗi lượt chấm giữ độc quyền
+      một handle (dành cho model chưa chứng minh được thread-safe); hết handle thì thread chờ.
+    - Buffer đầu vào: mỗi thread có ma trận float32 riêng, dùng lại giữa các lượt; kết quả của features()
+      chỉ hợp lệ tới lần gọi features() kế tiếp trên cùng thread.
+    """
+
+    MAX_BUFFER_ROWS = 4096  # batch lớn hơn cấp phát riêng, không giữ lại trong thread
+
+    def __init__(self, model, n_handles: int = 1):
+        self.model = model
+        self.handles: List[Any] = [model] + [_clone_model(model) for _ in range(max(1, n_handles) - 1)]
+        self._idle: Optional[queue.Queue] = None
+        if len(self.handles) > 1:
+            from app.explain import share_forest_cache  # import muộn: app.explain import app.scoring
+            share_forest_cache(model, self.handles[1:])
+            self._idle = queue.Queue()
+            for h in self.handles:
+                self._idle.put(h)
+        self._local = threading.local()
+
+    @contextmanager
+    def handle(self) -> Iterator[Any]:
+        if self._idle is None:
+            yield self.model
+            return
+        model = self._idle.get()
+        try:
+            yield model
+        finally:
+            self._idle.put(model)
+
+    # Hàm lấy buffer float32 (n_rows, n_cols) của thread hiện tại, tăng kích thước khi cần
+    def input_buffer(self, n_rows: int, n_cols: int) -> np.ndarray:
+        if n_rows > self.MAX_BUFFER_ROWS:
+            return np.empty((n_rows, n_cols), dtype=np.float32)
+        buf = getattr(self._local, "buf", None)
+        if buf is None or buf.shape[0] < n_rows or buf.shape[1] != n_cols:
+            rows = min(self.MAX_BUFFER_ROWS, max(n_rows, 64, 2 * (buf.shape[0] if buf is not None else 0)))
+            buf = self._local.buf = np.empty((rows, n_cols), dtype=np.float32)
+        return buf[:n_rows]
+
+    # Hàm tiền xử lý bằng CompiledPreprocessor vào buffer của thread
+    def features(self, compiled_pre, records: Sequence[Dict[str, Any]]) -> pd.DataFrame:
+        out = self.input_buffer(len(records), len(compiled_pre.feat_cols))
+        return pd.DataFrame(compiled_pre.transform(records, out=out), columns=compiled_pre.feat_cols, copy=False)
+
+    def score_decide_with_explanations(self, X: pd.DataFrame, th_low: float, th_high: float,
+                                       feat_cols: Sequence[str], medians: dict, **kwargs):
+        with self.handle() as model:
+            return score_decide_with_explanations(model, X, th_low, th_high, feat_cols, medians, **kwargs)
+
+    def stats(self) -> dict:
+        return {
+            "model_handles": len(self.handles),
+            "idle_handles": self._idle.qsize() if self._idle is not None else None,
+        }
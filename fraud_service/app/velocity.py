@@ -0,0 +1,303 @@
+import logging
+import os
+import pickle
+import threading
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional, Tuple
+
+from sqlalchemy import text
+
+from app.preprocess import _parse_date_text
+
+LOGGER = logging.getLogger(__name__)
+
+# (tên feature count, tên feature amount, độ dài cửa sổ giây) - sắp xếp tăng dần theo cửa sổ
+VELOCITY_WINDOWS: Tuple[Tuple[str, str, int], ...] = (
+    ("transaction_count_24hour", "transaction_amount_24hour", 24 * 3600),
+    ("transaction_count_1week", "transaction_amount_1week", 7 * 24 * 3600),
+    ("transaction_count_1month", "transaction_amount_1month", 30 * 24 * 3600),
+)
+SNAPSHOT_VERSION = 1
+
+# Giao dịch dùng để warm-up store khi khởi động không có snapshot (cùng định nghĩa với LATERAL velocity của
+# data.sql: mọi giao dịch của user, không lọc category), theo thứ tự thời gian
+SQL_WARMUP_EVENTS = """
+SELECT t.user_seq, t.create_dt, t.deposit_amount::float8 AS deposit_amount, t.seq
+FROM transaction_info t
+WHERE t.create_dt > :since AND t.user_seq IS NOT NULL
+ORDER BY t.create_dt, t.seq
+"""
+
+
+# Hàm đổi create_dt (chuỗi / datetime) sang epoch giây; datetime không có timezone được coi là UTC
+def to_epoch_seconds(value) -> Optional[float]:
+    dt = value if isinstance(value, datetime) else _parse_date_text(str(value)) if value is not None else None
+    if dt is None:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+class _UserHistory:
+    """
+    Các giao dịch gần đây của một user (sắp theo thời gian) + tổng count/amount đang chạy cho từng cửa sổ.
+    lo[i] là chỉ số tuyệt đối của giao dịch cũ nhất còn nằm trong cửa sổ i tính từ last_ts.
+    """
+
+    __slots__ = ("ts", "amount", "seq", "base", "lo", "count", "total", "last_ts", "max_seq")
+
+    def __init__(self, n_windows: int):
+        self.ts: deque = deque()
+        self.amount: deque = deque()
+        self.seq: deque = deque()
+        self.base = 0
+        self.lo = [0] * n_windows
+        self.count = [0] * n_windows
+        self.total = [0.0] * n_windows
+        self.last_ts = float("-inf")
+        self.max_seq: Optional[int] = None
+
+    def _end(self) -> int:
+        return self.base + len(self.ts)
+
+    # Dời các cửa sổ tới thời điểm now: bỏ giao dịch có ts <= now - w (khớp điều kiện create_dt > t - w của SQL)
+    def advance(self, now: float, spans: Tuple[int, ...], grace: float = 0.0) -> None:
+        end = self._end()
+        for i, span in enumerate(spans):
+            cutoff = now - span
+            while self.lo[i] < end and self.ts[self.lo[i] - self.base] <= cutoff:
+                self.count[i] -= 1
+                self.total[i] -= self.amount[self.lo[i] - self.base]
+                self.lo[i] += 1
+        self.last_ts = max(self.last_ts, now)
+        # Cửa sổ lớn nhất đứng cuối: giao dịch trước lo[-1] chỉ giữ thêm grace giây cho giao dịch đến muộn
+        keep_after = self.last_ts - spans[-1] - grace
+        while self.base < self.lo[-1] and self.ts[0] <= keep_after:
+            self.ts.popleft()
+            self.amount.popleft()
+            self.seq.popleft()
+            self.base += 1
+
+    def append(self, ts: float, amount: float, seq: Optional[int], spans: Tuple[int, ...], max_events: int,
+               grace: float = 0.0) -> None:
+        if self.ts and ts < self.ts[-1]:
+            # Giao dịch đến muộn: chèn sau các giao dịch cùng ts (chỉ so ts, seq có thể là None) rồi tính lại (hiếm gặp)
+            events = list(zip(self.ts, self.amount, self.seq))
+            events.insert(bisect_right(list(self.ts), ts), (ts, amount, seq))
+            self._rebuild(events, spans, grace)
+        else:
+            self.ts.append(ts)
+            self.amount.append(amount)
+            self.seq.append(seq)
+            for i in range(len(spans)):
+                self.count[i] += 1
+                self.total[i] += amount
+        if seq is not None:
+            self.max_seq = seq if self.max_seq is None else max(self.max_seq, seq)
+        self.advance(max(self.last_ts, ts), spans, grace)
+        while len(self.ts) > max_events:
+            self._drop_oldest()
+
+    def _drop_oldest(self) -> None:
+        for i in range(len(self.lo)):
+            if self.lo[i] == self.base:
+                self.count[i] -= 1
+                self.total[i] -= self.amount[0]
+                self.lo[i] += 1
+        self.ts.popleft()
+        self.amount.popleft()
+        self.seq.popleft()
+        self.base += 1
+
+    def _rebuild(self, events, spans: Tuple[int, ...], grace: float = 0.0) -> None:
+        self.ts, self.amount, self.seq = deque(), deque(), deque()
+        self.base = 0
+        self.lo = [0] * len(spans)
+        self.count = [0] * len(spans)
+        self.total = [0.0] * len(spans)
+        for ts, amount, seq in events:
+            self.ts.append(ts)
+            self.amount.append(amount)
+            self.seq.append(seq)
+            for i in range(len(spans)):
+                self.count[i] += 1
+                self.total[i] += amount
+        self.advance(self.last_ts, spans, grace)
+
+    # Đường chậm: quét toàn bộ (khi truy vấn lùi thời gian hoặc seq đã được ghi trước đó, vd. client retry)
+    def scan(self, now: float, seq: Optional[int], spans: Tuple[int, ...]):
+        counts, totals = [0] * len(spans), [0.0] * len(spans)
+        for ts, amount, eseq in zip(self.ts, self.amount, self.seq):
+            before = eseq < seq if (seq is not None and eseq is not None) else ts <= now
+            if not before:
+                continue
+            for i, span in enumerate(spans):
+                if ts > now - span:
+                    counts[i] += 1
+                    totals[i] += amount
+        return counts, totals
+
+
+class VelocityStore:
+    """
+    Velocity features theo user_seq tính ngay trong process từ luồng giao dịch được chấm điểm.
+
+    - observe(): trả về 6 feature transaction_count/amount_* từ các giao dịch trước đó của user rồi ghi nhận
+      giao dịch hiện tại; O(1) khấu hao khi giao dịch đến theo thứ tự thời gian.
+    - Bộ nhớ bị chặn bởi max_users (LRU) và max_events_per_user; user không hoạt động quá cửa sổ lớn nhất
+      có thể bỏ đi mà không mất thông tin (prune).
+    - Giao dịch đến muộn (create_dt lùi so với giao dịch mới nhất của user) vẫn cho kết quả chính xác nếu
+      trễ không quá late_grace_seconds.
+    - snapshot()/restore() ghi/đọc trạng thái ra đĩa để restart không phải warm-up lại từ transaction_info
+      (warm_up_from_db()).
+    Cửa sổ "1month" dùng 30 ngày cố định.
+    """
+
+    def __init__(self, max_users: int = 200_000, max_events_per_user: int = 5_000,
+                 late_grace_seconds: float = 24 * 3600,
+                 windows: Tuple[Tuple[str, str, int], ...] = VELOCITY_WINDOWS):
+        self.windows = tuple(sorted(windows, key=lambda w: w[2]))
+        self.spans = tuple(w[2] for w in self.windows)
+        self.max_users = max(1, int(max_users))
+        self.max_events_per_user = max(1, int(max_events_per_user))
+        self.grace = max(0.0, float(late_grace_seconds))
+        self._users: "OrderedDict[int, _UserHistory]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def _features(self, counts, totals) -> Dict[str, float]:
+        out = {}
+        for (count_name, amount_name, _), c, s in zip(self.windows, counts, totals):
+            out[count_name] = int(c)
+            out[amount_name] = float(s)
+        return out
+
+    def _history(self, user_seq: int, create: bool) -> Optional[_UserHistory]:
+        hist = self._users.get(user_seq)
+        if hist is None and create:
+            hist = self._users[user_seq] = _UserHistory(len(self.spans))
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+                self.evicted += 1
+        if hist is not None:
+            self._users.move_to_end(user_seq)
+        return hist
+
+    def _lookup(self, hist: Optional[_UserHistory], ts: float, seq: Optional[int]):
+        if hist is None:
+            return [0] * len(self.spans), [0.0] * len(self.spans)
+        replay = seq is not None and hist.max_seq is not None and seq <= hist.max_seq
+        if ts < hist.last_ts or replay:
+            return hist.scan(ts, seq, self.spans)
+        hist.advance(ts, self.spans, self.grace)
+        return list(hist.count), list(hist.total)
+
+    def features(self, user_seq: int, create_dt, seq: Optional[int] = None) -> Dict[str, float]:
+        ts = to_epoch_seconds(create_dt)
+        with self._lock:
+            hist = self._history(user_seq, create=False)
+            if ts is None:
+                return self._features([0] * len(self.spans), [0.0] * len(self.spans))
+            return self._features(*self._lookup(hist, ts, seq))
+
+    def record(self, user_seq: int, create_dt, amount: float, seq: Optional[int] = None) -> None:
+        ts = to_epoch_seconds(create_dt)
+        if ts is None:
+            return
+        with self._lock:
+            self._record(self._history(user_seq, create=True), ts, amount, seq)
+
+    def _record(self, hist: _UserHistory, ts: float, amount: float, seq: Optional[int]) -> None:
+        if seq is not None and hist.max_seq is not None and seq <= hist.max_seq and seq in hist.seq:
+            return  # đã ghi nhận (retry) - không đếm hai lần
+        hist.append(ts, float(amount or 0.0), seq, self.spans, self.max_events_per_user, self.grace)
+
+    def observe(self, user_seq: int, create_dt, amount: float, seq: Optional[int] = None) -> Dict[str, float]:
+        """Feature của giao dịch (chỉ tính các giao dịch trước nó) rồi ghi nhận giao dịch vào store."""
+        ts = to_epoch_seconds(create_dt)
+        with self._lock:
+            if ts is None:
+                return self._features([0] * len(self.spans), [0.0] * len(self.spans))
+            hist = self._history(user_seq, create=True)
+            feats = self._features(*self._lookup(hist, ts, seq))
+            self._record(hist, ts, amount, seq)
+            return feats
+
+    def load_events(self, events: Iterable[Tuple[int, object, float, Optional[int]]]) -> int:
+        """Nạp (user_seq, create_dt, amount, seq) - vd. warm-up một lần từ transaction_info khi chưa có snapshot."""
+        n = 0
+        for user_seq, create_dt, amount, seq in events:
+            self.record(int(user_seq), create_dt, amount, None if seq is None else int(seq))
+            n += 1
+        return n
+
+    def warm_up_from_db(self, engine, chunk_rows: int = 50_000, now=None) -> int:
+        """
+        Nạp các giao dịch trong cửa sổ lớn nhất (+ late grace) tính tới now từ transaction_info, đọc qua
+        server-side cursor theo từng khối chunk_rows dòng. create_dt không timezone được coi là UTC như to_epoch_seconds.
+        """
+        now_ts = to_epoch_seconds(now) if now is not None else datetime.now(timezone.utc).timestamp()
+        since = datetime.fromtimestamp(now_ts - self.spans[-1] - self.grace, tz=timezone.utc).replace(tzinfo=None)
+        n = 0
+        with engine.connect() as conn:
+            result = conn.execution_options(stream_results=True).execute(text(SQL_WARMUP_EVENTS), {"since": since})
+            for rows in result.yield_per(chunk_rows).partitions():
+                n += self.load_events(rows)
+        return n
+
+    def prune(self, now=None) -> int:
+        """Bỏ các user không có giao dịch nào trong cửa sổ lớn nhất tính tới now (mặc định: bây giờ)."""
+        now_ts = to_epoch_seconds(now) if now is not None else datetime.now(timezone.utc).timestamp()
+        cutoff = now_ts - self.spans[-1]
+        with self._lock:
+            stale = [u for u, h in self._users.items() if not h.ts or h.ts[-1] <= cutoff]
+            for u in stale:
+                del self._users[u]
+        return len(stale)
+
+    def snapshot(self, path: str) -> int:
+        """Ghi trạng thái ra file (ghi file tạm rồi os.replace để không để lại snapshot hỏng)."""
+        with self._lock:
+            users = {
+                u: (list(h.ts), list(h.amount), list(h.seq), h.last_ts, h.max_seq)
+                for u, h in self._users.items()
+            }
+        payload = {"version": SNAPSHOT_VERSION, "spans": self.spans, "users": users}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        return len(users)
+
+    def restore(self, path: str) -> int:
+        """Nạp snapshot (thay toàn bộ trạng thái hiện tại); trả về số user đã nạp."""
+        with open(path, "rb") as f:
+            payload = pickle.load(f)
+        if payload.get("version") != SNAPSHOT_VERSION or tuple(payload.get("spans", ())) != self.spans:
+            raise ValueError(f"Incompatible velocity snapshot at {path}")
+        users: "OrderedDict[int, _UserHistory]" = OrderedDict()
+        for u, (ts, amount, seq, last_ts, max_seq) in payload["users"].items():
+            hist = _UserHistory(len(self.spans))
+            hist.last_ts = last_ts
+            hist._rebuild(zip(ts, amount, seq), self.spans, self.grace)
+            hist.max_seq = max_seq
+            users[u] = hist
+        while len(users) > self.max_users:
+            users.popitem(last=False)
+        with self._lock:
+            self._users = users
+        return len(users)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "users": len(self._users),
+                "events": sum(len(h.ts) for h in self._users.values()),
+                "max_users": self.max_users,
+                "max_events_per_user": self.max_events_per_user,
+                "evicted": self.evicted,
+            }
@@ -0,0 +1,134 @@
+# data/arrow_io.py
+import os
+import shutil
+from typing import Iterable, Iterator, List, Sequence, Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from sqlalchemy import text
+
+# Cột partition (hive: <out_dir>/month=YYYY-MM/part-0.parquet) suy ra từ create_dt
+PARTITION_COL = "month"
+
+# OID kiểu Postgres -> kiểu Arrow; kiểu khác (text, varchar, ...) lưu dạng string
+_PG_ARROW_TYPES = {
+    16: pa.bool_(),                      # bool
+    20: pa.int64(), 21: pa.int64(), 23: pa.int64(),  # int8 / int2 / int4
+    700: pa.float64(), 701: pa.float64(),            # float4 / float8
+    1700: pa.float64(),                  # numeric (Decimal -> float như pd.read_sql + CSV trước đây)
+    1082: pa.date32(),                   # date
+    1114: pa.timestamp("us"),            # timestamp
+    1184: pa.timestamp("us", tz="UTC"),  # timestamptz
+}
+_NUMERIC_OID = 1700
+
+
+# Hàm dựng schema Arrow từ cursor.description của psycopg2 (kiểu cố định theo cột, không suy từ dữ liệu)
+def arrow_schema(description) -> pa.Schema:
+    return pa.schema([(col[0], _PG_ARROW_TYPES.get(col[1], pa.string())) for col in description])
+
+
+# Hàm chuyển một khối dòng (tuple) thành RecordBatch theo schema, từng cột một
+def rows_to_record_batch(rows: Sequence[tuple], schema: pa.Schema, oids: Sequence[int]) -> pa.RecordBatch:
+    columns = list(zip(*rows)) if rows else [()] * len(schema)
+    arrays = []
+    for values, field, oid in zip(columns, schema, oids):
+        if oid == _NUMERIC_OID:
+            values = [None if v is None else float(v) for v in values]
+        elif pa.types.is_string(field.type):
+            values = [None if v is None else str(v) for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+# Hàm chạy câu SQL và trả về pa.Table (bỏ qua DataFrame trung gian của pd.read_sql)
+def fetch_arrow(conn, sql: str, params: dict) -> pa.Table:
+    result = conn.execute(text(sql), params)
+    description = result.cursor.description
+    schema = arrow_schema(description)
+    batch = rows_to_record_batch(result.fetchall(), schema, [col[1] for col in description])
+    return pa.Table.from_batches([batch], schema=schema)
+
+
+# Hàm đọc kết quả SQL theo từng khối chunk_rows qua server-side cursor (stream_results -> named cursor của
+# psycopg2, yield_per -> mỗi lần FETCH chunk_rows dòng). Client chỉ giữ một khối tuple + một RecordBatch tại
+# một thời điểm nên bộ nhớ đỉnh tỉ lệ với chunk_rows thay vì cả cửa sổ dữ liệu. Cần conn nằm trong transaction.
+def stream_arrow(conn, sql: str, params: dict, chunk_rows: int) -> Tuple[pa.Schema, Iterator[pa.RecordBatch]]:
+    result = conn.execution_options(stream_results=True).execute(text(sql), params)
+    description = result.cursor.description
+    schema = arrow_schema(description)
+    oids = [col[1] for col in description]
+
+    def batches() -> Iterator[pa.RecordBatch]:
+        try:
+            for rows in result.yield_per(chunk_rows).partitions():
+                yield rows_to_record_batch(rows, schema, oids)
+        finally:
+            result.close()
+
+    return schema, batches()
+
+
+# Hàm kiểm tra đường dẫn dữ liệu là CSV (định dạng cũ) hay Parquet (file hoặc thư mục partition)
+def is_csv_path(path: str) -> bool:
+    return str(path).lower().endswith(".csv")
+
+
+# Hàm ghi các RecordBatch thành Parquet partition theo tháng của time_col; ghi đè dữ liệu cũ trong out_dir.
+# Batch được ghi dần khi đến (dùng được với stream_arrow); kết quả rỗng được ghi thành một file không
+# partition để lần đọc sau vẫn có schema. Trả về (số dòng, danh sách tháng).
+def write_parquet_by_month(batches: Iterable[pa.RecordBatch], schema: pa.Schema, out_dir: str,
+                           time_col: str = "create_dt") -> Tuple[int, List[str]]:
+    os.makedirs(out_dir, exist_ok=True)
+    for name in os.listdir(out_dir):
+        if name.startswith(f"{PARTITION_COL}="):
+            shutil.rmtree(os.path.join(out_dir, name))
+        elif name.endswith(".parquet"):
+            os.remove(os.path.join(out_dir, name))
+
+    out_schema = schema.append(pa.field(PARTITION_COL, pa.string()))
+    n_rows, months = 0, set()
+
+    def with_month() -> Iterator[pa.RecordBatch]:
+        nonlocal n_rows
+        for batch in batches:
+            if batch.num_rows == 0:
+                continue
+            month = pc.fill_null(pc.strftime(batch.column(time_col), format="%Y-%m"), "unknown")
+            months.update(pc.unique(month).to_pylist())
+            n_rows += batch.num_rows
+            yield pa.RecordBatch.from_arrays([*batch.columns, month], schema=out_schema)
+
+    ds.write_dataset(
+        pa.RecordBatchReader.from_batches(out_schema, with_month()), out_dir, format="parquet",
+        partitioning=ds.partitioning(pa.schema([(PARTITION_COL, pa.string())]), flavor="hive"),
+        basename_template="part-{i}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        use_threads=False,  # giữ thứ tự dòng như kết quả SQL
+    )
+    if n_rows == 0:
+        pq.write_table(schema.empty_table(), os.path.join(out_dir, "part-0.parquet"))
+    return n_rows, sorted(months)
+
+
+# Hàm đọc dữ liệu huấn luyện (CSV hoặc Parquet) thành DataFrame, bỏ các cột không cần.
+# Parquet chỉ đọc các cột cần thiết và giữ nguyên kiểu (int/float/date/timestamp) đã lưu lúc fetch.
+def read_frame(path: str, skip_columns: Iterable[str] = ()) -> pd.DataFrame:
+    skip = set(skip_columns) | {PARTITION_COL}
+    if is_csv_path(path):
+        return pd.read_csv(path, usecols=lambda c: c not in skip)
+    dataset = ds.dataset(path, format="parquet", partitioning="hive")
+    columns = [name for name in dataset.schema.names if name not in skip]
+    return dataset.to_table(columns=columns).to_pandas(date_as_object=False)
+
+
+# Hàm ghi DataFrame ra CSV hoặc một file Parquet tuỳ phần mở rộng của path
+def write_frame(df: pd.DataFrame, path: str) -> None:
+    if is_csv_path(path):
+        df.to_csv(path, index=False)
+    else:
+        df.to_parquet(path, index=False, engine="pyarrow")
+
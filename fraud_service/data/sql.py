@@ -1,9 +1,73 @@
 # data/sql.py
+from typing import Tuple
 from sqlalchemy import text
 import pandas as pd
 
-SQL_SKELETON = r"""
-SELECT 
+# Hàm dựng câu SQL lấy raw features cho các giao dịch thỏa where_sql (alias t = transaction_info)
+def build_feature_sql(where_sql: str, ctes: str = "") -> str:
+    """
+    Các lookup theo user (register_date, face_pin_date, ...) được tính một lần cho mỗi user có trong batch
+    (CTE user_lookups / token_accounts) thay vì một lần cho mỗi giao dịch; 6 velocity features được tính trong một LATERAL scan duy nhất trên
+    (user_seq, create_dt) thay vì 6 subquery tương quan. Định nghĩa giữ nguyên: các giao dịch trước đó
+    (seq < t.seq) có create_dt nằm trong cửa sổ 24h / 1 week / 1 month tính từ t.create_dt.
+    ctes: các CTE bổ sung (không kèm WITH) mà where_sql có thể tham chiếu.
+    Index khuyến nghị: migrations/003_feature_query_indexes.sql.
+    """
+    extra = f"{ctes.strip()},\n" if ctes else ""
+    return f"""
+WITH {extra}target AS (
+  SELECT t.seq, t.user_seq, t.create_dt, t.deposit_amount, t.receiving_country, t.recipient_name
+  FROM transaction_info t
+  WHERE {where_sql}
+),
+target_users AS (
+  SELECT DISTINCT u.seq AS user_seq, u.uid
+  FROM target t
+  JOIN user_info u ON u.seq = t.user_seq
+),
+user_lookups AS (
+  SELECT tu.user_seq, fa.register_date, ft.first_transaction_date, rc.recheck_date, fp.face_pin_date
+  FROM target_users tu
+  LEFT JOIN LATERAL (
+    SELECT a.update_dt::date AS register_date
+    FROM id_approval a
+    WHERE a.user_seq = tu.user_seq
+    ORDER BY a.seq LIMIT 1
+  ) fa ON TRUE
+  LEFT JOIN LATERAL (
+    SELECT t2.create_dt::date AS first_transaction_date
+    FROM transaction_info t2
+    WHERE t2.user_seq = tu.user_seq AND t2.category = 3
+    ORDER BY t2.seq LIMIT 1
+  ) ft ON TRUE
+  LEFT JOIN LATERAL (
+    SELECT r.approve_dt::date AS recheck_date
+    FROM idcard_recheck r
+    WHERE r.uid = tu.uid AND r.status = 'APPROVED'
+    ORDER BY r.seq DESC LIMIT 1
+  ) rc ON TRUE
+  LEFT JOIN LATERAL (
+    SELECT f.update_dt::date AS face_pin_date
+    FROM face_pin f
+    WHERE f.user_seq = tu.user_seq AND f.active
+    ORDER BY f.seq DESC LIMIT 1
+  ) fp ON TRUE
+),
+token_accounts AS (
+  SELECT tok.user_seq_no, ad.autodebit_account
+  FROM (
+    SELECT DISTINCT o.user_seq_no
+    FROM op_token o
+    JOIN target_users tu ON tu.user_seq = o.user_seq
+  ) tok
+  LEFT JOIN LATERAL (
+    SELECT l.account_number AS autodebit_account
+    FROM op_log_user_register l
+    WHERE l.user_seq_no = tok.user_seq_no AND l.rsp_code = 'A0000'
+    ORDER BY l.seq DESC LIMIT 1
+  ) ad ON TRUE
+)
+SELECT
   t.seq AS transaction_seq,
   u.seq AS user_seq,
   t.create_dt,
@@ -17,89 +81,179 @@ SELECT
   COALESCE(
     (SELECT deposit_name FROM kibnet_account_issued k WHERE ukey = t.seq::text),
     (SELECT account_holder_name FROM op_withdraw o2 WHERE transaction_seq = t.seq),
-    (SELECT account_holder FROM account_transfer_issued 
+    (SELECT account_holder FROM account_transfer_issued
      WHERE remittance_type = 'OVERSEA_TRANSACTION' AND related_seq = t.seq)
   ) AS sender_name,
   t.recipient_name,
   pi.method AS payment_method,
-  (SELECT DISTINCT ON (user_seq_no) account_number
-     FROM op_log_user_register
-    WHERE rsp_code='A0000' AND user_seq_no=o.user_seq_no
-    ORDER BY user_seq_no, seq DESC) AS autodebit_account,
-  (SELECT DISTINCT ON (user_seq) update_dt::date
-     FROM id_approval
-    WHERE user_seq=u.seq
-    ORDER BY user_seq, seq) AS register_date,
-  (SELECT t2.create_dt::date
-     FROM transaction_info t2
-    WHERE t2.user_seq=u.seq AND t2.category=3
-    ORDER BY t2.seq LIMIT 1) AS first_transaction_date,
+  ta.autodebit_account,
+  ul.register_date,
+  ul.first_transaction_date,
   u.birth_date,
-  (SELECT approve_dt::date
-     FROM idcard_recheck
-    WHERE uid=p.uid AND status='APPROVED'
-    ORDER BY uid, seq DESC LIMIT 1) AS recheck_date,
+  ul.recheck_date,
   u.invite_code,
-  (SELECT DISTINCT ON (user_seq) update_dt::date
-     FROM face_pin
-    WHERE user_seq=u.seq AND active
-    ORDER BY user_seq, seq DESC) AS face_pin_date,
-  (SELECT COUNT(*) FROM transaction_info
-    WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '24 hour') AS transaction_count_24hour,
-  (SELECT COALESCE(SUM(deposit_amount),0) FROM transaction_info
-    WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '24 hour') AS transaction_amount_24hour,
-  (SELECT COUNT(*) FROM transaction_info
-    WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '1 week') AS transaction_count_1week,
-  (SELECT COALESCE(SUM(deposit_amount),0) FROM transaction_info
-    WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '1 week') AS transaction_amount_1week,
-  (SELECT COUNT(*) FROM transaction_info
-    WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '1 month') AS transaction_count_1month,
-  (SELECT COALESCE(SUM(deposit_amount),0) FROM transaction_info
-    WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '1 month') AS transaction_amount_1month
-FROM transaction_info t
-JOIN user_info u ON u.seq=t.user_seq
-JOIN personal_identification p ON p.uid=u.uid
-LEFT JOIN payment_info pi ON pi.transaction_seq=t.seq
-LEFT JOIN op_token o ON o.user_seq=u.seq
-WHERE t.create_dt >= :start_dt AND t.create_dt < :end_dt
+  ul.face_pin_date,
+  v.transaction_count_24hour,
+  v.transaction_amount_24hour,
+  v.transaction_count_1week,
+  v.transaction_amount_1week,
+  v.transaction_count_1month,
+  v.transaction_amount_1month
+FROM target t
+JOIN user_info u ON u.seq = t.user_seq
+JOIN personal_identification p ON p.uid = u.uid
+LEFT JOIN payment_info pi ON pi.transaction_seq = t.seq
+LEFT JOIN op_token o ON o.user_seq = u.seq
+LEFT JOIN token_accounts ta ON ta.user_seq_no = o.user_seq_no
+LEFT JOIN user_lookups ul ON ul.user_seq = u.seq
+CROSS JOIN LATERAL (
+  -- 1 month là cửa sổ rộng nhất: quét một lần, 24h / 1 week lọc bằng FILTER
+  SELECT
+    COUNT(*) FILTER (WHERE h.create_dt > t.create_dt - INTERVAL '24 hour') AS transaction_count_24hour,
+    COALESCE(SUM(h.deposit_amount) FILTER (WHERE h.create_dt > t.create_dt - INTERVAL '24 hour'), 0) AS transaction_amount_24hour,
+    COUNT(*) FILTER (WHERE h.create_dt > t.create_dt - INTERVAL '1 week') AS transaction_count_1week,
+    COALESCE(SUM(h.deposit_amount) FILTER (WHERE h.create_dt > t.create_dt - INTERVAL '1 week'), 0) AS transaction_amount_1week,
+    COUNT(*) AS transaction_count_1month,
+    COALESCE(SUM(h.deposit_amount), 0) AS transaction_amount_1month
+  FROM transaction_info h
+  WHERE h.user_seq = t.user_seq
+    AND h.seq < t.seq
+    AND h.create_dt > t.create_dt - INTERVAL '1 month'
+) v
 """
 
-SQL_NONFRAUD = f"""
-WITH nf AS (
+SQL_WINDOW_FILTER = "t.create_dt >= :start_dt AND t.create_dt < :end_dt"
+
+# Các cách chọn mẫu non-fraud trong cửa sổ (CTE nf):
+# - random: ORDER BY random() LIMIT (cũ) - sort toàn bộ giao dịch trong cửa sổ, mỗi lần chạy ra mẫu khác
+# - hash: giữ các seq có hash(seq, seed) rơi vào một phần bucket vừa đủ (~1.3 x limit, tính từ COUNT của cửa sổ)
+#   rồi cắt LIMIT theo thứ tự hash: chỉ sort phần đã lọc, cùng seed + cùng dữ liệu -> cùng mẫu
+# strata (chỉ với hash): chia limit theo tỉ lệ số giao dịch của từng tháng / receiving_country; tổng có thể lệch
+# limit vài dòng do làm tròn quota của từng nhóm
+NONFRAUD_SAMPLINGS = ("random", "hash")
+NONFRAUD_STRATA = {
+    "": None,
+    "month": "date_trunc('month', t.create_dt)",
+    "receiving_country": "COALESCE(t.receiving_country, '')",
+}
+# hashint8extended trả bigint; 20 bit thấp dùng làm bucket lọc, cả giá trị dùng làm thứ tự ngẫu nhiên cố định
+_HASH = "hashint8extended(t.seq, :seed)"
+_HASH_BUCKETS = 1 << 20
+# Lấy dư trước khi cắt theo LIMIT / quota để gần như luôn đủ dòng: 1.3 x limit + 100 dòng (mỗi nhóm)
+_HASH_OVERSAMPLE = 1.3
+_HASH_EXTRA_ROWS = 100
+
+# Hàm dựng CTE chọn mẫu non-fraud (nf) theo chiến lược sampling / strata
+def build_nonfraud_sample_cte(sampling: str = "random", strata: str = "") -> str:
+    if sampling not in NONFRAUD_SAMPLINGS:
+        raise ValueError(f"Unknown non-fraud sampling {sampling!r}; expected one of {NONFRAUD_SAMPLINGS}")
+    if strata not in NONFRAUD_STRATA:
+        raise ValueError(f"Unknown non-fraud strata {strata!r}; expected one of {sorted(NONFRAUD_STRATA)}")
+    if sampling == "random":
+        if strata:
+            raise ValueError("Stratified sampling requires sampling='hash'")
+        return f"""nf AS (
   SELECT t.seq
   FROM transaction_info t
-  WHERE t.create_dt >= :start_dt AND t.create_dt < :end_dt
+  WHERE {SQL_WINDOW_FILTER}
   ORDER BY random()
   LIMIT :limit_nf
-)
-{SQL_SKELETON}
-AND t.seq IN (SELECT seq FROM nf)
-"""
+)"""
+    if not strata:
+        keep = f"(:limit_nf * {_HASH_OVERSAMPLE} + {_HASH_EXTRA_ROWS})"
+        return f"""nf_window AS MATERIALIZED (
+  SELECT CEIL({_HASH_BUCKETS} * LEAST(1.0, {keep} / GREATEST(COUNT(*), 1)))::bigint AS cut
+  FROM transaction_info t
+  WHERE {SQL_WINDOW_FILTER}
+),
+nf AS (
+  SELECT t.seq
+  FROM transaction_info t, nf_window w
+  WHERE {SQL_WINDOW_FILTER}
+    AND ({_HASH} & {_HASH_BUCKETS - 1}) < w.cut
+  ORDER BY {_HASH}
+  LIMIT :limit_nf
+)"""
+    # Phân bổ theo tỉ lệ nên tỉ lệ giữ lại của mọi nhóm ~ limit / N: lọc hash một lần với cùng một ngưỡng
+    # (lấy dư thêm 100 dòng mỗi nhóm) rồi mới cắt theo quota của từng nhóm trên tập ứng viên nhỏ
+    stratum = NONFRAUD_STRATA[strata]
+    keep = f"(:limit_nf * {_HASH_OVERSAMPLE} + {_HASH_EXTRA_ROWS} * COUNT(*) OVER ())"
+    return f"""nf_quota AS MATERIALIZED (
+  SELECT stratum,
+         ROUND(:limit_nf * n::numeric / SUM(n) OVER ())::bigint AS quota,
+         CEIL({_HASH_BUCKETS} * LEAST(1.0, {keep} / GREATEST(SUM(n) OVER (), 1)))::bigint AS cut
+  FROM (
+    SELECT {stratum} AS stratum, COUNT(*) AS n
+    FROM transaction_info t
+    WHERE {SQL_WINDOW_FILTER}
+    GROUP BY 1
+  ) s
+),
+nf_candidates AS MATERIALIZED (
+  SELECT t.seq, {stratum} AS stratum, {_HASH} AS h
+  FROM transaction_info t
+  WHERE {SQL_WINDOW_FILTER}
+    AND ({_HASH} & {_HASH_BUCKETS - 1}) < (SELECT MAX(cut) FROM nf_quota)
+),
+nf AS (
+  SELECT r.seq
+  FROM (
+    SELECT c.seq, q.quota, ROW_NUMBER() OVER (PARTITION BY c.stratum ORDER BY c.h) AS rn
+    FROM nf_candidates c
+    JOIN nf_quota q ON q.stratum = c.stratum
+  ) r
+  WHERE r.rn <= r.quota
+)"""
+
+# Hàm dựng câu SQL non-fraud theo chiến lược sampling / strata
+def build_nonfraud_sql(sampling: str = "random", strata: str = "") -> str:
+    return build_feature_sql(
+        f"{SQL_WINDOW_FILTER} AND t.seq IN (SELECT seq FROM nf)",
+        ctes=build_nonfraud_sample_cte(sampling, strata),
+    )
+
+SQL_NONFRAUD = build_nonfraud_sql("random")
 
-SQL_FRAUD_FROM_TABLE = f"""
-WITH f AS (
+SQL_FRAUD_FROM_TABLE = build_feature_sql(
+    f"{SQL_WINDOW_FILTER} AND t.seq IN (SELECT seq FROM f)",
+    ctes="""f AS (
   SELECT fl.transaction_seq AS seq
   FROM fraud_labels fl
   JOIN transaction_info t ON t.seq = fl.transaction_seq
   WHERE fl.status IN ('CONFIRMED','CHARGEBACK')
     AND t.create_dt >= :start_dt AND t.create_dt < :end_dt
+)""",
 )
-{SQL_SKELETON}
-AND t.seq IN (SELECT seq FROM f)
-"""
+
+# Các hàm dựng (sql, params) cho từng tập dữ liệu huấn luyện: dùng chung cho pd.read_sql và fetch Arrow (data/arrow_io.py)
+def nonfraud_query(start_dt, end_dt, limit_nf: int,
+                   sampling: str = "random", strata: str = "", seed: int = 0) -> Tuple[str, dict]:
+    params = {"start_dt": start_dt, "end_dt": end_dt, "limit_nf": limit_nf}
+    if sampling == "hash":
+        params["seed"] = int(seed)
+    return build_nonfraud_sql(sampling, strata), params
+
+def fraud_table_query(start_dt, end_dt) -> Tuple[str, dict]:
+    return SQL_FRAUD_FROM_TABLE, {"start_dt": start_dt, "end_dt": end_dt}
+
+def fraud_seq_list_query(start_dt, end_dt, seq_list) -> Tuple[str, dict]:
+    values = ("VALUES " + ",".join(f"({int(s)})" for s in seq_list)) if seq_list else "SELECT NULL::bigint WHERE FALSE"
+    sql = build_feature_sql(f"{SQL_WINDOW_FILTER} AND t.seq IN (SELECT seq FROM f)", ctes=f"f(seq) AS ({values})")
+    return sql, {"start_dt": start_dt, "end_dt": end_dt}
 
 # Hàm lấy dữ liệu non-fraud
 def fetch_nonfraud(conn, start_dt, end_dt, limit_nf: int) -> pd.DataFrame:
-    return pd.read_sql(text(SQL_NONFRAUD), conn, params={"start_dt": start_dt, "end_dt": end_dt, "limit_nf": limit_nf})
+    sql, params = nonfraud_query(start_dt, end_dt, limit_nf)
+    return pd.read_sql(text(sql), conn, params=params)
 
 # Function to get fraud data from fraud_labels table
 def fetch_fraud_from_table(conn, start_dt, end_dt) -> pd.DataFrame:
-    return pd.read_sql(text(SQL_FRAUD_FROM_TABLE), conn, params={"start_dt": start_dt, "end_dt": end_dt})
+    sql, params = fraud_table_query(start_dt, end_dt)
+    return pd.read_sql(text(sql), conn, params=params)
 
 # Function to get fraud data from seq transaction list
 def fetch_fraud_from_seq_list(conn, start_dt, end_dt, seq_list):
     if not seq_list:
         return pd.DataFrame()
-    values = ",".join(f"({int(s)})" for s in seq_list)
-    sql = f"WITH f(seq) AS (VALUES {values})\n{SQL_SKELETON}\nAND t.seq IN (SELECT seq FROM f)"
-    return pd.read_sql(text(sql), conn, params={"start_dt": start_dt, "end_dt": end_dt})
+    sql, params = fraud_seq_list_query(start_dt, end_dt, seq_list)
+    return pd.read_sql(text(sql), conn, params=params)
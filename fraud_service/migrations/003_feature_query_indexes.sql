@@ -0,0 +1,51 @@
+-- migrations/003_feature_query_indexes.sql
+-- Index khuyến nghị cho build_feature_sql (data/sql.py): batch 15 phút (SQL_RECENT) và fetch training 6 tháng.
+-- Các bảng nguồn thuộc DB nghiệp vụ nên file này KHÔNG được ensure_tables() chạy tự động;
+-- chạy thủ công ngoài transaction (CONCURRENTLY), ví dụ: psql "$DB_URL" -f migrations/003_feature_query_indexes.sql
+
+-- lọc cửa sổ thời gian của batch / training (target CTE)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_transaction_info_create_dt
+  ON transaction_info (create_dt);
+
+-- velocity features: LATERAL range scan theo user trong 1 month, index-only nhờ INCLUDE
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_transaction_info_user_create_dt
+  ON transaction_info (user_seq, create_dt) INCLUDE (seq, deposit_amount);
+
+-- first_transaction_date (category = 3 đầu tiên của user)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_transaction_info_user_seq_cat3
+  ON transaction_info (user_seq, seq) INCLUDE (create_dt) WHERE category = 3;
+
+-- register_date (id_approval đầu tiên của user)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_id_approval_user_seq
+  ON id_approval (user_seq, seq) INCLUDE (update_dt);
+
+-- recheck_date (lần APPROVED gần nhất theo uid)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_idcard_recheck_uid_approved
+  ON idcard_recheck (uid, seq DESC) INCLUDE (approve_dt) WHERE status = 'APPROVED';
+
+-- face_pin_date (face pin active gần nhất)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_face_pin_user_active
+  ON face_pin (user_seq, seq DESC) INCLUDE (update_dt) WHERE active;
+
+-- autodebit_account (đăng ký thành công gần nhất)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_op_log_user_register_ok
+  ON op_log_user_register (user_seq_no, seq DESC) INCLUDE (account_number) WHERE rsp_code = 'A0000';
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_op_token_user_seq
+  ON op_token (user_seq);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_personal_identification_uid
+  ON personal_identification (uid);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_payment_info_transaction_seq
+  ON payment_info (transaction_seq);
+
+-- sender_name (point lookup theo từng giao dịch)
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_kibnet_account_issued_ukey
+  ON kibnet_account_issued (ukey);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_op_withdraw_transaction_seq
+  ON op_withdraw (transaction_seq);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_account_transfer_issued_oversea
+  ON account_transfer_issued (related_seq) WHERE remittance_type = 'OVERSEA_TRANSACTION';
@@ -0,0 +1,8 @@
+-- migrations/004_create_batch_checkpoint.sql
+-- High-water mark của batch job: giao dịch có seq > last_transaction_seq là chưa được chấm điểm
+CREATE TABLE IF NOT EXISTS fraud_batch_checkpoint (
+  job_name              TEXT PRIMARY KEY,
+  last_transaction_seq  BIGINT NOT NULL,
+  last_create_dt        TIMESTAMP,
+  updated_at            TIMESTAMP NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,4 @@
+-- migrations/005_auth_tokens_revoked_index.sql
+-- Index cho TokenCache.sync_revocations (app/auth.py): mỗi process API hỏi các token vừa bị thu hồi
+-- (revoked_at >= mốc lần sync trước) vài giây một lần để xoá khỏi cache jti.
+CREATE INDEX IF NOT EXISTS ix_auth_tokens_revoked_at ON auth_tokens (revoked_at);
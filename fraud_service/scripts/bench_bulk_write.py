@@ -0,0 +1,97 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
+import json
+import logging
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from app.batch_job import (
+    MIGRATION_PATH, upsert_scores, upsert_expl, _upsert_scores_rows, _upsert_expl_rows,
+)
+from utils.logging_utils import configure_logging
+
+LOGGER = logging.getLogger(__name__)
+
+# Hàm sinh dữ liệu scores/explanations giả lập (có cả transaction_seq trùng lặp như khi join nhân dòng)
+def make_frames(n_rows: int, seed: int):
+    rng = np.random.default_rng(seed)
+    seqs = rng.permutation(n_rows).astype("int64") + 1
+    seqs[: n_rows // 100] = seqs[n_rows // 100 : 2 * (n_rows // 100)]
+    scores = rng.random(n_rows)
+    decisions = np.where(scores >= 0.9, "BLOCK", np.where(scores >= 0.5, "REVIEW", "ALLOW"))
+    out = pd.DataFrame({"transaction_seq": seqs, "score": scores, "decision": decisions})
+    reasons = [json.dumps([{"feature": "deposit_amount", "value": float(s), "delta": float(s) / 2,
+                            "text": "Số tiền bất thường, \"cao\""}], ensure_ascii=False) for s in scores]
+    expl = pd.DataFrame({"id": seqs, "score": scores, "reasons_json": reasons})
+    return out, expl
+
+# Hàm ghi bằng writer đã chọn trong một transaction, trả về thời gian (giây)
+def run_writer(eng, schema, score_fn, expl_fn, out, expl):
+    with eng.begin() as conn:
+        conn.execute(text(f"SET LOCAL search_path TO {schema}"))
+        conn.execute(text("TRUNCATE fraud_scores, fraud_explanations"))
+    t0 = time.perf_counter()
+    with eng.begin() as conn:
+        conn.execute(text(f"SET LOCAL search_path TO {schema}"))
+        score_fn(conn, out, "bench-v1", 0.5, 0.9)
+        expl_fn(conn, expl, "bench-v1")
+    return time.perf_counter() - t0
+
+# Hàm đọc lại nội dung bảng (bỏ scored_at) để so sánh hai writer
+def table_snapshot(eng, schema):
+    with eng.connect() as conn:
+        conn.execute(text(f"SET search_path TO {schema}"))
+        scores = pd.read_sql(text(
+            "SELECT transaction_seq, model_version, score, decision, threshold_low, threshold_high "
+            "FROM fraud_scores ORDER BY transaction_seq"), conn)
+        expl = pd.read_sql(text(
+            "SELECT transaction_seq, model_version, reasons_json::text AS reasons_json "
+            "FROM fraud_explanations ORDER BY transaction_seq"), conn)
+    return scores, expl
+
+def main():
+    configure_logging()
+    ap = argparse.ArgumentParser(description="Benchmark: COPY-staged bulk upsert vs executemany upsert")
+    ap.add_argument("--db-url", required=True, help="SQLAlchemy URL (psycopg2) của Postgres local")
+    ap.add_argument("--schema", default="bench_bulk_write")
+    ap.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    ap.add_argument("--rowwise-max", type=int, default=1_000_000,
+                    help="Bỏ qua writer executemany khi số dòng lớn hơn ngưỡng này")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--keep", action="store_true", help="Giữ lại schema sau khi chạy")
+    args = ap.parse_args()
+
+    eng = create_engine(args.db_url)
+    with eng.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {args.schema}"))
+        conn.execute(text(f"SET LOCAL search_path TO {args.schema}"))
+        conn.execute(text(MIGRATION_PATH.read_text(encoding="utf-8")))
+
+    ok = True
+    try:
+        for n_rows in args.rows:
+            out, expl = make_frames(n_rows, args.seed)
+            t_bulk = run_writer(eng, args.schema, upsert_scores, upsert_expl, out, expl)
+            bulk_scores, bulk_expl = table_snapshot(eng, args.schema)
+            if n_rows > args.rowwise_max:
+                LOGGER.info("rows=%s | COPY bulk=%.2fs | executemany skipped", f"{n_rows:,}", t_bulk)
+                continue
+            t_rows = run_writer(eng, args.schema, _upsert_scores_rows, _upsert_expl_rows, out, expl)
+            row_scores, row_expl = table_snapshot(eng, args.schema)
+            same = bulk_scores.equals(row_scores) and bulk_expl.equals(row_expl)
+            ok = ok and same
+            LOGGER.info("rows=%s | executemany=%.2fs | COPY bulk=%.2fs | speedup=%.1fx | identical=%s",
+                        f"{n_rows:,}", t_rows, t_bulk, t_rows / max(t_bulk, 1e-9), same)
+    finally:
+        if not args.keep:
+            with eng.begin() as conn:
+                conn.execute(text(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE"))
+
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
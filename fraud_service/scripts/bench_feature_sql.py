@@ -0,0 +1,221 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
+import logging
+import statistics
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from data.sql import build_feature_sql, SQL_WINDOW_FILTER
+from utils.logging_utils import configure_logging
+
+LOGGER = logging.getLogger(__name__)
+INDEX_SQL_PATH = Path(__file__).resolve().parents[1] / "migrations" / "003_feature_query_indexes.sql"
+
+# Bản SQL cũ (6 subquery tương quan cho velocity features) dùng làm mốc so sánh
+LEGACY_SQL = r"""
+SELECT
+  t.seq AS transaction_seq,
+  u.seq AS user_seq,
+  t.create_dt,
+  t.deposit_amount,
+  t.receiving_country,
+  p.country_code,
+  p.id_type,
+  p.stay_qualify,
+  p.visa_expire_date,
+  u.name AS user_name,
+  COALESCE(
+    (SELECT deposit_name FROM kibnet_account_issued k WHERE ukey = t.seq::text),
+    (SELECT account_holder_name FROM op_withdraw o2 WHERE transaction_seq = t.seq),
+    (SELECT account_holder FROM account_transfer_issued
+     WHERE remittance_type = 'OVERSEA_TRANSACTION' AND related_seq = t.seq)
+  ) AS sender_name,
+  t.recipient_name,
+  pi.method AS payment_method,
+  (SELECT DISTINCT ON (user_seq_no) account_number
+     FROM op_log_user_register
+    WHERE rsp_code='A0000' AND user_seq_no=o.user_seq_no
+    ORDER BY user_seq_no, seq DESC) AS autodebit_account,
+  (SELECT DISTINCT ON (user_seq) update_dt::date
+     FROM id_approval
+    WHERE user_seq=u.seq
+    ORDER BY user_seq, seq) AS register_date,
+  (SELECT t2.create_dt::date
+     FROM transaction_info t2
+    WHERE t2.user_seq=u.seq AND t2.category=3
+    ORDER BY t2.seq LIMIT 1) AS first_transaction_date,
+  u.birth_date,
+  (SELECT approve_dt::date
+     FROM idcard_recheck
+    WHERE uid=p.uid AND status='APPROVED'
+    ORDER BY uid, seq DESC LIMIT 1) AS recheck_date,
+  u.invite_code,
+  (SELECT DISTINCT ON (user_seq) update_dt::date
+     FROM face_pin
+    WHERE user_seq=u.seq AND active
+    ORDER BY user_seq, seq DESC) AS face_pin_date,
+  (SELECT COUNT(*) FROM transaction_info
+    WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '24 hour') AS transaction_count_24hour,
+  (SELECT COALESCE(SUM(deposit_amount),0) FROM transaction_info
+    WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '24 hour') AS transaction_amount_24hour,
+  (SELECT COUNT(*) FROM transaction_info
+    WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '1 week') AS transaction_count_1week,
+  (SELECT COALESCE(SUM(deposit_amount),0) FROM transaction_info
+    WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '1 week') AS transaction_amount_1week,
+  (SELECT COUNT(*) FROM transaction_info
+    WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '1 month') AS transaction_count_1month,
+  (SELECT COALESCE(SUM(deposit_amount),0) FROM transaction_info
+    WHERE user_seq=u.seq AND seq<t.seq AND create_dt>t.create_dt - INTERVAL '1 month') AS transaction_amount_1month
+FROM transaction_info t
+JOIN user_info u ON u.seq=t.user_seq
+JOIN personal_identification p ON p.uid=u.uid
+LEFT JOIN payment_info pi ON pi.transaction_seq=t.seq
+LEFT JOIN op_token o ON o.user_seq=u.seq
+WHERE t.create_dt >= :start_dt AND t.create_dt < :end_dt
+"""
+
+# Schema tối thiểu (chỉ các cột mà câu feature SQL dùng)
+DDL = """
+CREATE TABLE user_info (seq BIGINT PRIMARY KEY, uid TEXT, name TEXT, birth_date DATE, invite_code TEXT);
+CREATE TABLE personal_identification (uid TEXT, country_code TEXT, id_type TEXT, stay_qualify TEXT, visa_expire_date DATE);
+CREATE TABLE transaction_info (seq BIGSERIAL PRIMARY KEY, user_seq BIGINT, create_dt TIMESTAMP, deposit_amount NUMERIC,
+                               receiving_country TEXT, recipient_name TEXT, category INT);
+CREATE TABLE payment_info (transaction_seq BIGINT, method TEXT);
+CREATE TABLE op_token (user_seq BIGINT, user_seq_no TEXT);
+CREATE TABLE op_log_user_register (seq BIGSERIAL PRIMARY KEY, user_seq_no TEXT, rsp_code TEXT, account_number TEXT);
+CREATE TABLE id_approval (seq BIGSERIAL PRIMARY KEY, user_seq BIGINT, update_dt TIMESTAMP);
+CREATE TABLE idcard_recheck (seq BIGSERIAL PRIMARY KEY, uid TEXT, status TEXT, approve_dt TIMESTAMP);
+CREATE TABLE face_pin (seq BIGSERIAL PRIMARY KEY, user_seq BIGINT, active BOOLEAN, update_dt TIMESTAMP);
+CREATE TABLE kibnet_account_issued (ukey TEXT, deposit_name TEXT);
+CREATE TABLE op_withdraw (transaction_seq BIGINT, account_holder_name TEXT);
+CREATE TABLE account_transfer_issued (related_seq BIGINT, remittance_type TEXT, account_holder TEXT);
+"""
+
+POPULATE = """
+SELECT setseed(:seed);
+INSERT INTO user_info
+SELECT g, 'uid' || g, 'USER ' || g, DATE '1970-01-01' + (random() * 15000)::int, 'INV' || (g % 97)
+  FROM generate_series(1, :users) g;
+INSERT INTO personal_identification
+SELECT 'uid' || g, (ARRAY['VN','PH','NP','KH','ID'])[1 + floor(random() * 5)::int],
+       (ARRAY['ARC','PASSPORT'])[1 + floor(random() * 2)::int],
+       (ARRAY['E-9','F-4','D-2','E-7'])[1 + floor(random() * 4)::int],
+       CAST(:end_dt AS date) + (random() * 900)::int
+  FROM generate_series(1, :users) g;
+INSERT INTO transaction_info (user_seq, create_dt, deposit_amount, receiving_country, recipient_name, category)
+SELECT 1 + floor(random() * :users)::int, ts, round((random() * 2000000)::numeric, 0),
+       (ARRAY['VN','PH','NP','KH','ID'])[1 + floor(random() * 5)::int], 'RECIPIENT ' || g,
+       CASE WHEN random() < 0.85 THEN 3 ELSE 1 END
+  FROM (SELECT g, :end_dt - random() * (:days * INTERVAL '1 day') AS ts
+          FROM generate_series(1, :txs) g ORDER BY ts) s;
+INSERT INTO payment_info
+SELECT seq, (ARRAY['AUTODEBIT','VIRTUAL_ACCOUNT','CARD'])[1 + floor(random() * 3)::int]
+  FROM transaction_info WHERE random() < 0.9;
+INSERT INTO op_token SELECT g, 'no' || g FROM generate_series(1, :users) g WHERE random() < 0.6;
+INSERT INTO op_log_user_register (user_seq_no, rsp_code, account_number)
+SELECT 'no' || (1 + floor(random() * :users)::int), CASE WHEN random() < 0.8 THEN 'A0000' ELSE 'E9999' END,
+       'ACC' || g
+  FROM generate_series(1, :users * 2) g;
+INSERT INTO id_approval (user_seq, update_dt)
+SELECT 1 + floor(random() * :users)::int, :end_dt - random() * INTERVAL '900 days'
+  FROM generate_series(1, :users * 2) g;
+INSERT INTO idcard_recheck (uid, status, approve_dt)
+SELECT 'uid' || (1 + floor(random() * :users)::int), CASE WHEN random() < 0.7 THEN 'APPROVED' ELSE 'REJECTED' END,
+       :end_dt - random() * INTERVAL '400 days'
+  FROM generate_series(1, :users) g;
+INSERT INTO face_pin (user_seq, active, update_dt)
+SELECT 1 + floor(random() * :users)::int, random() < 0.7, :end_dt - random() * INTERVAL '400 days'
+  FROM generate_series(1, :users * 2) g;
+INSERT INTO kibnet_account_issued SELECT seq::text, 'DEPOSIT ' || seq FROM transaction_info WHERE random() < 0.3;
+INSERT INTO op_withdraw SELECT seq, 'HOLDER ' || seq FROM transaction_info WHERE random() < 0.3;
+INSERT INTO account_transfer_issued
+SELECT seq, CASE WHEN random() < 0.8 THEN 'OVERSEA_TRANSACTION' ELSE 'DOMESTIC' END, 'ACCOUNT ' || seq
+  FROM transaction_info WHERE random() < 0.3;
+"""
+
+# Tạo schema tạm + dữ liệu tổng hợp
+def setup_schema(eng, args, end_dt):
+    with eng.begin() as conn:
+        conn.execute(text(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE"))
+        conn.execute(text(f"CREATE SCHEMA {args.schema}"))
+        conn.execute(text(f"SET search_path TO {args.schema}"))
+        conn.execute(text(DDL))
+        params = {"seed": args.seed, "users": args.users, "txs": args.txs, "days": args.days, "end_dt": end_dt}
+        for stmt in filter(str.strip, POPULATE.split(";")):
+            conn.execute(text(stmt), params)
+    if args.indexes:
+        statements = [s for s in INDEX_SQL_PATH.read_text(encoding="utf-8").split(";") if "CREATE" in s]
+        with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            conn.execute(text(f"SET search_path TO {args.schema}"))
+            for stmt in statements:
+                conn.execute(text(stmt))
+    with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text(f"SET search_path TO {args.schema}"))
+        conn.execute(text("ANALYZE"))
+
+# Chạy query repeat lần, trả về (DataFrame lần cuối, list thời gian giây)
+def time_query(eng, schema, sql, params, repeat):
+    timings, df = [], None
+    with eng.connect() as conn:
+        conn.execute(text(f"SET search_path TO {schema}"))
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            df = pd.read_sql(text(sql), conn, params=params)
+            timings.append(time.perf_counter() - t0)
+    return df, timings
+
+def _normalize(df: pd.DataFrame) -> pd.DataFrame:
+    return df.sort_values("transaction_seq", kind="stable").reset_index(drop=True)
+
+def main():
+    configure_logging()
+    ap = argparse.ArgumentParser(description="Benchmark: build_feature_sql vs legacy correlated-subquery SQL on a local Postgres")
+    ap.add_argument("--db-url", required=True, help="SQLAlchemy URL của Postgres local (dữ liệu tạo trong --schema riêng)")
+    ap.add_argument("--schema", default="bench_feature_sql")
+    ap.add_argument("--users", type=int, default=5000)
+    ap.add_argument("--txs", type=int, default=200000, help="Tổng số giao dịch tổng hợp")
+    ap.add_argument("--days", type=int, default=180, help="Số ngày dữ liệu lịch sử")
+    ap.add_argument("--window-hours", type=float, nargs="+", default=[0.25, 24.0],
+                    help="Các cửa sổ cần đo (vd. 0.25 = batch 15 phút)")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--seed", type=float, default=0.42)
+    ap.add_argument("--no-indexes", dest="indexes", action="store_false",
+                    help="Không tạo index từ migrations/003_feature_query_indexes.sql")
+    ap.add_argument("--keep", action="store_true", help="Giữ lại schema sau khi chạy")
+    args = ap.parse_args()
+
+    eng = create_engine(args.db_url)
+    end_dt = datetime(2025, 1, 1)
+    LOGGER.info("Populating schema %s: users=%s txs=%s days=%s indexes=%s",
+                args.schema, args.users, args.txs, args.days, args.indexes)
+    setup_schema(eng, args, end_dt)
+
+    new_sql = build_feature_sql(SQL_WINDOW_FILTER)
+    ok = True
+    try:
+        for hours in args.window_hours:
+            params = {"start_dt": end_dt - timedelta(hours=hours), "end_dt": end_dt}
+            old_df, old_t = time_query(eng, args.schema, LEGACY_SQL, params, args.repeat)
+            new_df, new_t = time_query(eng, args.schema, new_sql, params, args.repeat)
+            try:
+                pd.testing.assert_frame_equal(_normalize(old_df), _normalize(new_df), check_dtype=False)
+                same = True
+            except AssertionError as exc:
+                same, ok = False, False
+                LOGGER.error("Result mismatch for window %sh: %s", hours, exc)
+            LOGGER.info("window=%sh rows=%s | legacy median=%.3fs | set-based median=%.3fs | speedup=%.1fx | identical=%s",
+                        hours, len(new_df), statistics.median(old_t), statistics.median(new_t),
+                        statistics.median(old_t) / max(statistics.median(new_t), 1e-9), same)
+    finally:
+        if not args.keep:
+            with eng.begin() as conn:
+                conn.execute(text(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE"))
+
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
+import logging
+import statistics
+import time
+from datetime import datetime, timedelta
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from data.sql import build_nonfraud_sample_cte, build_nonfraud_sql
+from scripts.bench_feature_sql import setup_schema
+from utils.logging_utils import configure_logging
+
+LOGGER = logging.getLogger(__name__)
+
+# (sampling, strata) được đo; random là mốc so sánh
+VARIANTS = [("random", ""), ("hash", ""), ("hash", "month"), ("hash", "receiving_country")]
+
+POPULATION_SQL = """
+SELECT t.seq, date_trunc('month', t.create_dt) AS month, t.create_dt::date AS day,
+       COALESCE(t.receiving_country, '') AS receiving_country, t.deposit_amount::float8 AS deposit_amount
+FROM transaction_info t
+WHERE t.create_dt >= :start_dt AND t.create_dt < :end_dt
+"""
+
+# Hàm chạy CTE chọn mẫu (chỉ phần nf, không join feature) repeat lần; trả về (tập seq lần cuối, thời gian giây)
+def time_sample(eng, schema, sampling, strata, params, repeat, random_seed):
+    sql = f"WITH {build_nonfraud_sample_cte(sampling, strata)} SELECT seq FROM nf"
+    timings, seqs = [], None
+    with eng.connect() as conn:
+        conn.execute(text(f"SET search_path TO {schema}"))
+        for _ in range(repeat):
+            if sampling == "random":
+                conn.execute(text("SELECT setseed(:s)"), {"s": random_seed})
+            t0 = time.perf_counter()
+            seqs = [r[0] for r in conn.execute(text(sql), params)]
+            timings.append(time.perf_counter() - t0)
+    return np.array(seqs, dtype=np.int64), timings
+
+# Hàm đo cả câu feature SQL non-fraud (CTE chọn mẫu + join feature) để thấy phần tiết kiệm trên toàn query
+def time_full_query(eng, schema, sampling, strata, params, repeat):
+    sql = build_nonfraud_sql(sampling, strata)
+    timings = []
+    with eng.connect() as conn:
+        conn.execute(text(f"SET search_path TO {schema}"))
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            conn.execute(text(sql), params).fetchall()
+            timings.append(time.perf_counter() - t0)
+    return timings
+
+# Khoảng cách total variation giữa hai phân phối rời rạc
+def _tvd(sample: pd.Series, population: pd.Series) -> float:
+    p = sample.value_counts(normalize=True)
+    q = population.value_counts(normalize=True)
+    return float(0.5 * p.sub(q, fill_value=0.0).abs().sum())
+
+# Thống kê Kolmogorov-Smirnov hai mẫu (khoảng cách lớn nhất giữa hai ECDF)
+def _ks(sample: np.ndarray, population: np.ndarray) -> float:
+    a, b = np.sort(sample), np.sort(population)
+    grid = np.union1d(a, b)
+    return float(np.max(np.abs(np.searchsorted(a, grid, side="right") / len(a)
+                               - np.searchsorted(b, grid, side="right") / len(b))))
+
+# Các khoảng cách phân phối của mẫu so với toàn bộ giao dịch trong cửa sổ
+def distribution_distances(sample: pd.DataFrame, population: pd.DataFrame) -> dict:
+    return {
+        "month_tvd": _tvd(sample["month"], population["month"]),
+        "day_tvd": _tvd(sample["day"], population["day"]),
+        "country_tvd": _tvd(sample["receiving_country"], population["receiving_country"]),
+        "amount_ks": _ks(sample["deposit_amount"].to_numpy(), population["deposit_amount"].to_numpy()),
+    }
+
+def main():
+    configure_logging()
+    ap = argparse.ArgumentParser(description="Benchmark + distribution parity: hash sampling vs ORDER BY random() for SQL_NONFRAUD")
+    ap.add_argument("--db-url", required=True, help="SQLAlchemy URL của Postgres local (dữ liệu tạo trong --schema riêng)")
+    ap.add_argument("--schema", default="bench_nonfraud_sampling")
+    ap.add_argument("--users", type=int, default=5000)
+    ap.add_argument("--txs", type=int, default=1000000, help="Tổng số giao dịch tổng hợp")
+    ap.add_argument("--days", type=int, default=730, help="Số ngày dữ liệu lịch sử (cửa sổ chỉ là một phần bảng)")
+    ap.add_argument("--window-months", type=int, default=6)
+    ap.add_argument("--limit", type=int, default=30000, help="LIMIT_NONFRAUD")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--seed", type=float, default=0.42, help="Seed sinh dữ liệu (setseed)")
+    ap.add_argument("--sample-seed", type=int, default=0, help="NONFRAUD_SAMPLE_SEED cho hash sampling")
+    ap.add_argument("--tol", type=float, default=0.02,
+                    help="Cho phép khoảng cách phân phối vượt mốc random tối đa tol (tuyệt đối)")
+    ap.add_argument("--full", action="store_true", help="Đo thêm cả câu feature SQL non-fraud (chậm)")
+    ap.add_argument("--no-indexes", dest="indexes", action="store_false",
+                    help="Không tạo index từ migrations/003_feature_query_indexes.sql")
+    ap.add_argument("--keep", action="store_true", help="Giữ lại schema sau khi chạy")
+    args = ap.parse_args()
+
+    eng = create_engine(args.db_url)
+    end_dt = datetime(2025, 1, 1)
+    LOGGER.info("Populating schema %s: users=%s txs=%s days=%s indexes=%s",
+                args.schema, args.users, args.txs, args.days, args.indexes)
+    setup_schema(eng, args, end_dt)
+    with eng.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        # Như bảng production đã được autovacuum: visibility map cho phép index-only scan khi đếm cửa sổ
+        conn.execute(text(f"VACUUM ANALYZE {args.schema}.transaction_info"))
+
+    params = {"start_dt": end_dt - timedelta(days=30 * args.window_months), "end_dt": end_dt,
+              "limit_nf": args.limit, "seed": args.sample_seed}
+    ok = True
+    try:
+        with eng.connect() as conn:
+            conn.execute(text(f"SET search_path TO {args.schema}"))
+            population = pd.read_sql(text(POPULATION_SQL), conn, params=params).set_index("seq")
+        LOGGER.info("Window rows=%s limit=%s", f"{len(population):,}", f"{args.limit:,}")
+
+        results = {}
+        for sampling, strata in VARIANTS:
+            name = f"{sampling}/{strata or '-'}"
+            seqs, timings = time_sample(eng, args.schema, sampling, strata, params, args.repeat, args.seed)
+            sample = population.loc[seqs]
+            distances = distribution_distances(sample, population)
+            results[name] = distances
+            line = (f"{name:<24} rows={len(seqs):>7,} unique={len(np.unique(seqs)) == len(seqs)} "
+                    f"sample median={statistics.median(timings):.3f}s | "
+                    + " ".join(f"{k}={v:.4f}" for k, v in distances.items()))
+            if args.full:
+                full = time_full_query(eng, args.schema, sampling, strata, params, args.repeat)
+                line += f" | full query median={statistics.median(full):.3f}s"
+            LOGGER.info(line)
+
+            if abs(len(seqs) - min(args.limit, len(population))) > max(1, 0.01 * args.limit):
+                ok = False
+                LOGGER.error("%s: sample size %s is not ~limit %s", name, len(seqs), args.limit)
+            if sampling == "hash":
+                again, _ = time_sample(eng, args.schema, sampling, strata, params, 1, args.seed)
+                other, _ = time_sample(eng, args.schema, sampling, strata, {**params, "seed": args.sample_seed + 1}, 1, args.seed)
+                reproducible = np.array_equal(np.sort(seqs), np.sort(again))
+                seed_sensitive = not np.array_equal(np.sort(seqs), np.sort(other))
+                LOGGER.info("%-24s reproducible with same seed=%s | differs with another seed=%s",
+                            name, reproducible, seed_sensitive)
+                ok &= reproducible and seed_sensitive
+                if strata:
+                    share = sample[strata].value_counts(normalize=True)
+                    target = population[strata].value_counts(normalize=True)
+                    LOGGER.info("%-24s max stratum share error=%.5f", name, float(share.sub(target, fill_value=0).abs().max()))
+
+        baseline = results["random/-"]
+        for name, distances in results.items():
+            worse = {k: v for k, v in distances.items() if v > baseline[k] + args.tol}
+            if worse:
+                ok = False
+                LOGGER.error("%s: distribution further from the window than ORDER BY random(): %s", name, worse)
+        LOGGER.info("Distribution parity vs ORDER BY random() (tol=%.3f): %s", args.tol, "OK" if ok else "FAILED")
+    finally:
+        if not args.keep:
+            with eng.begin() as conn:
+                conn.execute(text(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE"))
+
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
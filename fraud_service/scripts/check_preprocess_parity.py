@@ -0,0 +1,59 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
+import logging
+import time
+import numpy as np
+import pandas as pd
+
+from app.preprocess import prepare_features_for_inference, CompiledPreprocessor
+from data.arrow_io import read_frame
+from utils.artifact_loaders import load_encoders_flexible, load_medians_and_schema_flexible
+from utils.logging_utils import configure_logging
+
+LOGGER = logging.getLogger(__name__)
+MAYBE_CATS = ["receiving_country","country_code","id_type","stay_qualify","payment_method", "payment_method_filled"]
+
+# So sánh CompiledPreprocessor với pipeline pandas trên holdout_raw (.parquet hoặc .csv)
+def main():
+    configure_logging()
+    ap = argparse.ArgumentParser(description="Parity check: CompiledPreprocessor vs prepare_features_for_inference")
+    ap.add_argument("--artifacts-dir", required=True, help="Thư mục chứa encoders.pkl và medians.json")
+    ap.add_argument("--holdout", required=True, help="Đường dẫn holdout_raw.parquet (hoặc holdout_raw.csv của run cũ)")
+    ap.add_argument("--repeat", type=int, default=200, help="Số lần lặp khi đo latency 1 giao dịch")
+    args = ap.parse_args()
+
+    encoders = load_encoders_flexible(args.artifacts_dir)
+    feat_cols, medians, clipping_bounds = load_medians_and_schema_flexible(args.artifacts_dir)
+
+    raw = read_frame(args.holdout).drop(columns=["is_fraud"], errors="ignore")
+    # Giống payload JSON: giá trị thiếu là None chứ không phải NaN
+    records = raw.astype(object).where(raw.notna(), None).to_dict(orient="records")
+
+    compiled = CompiledPreprocessor(feat_cols, encoders, medians, clipping_bounds)
+    expected = prepare_features_for_inference(
+        pd.DataFrame(records), feat_cols, encoders, medians, MAYBE_CATS, clipping_bounds
+    ).to_numpy(dtype=float).astype(np.float32)
+    got = compiled.transform(records)
+
+    diff = ~np.isclose(expected, got, rtol=0, atol=0, equal_nan=True)
+    bad_cols = sorted({feat_cols[j] for j in np.where(diff)[1]})
+    LOGGER.info("Rows=%s Features=%s Mismatched cells=%s", len(records), len(feat_cols), int(diff.sum()))
+    if bad_cols:
+        LOGGER.error("Mismatched columns: %s", bad_cols)
+
+    one = records[:1]
+    t0 = time.perf_counter()
+    for _ in range(args.repeat):
+        prepare_features_for_inference(pd.DataFrame(one), feat_cols, encoders, medians, MAYBE_CATS, clipping_bounds)
+    t_pandas = (time.perf_counter() - t0) / args.repeat
+    t0 = time.perf_counter()
+    for _ in range(args.repeat):
+        compiled.transform(one)
+    t_compiled = (time.perf_counter() - t0) / args.repeat
+    LOGGER.info("Single-transaction latency: pandas=%.3f ms | compiled=%.3f ms", t_pandas * 1e3, t_compiled * 1e3)
+
+    sys.exit(1 if bad_cols else 0)
+
+if __name__ == "__main__":
+    main()
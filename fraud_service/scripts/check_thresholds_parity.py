@@ -0,0 +1,70 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
+import logging
+import time
+import numpy as np
+from sklearn.metrics import confusion_matrix
+
+from utils.common import compute_thresholds, roc_sweep, threshold_for_fpr
+from utils.logging_utils import configure_logging
+
+LOGGER = logging.getLogger(__name__)
+
+# Bản cũ của compute_thresholds (vòng lặp confusion_matrix trên từng score), giữ làm chuẩn so sánh
+def _reference_fpr_cap(y_true_bin, scores, fpr_cap):
+    for t in sorted(np.unique(scores)):
+        yp = (scores >= t).astype(int)
+        tn, fp, fn, tp = confusion_matrix(y_true_bin, yp).ravel()
+        fpr = fp / (fp + tn + 1e-12)
+        if fpr <= fpr_cap:
+            return float(t)
+    return None
+
+# Hàm sinh một bộ (nhãn, điểm) ngẫu nhiên: nhiều mức trùng điểm, tỉ lệ fraud lệch như dữ liệu thật
+def _random_case(rng):
+    n = int(rng.integers(2, 400))
+    y = (rng.random(n) < rng.choice([0.01, 0.05, 0.3, 0.5])).astype(int)
+    y[:2] = [1, 0]  # luôn đủ hai lớp (vòng lặp cũ cần confusion_matrix 2x2)
+    decimals = int(rng.choice([1, 2, 3, 6]))  # làm tròn để có nhiều score bằng nhau
+    scores = np.round(np.clip(rng.normal(0.3 + 0.4 * y, 0.2), 0, 1), decimals)
+    return y, scores
+
+# Kiểm tra tính chất: bản quét ROC vector hoá chọn đúng ngưỡng như vòng lặp cũ với mọi fpr_cap
+def main():
+    configure_logging()
+    ap = argparse.ArgumentParser(description="Property check: roc_sweep thresholds vs the confusion_matrix loop")
+    ap.add_argument("--trials", type=int, default=500)
+    ap.add_argument("--bench-rows", type=int, default=5000, help="Số dòng holdout giả lập khi đo thời gian")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    failures = 0
+    for i in range(args.trials):
+        y, scores = _random_case(rng)
+        roc = roc_sweep(y, scores)
+        caps = [0.0, 1.0, *rng.random(3), *roc["fpr"].sample(min(3, len(roc)), random_state=i)]
+        for cap in caps:
+            expected = _reference_fpr_cap(y, scores, cap)
+            got = threshold_for_fpr(roc, cap)
+            if expected != got:
+                failures += 1
+                LOGGER.error("Trial %s cap=%r: expected %r, got %r", i, cap, expected, got)
+    LOGGER.info("Trials=%s Mismatches=%s", args.trials, failures)
+
+    y = (rng.random(args.bench_rows) < 0.02).astype(int)
+    scores = np.round(np.clip(rng.normal(0.3 + 0.4 * y, 0.2), 0, 1), 4)
+    t0 = time.perf_counter()
+    expected = _reference_fpr_cap(y, scores, 0.005)
+    t_loop = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    got = compute_thresholds(y, scores, fpr_cap=0.005)["th_fpr_cap"]
+    t_sweep = time.perf_counter() - t0
+    LOGGER.info("Rows=%s unique scores=%s: loop=%.3fs (th=%s) | compute_thresholds=%.4fs (th=%s)",
+                args.bench_rows, len(np.unique(scores)), t_loop, expected, t_sweep, got)
+
+    sys.exit(1 if failures or expected != got else 0)
+
+if __name__ == "__main__":
+    main()
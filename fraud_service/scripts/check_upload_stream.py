@@ -0,0 +1,76 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
+import json
+import logging
+
+import pandas as pd
+from fastapi.testclient import TestClient
+
+from scripts.stress_score_reload import make_transactions
+from utils.logging_utils import configure_logging
+
+LOGGER = logging.getLogger(__name__)
+
+# Kiểm tra end-to-end /score/upload/stream qua TestClient (import app.api nạp model như service thật):
+# - file nhiều chunk (và lớn hơn ngưỡng RAM của bản spooled) được chấm hết, dòng cuối là summary
+# - kết quả từng giao dịch trùng với /score/upload trên cùng file
+# - CSV rỗng / thiếu cột vẫn trả 400 trước khi stream bắt đầu
+# Thoát với mã 1 nếu vi phạm.
+
+
+# Hàm đọc response NDJSON thành (danh sách kết quả, dòng cuối)
+def parse_ndjson(text: str):
+    lines = [json.loads(line) for line in text.splitlines() if line.strip()]
+    return lines[:-1], (lines[-1] if lines else {})
+
+
+def main():
+    configure_logging()
+    ap = argparse.ArgumentParser(description="Check /score/upload/stream end to end through TestClient")
+    ap.add_argument("--rows", type=int, default=5000)
+    ap.add_argument("--chunk-rows", type=int, default=700, help="chunk_rows của request (nhỏ hơn --rows)")
+    ap.add_argument("--csv", default=None, help="CSV thô cùng định dạng /score/upload (mặc định: giao dịch giả lập)")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    from app import api
+    api.app.dependency_overrides[api.require_active_user] = lambda: None
+
+    content = pd.DataFrame(make_transactions(args.rows, args.seed, args.csv)).to_csv(index=False).encode("utf-8")
+    LOGGER.info("Upload: %s rows, %.2f MB, chunk_rows=%s (spool RAM limit %.2f MB)", args.rows,
+                len(content) / 2**20, args.chunk_rows, api.UPLOAD_SPOOL_MAX_BYTES / 2**20)
+    ok = True
+    with TestClient(api.app) as client:
+        files = {"file": ("upload.csv", content, "text/csv")}
+        resp = client.post("/score/upload/stream", files=files,
+                           params={"chunk_rows": args.chunk_rows, "top_k": 3})
+        results, last = parse_ndjson(resp.text)
+        LOGGER.info("stream: status=%s results=%s last=%s", resp.status_code, len(results), last)
+        if resp.status_code != 200 or "summary" not in last or last["summary"]["count"] != args.rows \
+                or len(results) != args.rows:
+            ok = False
+            LOGGER.error("Stream did not score every row: status=%s results=%s last=%s",
+                         resp.status_code, len(results), last)
+
+        full = client.post("/score/upload", files=files, params={"top_k": 3})
+        expected = {r["transaction_seq"]: r for r in full.json().get("results", [])} if full.status_code == 200 else {}
+        mismatched = [r["transaction_seq"] for r in results
+                      if expected.get(r["transaction_seq"], {}).get("score") != r.get("score")
+                      or expected.get(r["transaction_seq"], {}).get("decision") != r.get("decision")]
+        LOGGER.info("stream vs /score/upload: %s/%s rows differ", len(mismatched), len(results))
+        if full.status_code != 200 or mismatched:
+            ok = False
+            LOGGER.error("Stream results differ from /score/upload (status=%s, first seqs=%s)",
+                         full.status_code, mismatched[:5])
+
+        for name, bad in (("empty", b""), ("missing column", b"deposit_amount\n1000\n")):
+            resp = client.post("/score/upload/stream", files={"file": ("bad.csv", bad, "text/csv")})
+            LOGGER.info("%s CSV: status=%s %s", name, resp.status_code, resp.text[:120])
+            ok &= resp.status_code == 400
+
+    LOGGER.info("Upload stream check: %s", "OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
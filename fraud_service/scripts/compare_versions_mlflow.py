@@ -14,6 +14,7 @@ from utils.azure import (
 )
 
 from app.preprocess import prepare_features_for_inference
+from data.arrow_io import read_frame
 from utils.artifact_loaders import load_encoders_flexible, load_medians_and_schema_flexible
 import shutil
 
@@ -97,8 +98,12 @@ def _load_manifest_and_holdout(client: MlflowClient, run_id: str):
     man_path = _download_artifact_file(client, run_id, "artifacts/manifest.json")
     with open(man_path, "r", encoding="utf-8") as f:
         manifest = json.load(f)
-    holdout_path = _download_artifact_file(client, run_id, "artifacts/holdout_raw.csv")
-    holdout_raw = pd.read_csv(holdout_path)
+    # Run mới lưu holdout dạng Parquet (nhỏ, giữ kiểu cột); run cũ chỉ có holdout_raw.csv
+    try:
+        holdout_path = _download_artifact_file(client, run_id, "artifacts/holdout_raw.parquet")
+    except Exception:
+        holdout_path = _download_artifact_file(client, run_id, "artifacts/holdout_raw.csv")
+    holdout_raw = read_frame(holdout_path)
     return manifest, holdout_raw
 
 def _cleanup_temp_dirs(temp_dirs: list[str]):
@@ -71,6 +71,15 @@ class Settings:
     TEST_RATIO: float = _get_float("TEST_RATIO", 0.0)
     WINDOW_MONTHS: int = _get_int("WINDOW_MONTHS", 1)
     LIMIT_NONFRAUD: int = _get_int("LIMIT_NONFRAUD", 0)
+    FETCH_CHUNK_ROWS: int = _get_int("FETCH_CHUNK_ROWS", 50000)
+    NONFRAUD_SAMPLING: str = _get_str("NONFRAUD_SAMPLING", "hash")
+    NONFRAUD_SAMPLE_STRATA: str = _get_str("NONFRAUD_SAMPLE_STRATA", "")
+    NONFRAUD_SAMPLE_SEED: int = _get_int("NONFRAUD_SAMPLE_SEED", 0)
+    TRAIN_NUM_THREADS: int = _get_int("TRAIN_NUM_THREADS", 0)
+    TRAIN_NUM_TREES: int = _get_int("TRAIN_NUM_TREES", 500)
+    TRAIN_MAX_DEPTH: int = _get_int("TRAIN_MAX_DEPTH", 16)
+    TRAIN_COMPUTE_OOB: bool = _get_bool("TRAIN_COMPUTE_OOB", True)
+    TRAIN_FE_WORKERS: int = _get_int("TRAIN_FE_WORKERS", 1)
     USE_FRAUD_TABLE: bool = _get_bool("USE_FRAUD_TABLE", False)
     NONFRAUD_CSV_NAME_USE: str = _get_str("NONFRAUD_CSV_NAME_USE", "")
     FRAUD_CSV_NAME_USE: str = _get_str("FRAUD_CSV_NAME_USE", "")
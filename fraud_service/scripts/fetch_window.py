@@ -2,10 +2,37 @@ import os
 import logging
 from datetime import datetime, timedelta, timezone
 import pandas as pd
-from sqlalchemy import create_engine
-from data.sql import fetch_nonfraud, fetch_fraud_from_table, fetch_fraud_from_seq_list
+from sqlalchemy import create_engine, text
+from data.sql import nonfraud_query, fraud_table_query, fraud_seq_list_query
+from data.arrow_io import fetch_arrow, is_csv_path, stream_arrow, write_parquet_by_month
+from scripts.config import settings
 LOGGER = logging.getLogger(__name__)
 
+# Hàm ghi một tập dữ liệu: đường dẫn .csv giữ định dạng cũ, còn lại là thư mục Parquet partition theo tháng.
+# chunk_rows > 0: đọc qua server-side cursor và ghi dần từng khối (bộ nhớ đỉnh ~ chunk_rows dòng);
+# chunk_rows = 0: đọc toàn bộ kết quả vào bộ nhớ rồi mới ghi.
+def _write_output(conn, query, out_path: str, chunk_rows: int = 0) -> int:
+    sql, params = query
+    if is_csv_path(out_path):
+        if chunk_rows <= 0:
+            df = pd.read_sql(text(sql), conn, params=params)
+            df.to_csv(out_path, index=False)
+            return len(df)
+        n = 0
+        stream_conn = conn.execution_options(stream_results=True, max_row_buffer=chunk_rows)
+        for i, chunk in enumerate(pd.read_sql(text(sql), stream_conn, params=params, chunksize=chunk_rows)):
+            chunk.to_csv(out_path, index=False, mode="w" if i == 0 else "a", header=i == 0)
+            n += len(chunk)
+        return n
+    if chunk_rows <= 0:
+        table = fetch_arrow(conn, sql, params)
+        schema, batches = table.schema, table.to_batches()
+    else:
+        schema, batches = stream_arrow(conn, sql, params, chunk_rows)
+    n, months = write_parquet_by_month(batches, schema, out_path)
+    LOGGER.info("Wrote %s rows to %s (months: %s)", f"{n:,}", out_path, ", ".join(months) or "-")
+    return n
+
 def fetch_data_window(
     db_url: str,
     window_months: int,
@@ -14,25 +41,29 @@ def fetch_data_window(
     fraud_seqs_csv: str,
     out_nonfraud: str,
     out_fraud: str,
-    end_date: str = None
+    end_date: str = None,
+    chunk_rows: int = settings.FETCH_CHUNK_ROWS,
+    sampling: str = settings.NONFRAUD_SAMPLING,
+    strata: str = settings.NONFRAUD_SAMPLE_STRATA,
+    sample_seed: int = settings.NONFRAUD_SAMPLE_SEED,
 ):
     tz = timezone.utc
-    end_dt = (datetime.strptime(end_date, "%Y-%m-%d").replace(tzinfo=tz) 
+    end_dt = (datetime.strptime(end_date, "%Y-%m-%d").replace(tzinfo=tz)
               if end_date else datetime.now(tz))
     start_dt = end_dt - timedelta(days=30*window_months)
     LOGGER.info(f"Fetching data from {start_dt.date()} to {end_dt.date()}")
+    LOGGER.info("Non-fraud sampling: %s (strata=%s, seed=%s)", sampling, strata or "-", sample_seed)
 
-    eng = create_engine(db_url)
-    with eng.begin() as conn: 
-        nf = fetch_nonfraud(conn, start_dt, end_dt, limit_nonfraud)
-        if use_fraud_table:
-            fr = fetch_fraud_from_table(conn, start_dt, end_dt)
-        else:
-            if not fraud_seqs_csv or not os.path.exists(fraud_seqs_csv):
-                raise FileNotFoundError(f"Provide --fraud-seqs-csv when --use-fraud-table is false. Path: {fraud_seqs_csv}")
-            seqs = pd.read_csv(fraud_seqs_csv)["seq"].dropna().astype(int).unique().tolist()
-            fr = fetch_fraud_from_seq_list(conn, start_dt, end_dt, seqs)
+    if use_fraud_table:
+        fraud_query = fraud_table_query(start_dt, end_dt)
+    else:
+        if not fraud_seqs_csv or not os.path.exists(fraud_seqs_csv):
+            raise FileNotFoundError(f"Provide --fraud-seqs-csv when --use-fraud-table is false. Path: {fraud_seqs_csv}")
+        seqs = pd.read_csv(fraud_seqs_csv)["seq"].dropna().astype(int).unique().tolist()
+        fraud_query = fraud_seq_list_query(start_dt, end_dt, seqs)
 
-    nf.to_csv(out_nonfraud, index=False)
-    fr.to_csv(out_fraud, index=False)
-    LOGGER.info("Wrote %s (%s) and %s (%s)", out_nonfraud, f"{len(nf):,}", out_fraud, f"{len(fr):,}")
+    eng = create_engine(db_url)
+    with eng.begin() as conn:
+        n_nf = _write_output(conn, nonfraud_query(start_dt, end_dt, limit_nonfraud, sampling, strata, sample_seed), out_nonfraud, chunk_rows)
+        n_fr = _write_output(conn, fraud_query, out_fraud, chunk_rows)
+    LOGGER.info("Wrote %s (%s) and %s (%s)", out_nonfraud, f"{n_nf:,}", out_fraud, f"{n_fr:,}")
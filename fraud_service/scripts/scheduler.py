@@ -1,9 +1,9 @@
 import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
 import logging
-import os
 import signal
 import subprocess
-import sys
 import time
 from pathlib import Path
 from utils.logging_utils import configure_logging
@@ -16,6 +16,8 @@ PROJECT_ROOT = Path(__file__).resolve().parent.parent
 PYTHON_BIN = os.getenv("PYTHON_BIN", sys.executable)
 BATCH_INTERVAL_SECONDS = int(os.getenv("BATCH_INTERVAL_SECONDS", "900"))# 15 phút
 RETRAIN_EVERY_N_BATCHES = int(os.getenv("RETRAIN_EVERY_N_BATCHES", "672"))# khoảng 7 ngày nếu chạy mỗi 15 phút
+# worker: chạy batch trong process (model + engine nạp một lần) | subprocess: mỗi chu kỳ một interpreter mới
+SCHEDULER_MODE = os.getenv("SCHEDULER_MODE", "worker")
 
 _should_exit = False
 
@@ -45,32 +47,61 @@ def _run_python_script(label: str, relative_path: str) -> int:
     return result.returncode
 
 
+def _make_batch_runner(mode: str):
+    """Trả về hàm chạy một chu kỳ batch và hàm dọn dẹp tương ứng với mode."""
+    if mode == "subprocess":
+        return (lambda: _run_python_script("batch job", "app/batch_job.py")), (lambda: None)
+
+    from app.batch_job import BatchWorker
+
+    worker = BatchWorker()
+
+    def run_cycle() -> int:
+        try:
+            worker.run_cycle(should_stop=lambda: _should_exit)
+            return 0
+        except Exception:
+            logging.exception("Batch cycle failed")
+            return 1
+
+    return run_cycle, worker.close
+
+
 def main() -> None:
+    ap = argparse.ArgumentParser(description="Run batch scoring on a fixed cadence and retrain periodically")
+    ap.add_argument("--mode", choices=["worker", "subprocess"], default=SCHEDULER_MODE)
+    args = ap.parse_args()
+
     logging.info(
-        "Scheduler starting: batch every %ss, retrain every %s batches",
+        "Scheduler starting (%s mode): batch every %ss, retrain every %s batches",
+        args.mode,
         BATCH_INTERVAL_SECONDS,
         RETRAIN_EVERY_N_BATCHES,
     )
+    run_batch, close = _make_batch_runner(args.mode)
 
     batch_count = 0
-    while not _should_exit:
-        batch_count += 1
-        loop_started = time.monotonic()
-
-        _run_python_script("batch job", "app/batch_job.py")
-
-        if batch_count % RETRAIN_EVERY_N_BATCHES == 0:
-            _run_python_script("retrain rolling (MLflow)", "scripts/retrain_rolling_mlflow.py")
-
-        elapsed = time.monotonic() - loop_started
-        sleep_seconds = max(0.0, BATCH_INTERVAL_SECONDS - elapsed)
-        logging.info("Loop done in %.2fs; sleeping %.2fs", elapsed, sleep_seconds)
-
-        slept = 0.0
-        while slept < sleep_seconds and not _should_exit:
-            interval = min(1.0, sleep_seconds - slept)
-            time.sleep(interval)
-            slept += interval
+    try:
+        while not _should_exit:
+            batch_count += 1
+            loop_started = time.monotonic()
+
+            run_batch()
+
+            if batch_count % RETRAIN_EVERY_N_BATCHES == 0 and not _should_exit:
+                _run_python_script("retrain rolling (MLflow)", "scripts/retrain_rolling_mlflow.py")
+
+            elapsed = time.monotonic() - loop_started
+            sleep_seconds = max(0.0, BATCH_INTERVAL_SECONDS - elapsed)
+            logging.info("Loop done in %.2fs; sleeping %.2fs", elapsed, sleep_seconds)
+
+            slept = 0.0
+            while slept < sleep_seconds and not _should_exit:
+                interval = min(1.0, sleep_seconds - slept)
+                time.sleep(interval)
+                slept += interval
+    finally:
+        close()
 
     logging.info("Scheduler received shutdown signal; exiting.")
 
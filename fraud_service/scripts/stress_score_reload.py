@@ -0,0 +1,179 @@
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import argparse
+import json
+import logging
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from utils.logging_utils import configure_logging
+
+LOGGER = logging.getLogger(__name__)
+
+# Stress test đồng thời cho /score trên một service đang chạy: bắn hàng nghìn request song song trong khi
+# gọi /reload, rồi kiểm tra các bảo đảm của ScoringService / ScoringBundle:
+# - mỗi model_version chỉ đi kèm đúng một cặp (threshold_low, threshold_high): không trộn model mới + ngưỡng cũ
+# - cùng model_version + cùng giao dịch luôn cho cùng score / decision: predict song song không làm hỏng kết quả
+# - không có response lỗi ngoài 503 (quá tải, được đếm riêng)
+# Thoát với mã 1 nếu vi phạm.
+
+
+# Hàm sinh giao dịch giả lập (hoặc lấy từ CSV thô cùng định dạng /score/upload)
+def make_transactions(n: int, seed: int, csv_path: str = None) -> list:
+    if csv_path:
+        df = pd.read_csv(csv_path, nrows=n)
+        df = df.astype(object).where(df.notna(), None)
+        txs = df.to_dict(orient="records")
+        for tx in txs:
+            tx["create_dt"] = str(tx["create_dt"])
+            tx["receiving_country"] = str(tx["receiving_country"])
+        return txs
+    rng = np.random.default_rng(seed)
+    countries = ["VN", "PH", "ID", "NP", "KR", "JP"]
+    txs = []
+    for i in range(n):
+        day = int(rng.integers(1, 28))
+        txs.append({
+            "transaction_seq": 9_000_000 + i,
+            "deposit_amount": float(rng.choice([300_000, 1_500_000, 4_500_000, 9_000_000])),
+            "receiving_country": str(rng.choice(countries)),
+            "country_code": str(rng.choice(countries)),
+            "id_type": "ARC",
+            "stay_qualify": str(rng.choice(["E-9", "F-4", "D-2"])),
+            "payment_method": str(rng.choice(["bank", "card"])),
+            "create_dt": f"2024-12-{day:02d} {int(rng.integers(0, 24)):02d}:15:00",
+            "register_date": f"2024-{int(rng.integers(1, 12)):02d}-01 09:00:00",
+            "first_transaction_date": f"2024-{int(rng.integers(1, 12)):02d}-05 10:00:00",
+            "transaction_count_24hour": int(rng.integers(0, 5)),
+            "transaction_amount_24hour": float(rng.integers(0, 10_000_000)),
+            "transaction_count_1month": int(rng.integers(0, 30)),
+        })
+    return txs
+
+
+class Client:
+    def __init__(self, base_url: str, token: str = None, timeout: float = 30.0):
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.timeout = timeout
+
+    def request(self, method: str, path: str, body: bytes = None, content_type: str = "application/json"):
+        headers = {"Content-Type": content_type}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        req = urllib.request.Request(self.base_url + path, data=body, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return resp.status, json.loads(resp.read() or b"null")
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.read().decode("utf-8", "replace")
+        except OSError as exc:  # connection reset / timeout dưới tải: ghi nhận như lỗi, không dừng cả lượt chạy
+            return 0, str(exc)
+
+    def login(self, username: str, password: str) -> None:
+        form = urllib.parse.urlencode({"username": username, "password": password}).encode()
+        status, body = self.request("POST", "/auth/login", form, "application/x-www-form-urlencoded")
+        if status != 200:
+            raise SystemExit(f"Login failed ({status}): {body}")
+        self.token = body["access_token"]
+
+
+def main():
+    configure_logging()
+    ap = argparse.ArgumentParser(description="Fire concurrent /score calls during /reload and check consistency")
+    ap.add_argument("--url", default=f"http://localhost:{os.getenv('PORT', '8080')}")
+    ap.add_argument("--username", default=os.getenv("STRESS_USERNAME"))
+    ap.add_argument("--password", default=os.getenv("STRESS_PASSWORD"))
+    ap.add_argument("--token", default=os.getenv("STRESS_TOKEN"), help="JWT có sẵn (bỏ qua login)")
+    ap.add_argument("--requests", type=int, default=5000)
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--reloads", type=int, default=3, help="Số lần POST /reload?wait=true rải đều trong lúc chạy")
+    ap.add_argument("--distinct", type=int, default=200, help="Số giao dịch khác nhau được lặp lại")
+    ap.add_argument("--csv", help="CSV giao dịch thô làm payload thay cho dữ liệu giả lập")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    client = Client(args.url, args.token)
+    if not client.token and args.username:
+        client.login(args.username, args.password)
+
+    txs = make_transactions(args.distinct, args.seed, args.csv)
+    bodies = [json.dumps(tx).encode() for tx in txs]
+    results = []  # (tx_idx, status, latency, body)
+    lock = threading.Lock()
+    done = [0]
+
+    def fire(i: int) -> None:
+        idx = i % len(bodies)
+        t0 = time.perf_counter()
+        status, body = client.request("POST", "/score", bodies[idx])
+        with lock:
+            results.append((idx, status, time.perf_counter() - t0, body))
+            done[0] += 1
+
+    reload_log = []
+
+    def reloader() -> None:
+        for k in range(args.reloads):
+            target = args.requests * (k + 1) // (args.reloads + 1)
+            while done[0] < target:
+                time.sleep(0.01)
+            t0 = time.perf_counter()
+            status, body = client.request("POST", "/reload?wait=true")
+            reload_log.append((status, time.perf_counter() - t0, body))
+            LOGGER.info("Reload %s after %s requests -> %s in %.2fs", k + 1, target, status, time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    reload_thread = threading.Thread(target=reloader, daemon=True)
+    reload_thread.start()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(fire, range(args.requests)))
+    reload_thread.join(timeout=120)
+    elapsed = time.perf_counter() - t0
+
+    status_counts = defaultdict(int)
+    thresholds = defaultdict(set)
+    outcomes = defaultdict(set)
+    other_errors = []
+    for idx, status, _, body in results:
+        status_counts[status] += 1
+        if status == 200:
+            version = body["model_version"]
+            thresholds[version].add((body["threshold_low"], body["threshold_high"]))
+            outcomes[(version, idx)].add((body["score"], body["decision"]))
+        elif status != 503:
+            other_errors.append((status, body))
+
+    latencies = np.array([r[2] for r in results if r[1] == 200]) * 1000.0
+    mixed = {v: sorted(t) for v, t in thresholds.items() if len(t) > 1}
+    unstable = {k: sorted(v) for k, v in outcomes.items() if len(v) > 1}
+    failed_reloads = [r for r in reload_log if r[0] != 200]
+
+    print(f"requests={len(results)} concurrency={args.concurrency} elapsed={elapsed:.2f}s "
+          f"throughput={len(results) / elapsed:.0f} req/s statuses={dict(status_counts)}")
+    if latencies.size:
+        print("latency ms p50=%.1f p95=%.1f p99=%.1f max=%.1f" % tuple(
+            np.percentile(latencies, [50, 95, 99, 100])))
+    print(f"model versions seen={sorted(thresholds)} reloads={len(reload_log)} failed_reloads={len(failed_reloads)}")
+    print(f"versions with mixed thresholds={len(mixed)} transactions with unstable score={len(unstable)} "
+          f"unexpected errors={len(other_errors)}")
+    for v, t in list(mixed.items())[:5]:
+        print("  mixed thresholds", v, t)
+    for k, v in list(unstable.items())[:5]:
+        print("  unstable", k, v)
+    for e in other_errors[:5]:
+        print("  error", e)
+    if mixed or unstable or other_errors or failed_reloads:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,23 @@
 import logging
 import os
 import os, json
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from typing import List
 import numpy as np, pandas as pd, ydf
 from sklearn.metrics import precision_recall_curve, roc_auc_score, auc
 from sklearn.preprocessing import StandardScaler
 import mlflow
 import mlflow.pyfunc
 from mlflow.models import infer_signature
-from app.preprocess import df_align, encode_categoricals, prepare_features_for_inference,sanitize_for_model
+from app.preprocess import df_align, encode_categoricals, prepare_features_for_inference,sanitize_for_model, PII_COLS, TEXT_COLS
+from data.arrow_io import read_frame, write_frame
 from utils.encoders import export_encoders
 from utils.medians import export_medians_and_schema
 from utils.thresholds import write_thresholds_yaml
-from utils.common import split_oot, fraud_prob_from_model, compute_thresholds
+from utils.common import split_oot, fraud_prob_from_model, compute_thresholds, roc_sweep
 # from utils.azure import (
 #     configure_azure_credentials_from_settings,
 #     ensure_azure_identity_env,
@@ -24,6 +29,9 @@ from utils.logging_utils import configure_logging
 # configure_azure_credentials_from_settings()
 LOGGER = logging.getLogger(__name__)
 
+# Cột PII mà df_align chỉ drop (không dùng để tạo feature): không cần đọc khi load dữ liệu huấn luyện
+UNUSED_RAW_COLS = [c for c in PII_COLS if c not in TEXT_COLS]
+
 # Định nghĩa lớp mô hình MLflow pyfunc
 class FraudYDFPythonModel(mlflow.pyfunc.PythonModel):
     def load_context(self, context):
@@ -71,6 +79,29 @@ class FraudYDFPythonModel(mlflow.pyfunc.PythonModel):
 class SkipTraining(RuntimeError):
    """Raised to signal that this window should skip training (e.g., label issues)."""
    pass
+
+# Hàm đo thời gian một stage huấn luyện, cộng dồn vào timings[name] (giây)
+@contextmanager
+def _stage(timings: dict, name: str):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - t0
+
+# Hàm chạy df_align cho nhiều frame (train + test) cùng lúc. df_align chỉ tính theo từng dòng nên mỗi frame
+# được chia thành các khúc liên tiếp cho process pool rồi ghép lại đúng thứ tự; fe_workers <= 1 chạy tuần tự.
+def align_frames(frames: List[pd.DataFrame], fe_workers: int) -> List[pd.DataFrame]:
+    if fe_workers <= 1:
+        return [df_align(f) for f in frames]
+    chunk_rows = max(1, -(-sum(len(f) for f in frames) // (2 * fe_workers)))  # ~2 khúc mỗi worker để cân tải
+    bounds = [
+        [(lo, min(lo + chunk_rows, len(f))) for lo in range(0, max(len(f), 1), chunk_rows)]
+        for f in frames
+    ]
+    with ProcessPoolExecutor(max_workers=fe_workers) as pool:
+        futures = [[pool.submit(df_align, f.iloc[lo:hi]) for lo, hi in b] for f, b in zip(frames, bounds)]
+        return [pd.concat([fut.result() for fut in parts]) for parts in futures]
 # Hàm huấn luyện một lần
 def train_once(nonfraud_path: str, fraud_path: str,
                artifacts_dir: str, model_dir: str,
@@ -81,13 +112,24 @@ def train_once(nonfraud_path: str, fraud_path: str,
                # MLflow
                mlflow_exp: str = "fraud-detection",
                mlflow_tags: dict = None,
-               registered_model_name: str = "fraud-ydf"
+               registered_model_name: str = "fraud-ydf",
+               # Hiệu năng huấn luyện (mặc định lấy từ scripts/config.py)
+               num_threads: int = settings.TRAIN_NUM_THREADS,
+               num_trees: int = settings.TRAIN_NUM_TREES,
+               max_depth: int = settings.TRAIN_MAX_DEPTH,
+               compute_oob: bool = settings.TRAIN_COMPUTE_OOB,
+               fe_workers: int = settings.TRAIN_FE_WORKERS,
                ):
+    t_start = time.perf_counter()
+    timings = {}
+    num_threads = num_threads if num_threads and num_threads > 0 else (os.cpu_count() or 1)
     
     LOGGER.info("Starting training with nonfraud=%s, fraud=%s", nonfraud_path, fraud_path)
     LOGGER.info("Artifacts dir: %s, Model dir: %s", artifacts_dir, model_dir)
     LOGGER.info("Test ratio: %s, FPR cap: %s, Recall target: %s", test_ratio, fpr_cap, recall_tgt)
     LOGGER.info("Experiment: %s, Registered model name: %s", mlflow_exp, registered_model_name)
+    LOGGER.info("YDF threads: %s, trees: %s, max depth: %s, OOB: %s, FE workers: %s",
+                num_threads, num_trees, max_depth, compute_oob, fe_workers)
     LOGGER.info("-" * 53)
     if stamp:
         if nest_version:
@@ -100,53 +142,61 @@ def train_once(nonfraud_path: str, fraud_path: str,
             save_holdout = os.path.join(artifacts_dir, "holdout.csv")
 
     # load
-    df0 = pd.read_csv(nonfraud_path); df0["is_fraud"] = False
-    df1 = pd.read_csv(fraud_path);    df1["is_fraud"] = True
-    df = pd.concat([df0, df1], ignore_index=True)
-
-    prep_df = df.copy()
-    # Điền giá trị thiếu cho cột chuỗi bằng 'Unknown' để encode ổn định
-    string_cols = prep_df.select_dtypes(include=['object']).columns
-    for col in string_cols:
-        prep_df[col] = prep_df[col].fillna('Unknown')#Nếu giá trị thiếu thì điền 'Unknown'
-
-    # Cắt ngoại lệ bằng IQR cho các cột amount. Giới hạn giá trị trong khoảng [lower, upper]
-    amount_cols = [c for c in prep_df.columns if 'amount' in c] 
-    clipping_bounds = {}
-    for col in amount_cols:
-        series = pd.to_numeric(prep_df[col], errors='coerce')
-        q1, q3 = series.quantile([0.25, 0.75])# [1, 2, 3, 4, 5, 6, 7, 8, 9, 10], thì Q1 = 3.25 và Q3 = 7.75
-        iqr = q3 - q1 #Tính IQR. ví dụ IQR = Q3 - Q1 = 7.75 - 3.25 = 4.5
-        upper = q3 + 1.5 * iqr 
-        lower = max(q1 - 1.5 * iqr, 0) 
-        prep_df[col] = series.clip(lower=lower, upper=upper)# lower = 0 và upper = 14.5, giá trị < 0 -> 0, giá trị > 14.5 -> 14.5
-        clipping_bounds[col] = [float(lower), float(upper)]
+    with _stage(timings, "load"):
+        df0 = read_frame(nonfraud_path, skip_columns=UNUSED_RAW_COLS); df0["is_fraud"] = False
+        df1 = read_frame(fraud_path, skip_columns=UNUSED_RAW_COLS);    df1["is_fraud"] = True
+        df = pd.concat([df0, df1], ignore_index=True)
+
+    with _stage(timings, "impute_and_clip"):
+        prep_df = df.copy()
+        # Điền giá trị thiếu cho cột chuỗi bằng 'Unknown' để encode ổn định
+        string_cols = prep_df.select_dtypes(include=['object']).columns
+        for col in string_cols:
+            prep_df[col] = prep_df[col].fillna('Unknown')#Nếu giá trị thiếu thì điền 'Unknown'
+
+        # Cắt ngoại lệ bằng IQR cho các cột amount. Giới hạn giá trị trong khoảng [lower, upper]
+        amount_cols = [c for c in prep_df.columns if 'amount' in c] 
+        clipping_bounds = {}
+        for col in amount_cols:
+            series = pd.to_numeric(prep_df[col], errors='coerce')
+            q1, q3 = series.quantile([0.25, 0.75])# [1, 2, 3, 4, 5, 6, 7, 8, 9, 10], thì Q1 = 3.25 và Q3 = 7.75
+            iqr = q3 - q1 #Tính IQR. ví dụ IQR = Q3 - Q1 = 7.75 - 3.25 = 4.5
+            upper = q3 + 1.5 * iqr 
+            lower = max(q1 - 1.5 * iqr, 0) 
+            prep_df[col] = series.clip(lower=lower, upper=upper)# lower = 0 và upper = 14.5, giá trị < 0 -> 0, giá trị > 14.5 -> 14.5
+            clipping_bounds[col] = [float(lower), float(upper)]
 
     # split
-    train_raw, test_raw, cutoff = split_oot(prep_df, test_ratio=test_ratio)
+    with _stage(timings, "split"):
+        train_raw, test_raw, cutoff = split_oot(prep_df, test_ratio=test_ratio)
     LOGGER.info("Cutoff time: %s | Train=%s Test=%s", cutoff, f"{len(train_raw):,}", f"{len(test_raw):,}")
     LOGGER.info("Train label counts: %s", train_raw["is_fraud"].value_counts().to_dict())
     LOGGER.info("Test  label counts: %s", test_raw["is_fraud"].value_counts().to_dict())
 
-    # FE
+    # FE (train + test chạy song song khi fe_workers > 1)
     drop_cols = ["is_fraud", "transaction_seq"]
-    Xtr = df_align(train_raw.drop(columns=[c for c in drop_cols if c in train_raw.columns], errors="ignore"))
-    Xte = df_align(test_raw .drop(columns=[c for c in drop_cols if c in test_raw.columns],  errors="ignore"))
+    with _stage(timings, "df_align"):
+        Xtr, Xte = align_frames([
+            train_raw.drop(columns=[c for c in drop_cols if c in train_raw.columns], errors="ignore"),
+            test_raw .drop(columns=[c for c in drop_cols if c in test_raw.columns],  errors="ignore"),
+        ], fe_workers)
 
     # encode
     maybe_cats = ["receiving_country","country_code","id_type","stay_qualify","payment_method", "payment_method_filled"]
     cat_cols = [c for c in maybe_cats if c in Xtr.columns]
-    Xtr_enc, encoders = encode_categoricals(Xtr, cat_cols, encoders=None)
-    Xte_enc, _ = encode_categoricals(Xte, cat_cols, encoders=encoders)
+    with _stage(timings, "encode_categoricals"):
+        Xtr_enc, encoders = encode_categoricals(Xtr, cat_cols, encoders=None)
+        Xte_enc, _ = encode_categoricals(Xte, cat_cols, encoders=encoders)
 
     # label
     ytr = train_raw["is_fraud"].map({False:"NO_FRAUD", True:"FRAUD"})
     yte = test_raw ["is_fraud"].map({False:"NO_FRAUD", True:"FRAUD"})
    
     # sanitize_for_model
-    feat_cols, med = export_medians_and_schema(Xtr_enc, out_dir=artifacts_dir, clipping_bounds=clipping_bounds)
-    Xtr_sanitize = sanitize_for_model(Xtr_enc, feat_cols, med)
-    Xte_sanitize = sanitize_for_model(Xte_enc, feat_cols, med)
+    with _stage(timings, "sanitize"):
+        feat_cols, med = export_medians_and_schema(Xtr_enc, out_dir=artifacts_dir, clipping_bounds=clipping_bounds)
+        Xtr_sanitize = sanitize_for_model(Xtr_enc, feat_cols, med)
+        Xte_sanitize = sanitize_for_model(Xte_enc, feat_cols, med)
 
     # numeric_cols = Xtr_enc.select_dtypes(include=['number']).columns # chọn các cột số
     # scaler = StandardScaler() # Chuẩn hoá dữ liệu về phân phối chuẩn (mean=0, std=1) để cho huấn luyện mô hình được tốt hơn bởi vì nhiều thuật toán ML nhạy cảm với thang đo của dữ liệu(KNN)
@@ -171,10 +221,13 @@ def train_once(nonfraud_path: str, fraud_path: str,
     learner = ydf.RandomForestLearner(
         label="is_fraud",
         class_weights={"NO_FRAUD": 1.0, "FRAUD": float(w_pos)},
-        num_trees=500, max_depth=16,
+        num_trees=num_trees, max_depth=max_depth,
+        num_threads=num_threads,
+        compute_oob_performances=compute_oob,
     )
     try:
-        model = learner.train(train_ds)
+        with _stage(timings, "train"):
+            model = learner.train(train_ds)
     except Exception as e:
         msg = str(e)
         if "categorical weight value \"FRAUD\" is not defined" in msg or "INVALID_ARGUMENT" in msg:
@@ -184,52 +237,64 @@ def train_once(nonfraud_path: str, fraud_path: str,
 
     # eval + thresholds
     y_true = (test_ds["is_fraud"].to_numpy()=="FRAUD").astype(int)
-    scores = fraud_prob_from_model(model, test_ds.drop(columns=["is_fraud"]))
+    with _stage(timings, "evaluate"):
+        scores = fraud_prob_from_model(model, test_ds.drop(columns=["is_fraud"]))
     if len(np.unique(y_true)) < 2:
         LOGGER.warning("Test set has a single class; ROC/PR undefined. Skip this window.")
         raise SkipTraining("Only one class present in test set.")
     
-    prec, rec, _ = precision_recall_curve(y_true, scores)
-    pr_auc = float(auc(rec, prec))
-    roc = float(roc_auc_score(y_true, scores))
-    ths = compute_thresholds(y_true, scores, fpr_cap=fpr_cap, recall_tgt=recall_tgt)
+    with _stage(timings, "evaluate"):
+        prec, rec, _ = precision_recall_curve(y_true, scores)
+        pr_auc = float(auc(rec, prec))
+        roc = float(roc_auc_score(y_true, scores))
+        roc_table = roc_sweep(y_true, scores)
+        ths = compute_thresholds(y_true, scores, fpr_cap=fpr_cap, recall_tgt=recall_tgt, roc=roc_table)
     th_low, th_high = float(ths["th_recall"]), float(ths["th_fpr_cap"])
 
     # save model & artifacts
-    os.makedirs(model_dir, exist_ok=True)
-    os.makedirs(artifacts_dir, exist_ok=True) 
-    model.save(model_dir) 
-
-    export_encoders(encoders, out_dir=artifacts_dir)
-    write_thresholds_yaml(th_low, th_high, model_version=os.path.basename(model_dir),
-                          out_dir=artifacts_dir, fpr_cap=fpr_cap)
-    manifest = {
-        "model_version": os.path.basename(model_dir),
-        "trained_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
-        "cutoff_time": str(cutoff),
-        "train_size": int(len(train_raw)),
-        "test_size": int(len(test_raw)),
-        "class_weight_pos": float(w_pos),
-        "metrics": {"pr_auc": pr_auc, "roc_auc": roc},
-        "thresholds": {"low": th_low, "high": th_high, "fpr_cap": float(fpr_cap)},
-        "feature_count": len(feat_cols),
-    }
-    with open(os.path.join(artifacts_dir, "manifest.json"), "w", encoding="utf-8") as f:
-        json.dump(manifest, f, ensure_ascii=False, indent=2) 
-
-    holdout_raw_path = os.path.join(artifacts_dir, "holdout_raw.csv")
-    test_raw.to_csv(holdout_raw_path, index=False)
+    with _stage(timings, "save"):
+        os.makedirs(model_dir, exist_ok=True)
+        os.makedirs(artifacts_dir, exist_ok=True) 
+        model.save(model_dir) 
+
+        export_encoders(encoders, out_dir=artifacts_dir)
+        write_thresholds_yaml(th_low, th_high, model_version=os.path.basename(model_dir),
+                              out_dir=artifacts_dir, fpr_cap=fpr_cap)
+        manifest = {
+            "model_version": os.path.basename(model_dir),
+            "trained_at": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+            "cutoff_time": str(cutoff),
+            "train_size": int(len(train_raw)),
+            "test_size": int(len(test_raw)),
+            "class_weight_pos": float(w_pos),
+            "metrics": {"pr_auc": pr_auc, "roc_auc": roc},
+            "thresholds": {"low": th_low, "high": th_high, "fpr_cap": float(fpr_cap)},
+            "feature_count": len(feat_cols),
+        }
+        with open(os.path.join(artifacts_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2) 
+
+        # Parquet giữ kiểu cột và nhỏ hơn nhiều so với CSV (compare_versions_mlflow tải file này)
+        holdout_raw_path = os.path.join(artifacts_dir, "holdout_raw.parquet")
+        write_frame(test_raw, holdout_raw_path)
+        # Bảng FPR/TPR theo mọi ngưỡng trên holdout: chọn điểm vận hành khác mà không cần chấm lại
+        roc_table.to_csv(os.path.join(artifacts_dir, "roc_table.csv"), index=False)
 
     LOGGER.info("PR-AUC=%.3f | ROC-AUC=%.3f | th_low=%.3f | th_high=%.3f", pr_auc, roc, th_low, th_high)
+    LOGGER.info("Stage timings (s): %s", ", ".join(f"{k}={v:.2f}" for k, v in timings.items()))
 
     mlflow.set_experiment(mlflow_exp)
     run_name = os.path.basename(model_dir)
     with mlflow.start_run(run_name=run_name):
+        t_mlflow = time.perf_counter()
         # Params/metrics
         mlflow.log_params({
             "model_type": "YDF.RandomForestLearner",
-            "num_trees": 500,
-            "max_depth": 16,
+            "num_trees": num_trees,
+            "max_depth": max_depth,
+            "num_threads": num_threads,
+            "compute_oob_performances": compute_oob,
+            "fe_workers": fe_workers,
             "class_weight_pos": w_pos,
             "test_ratio": float(test_ratio),
             "fpr_cap": float(fpr_cap),
@@ -244,6 +309,7 @@ def train_once(nonfraud_path: str, fraud_path: str,
             "roc_auc": roc,
             "th_low": th_low,
             "th_high": th_high,
+            **{f"time_{k}_seconds": v for k, v in timings.items()},
         })
 
         # Tags
@@ -297,6 +363,10 @@ def train_once(nonfraud_path: str, fraud_path: str,
     
             pass
 
+        mlflow.log_metrics({
+            "time_mlflow_log_seconds": time.perf_counter() - t_mlflow,
+            "time_total_seconds": time.perf_counter() - t_start,
+        })
         LOGGER.info("MLflow Logged run: %s", mlflow.active_run().info.run_id)
         LOGGER.info("MLflow Model URI: %s", model_info.model_uri)
         LOGGER.info("MLflow Registered name: %s", registered_model_name)
@@ -89,6 +89,7 @@ DB_CONTAINER="postgres-fraud-service" # Tên container từ docker-compose.yml
 # Đường dẫn đến các file SQL cần chạy
 SQL_FILE_1="${ROOT}/migrations/001_create_fraud_tables.sql"
 SQL_FILE_2="${ROOT}/migrations/002_create_auth_tables.sql"
+SQL_FILE_5="${ROOT}/migrations/005_auth_tokens_revoked_index.sql"
 
 # Hàm chạy SQL trong container
 run_migration() {
@@ -103,9 +104,10 @@ run_migration() {
     echo "[ok] Migration successful for $(basename "${sql_file}")."
 }
 
-# Chạy cả hai file migration
+# Chạy các file migration
 run_migration "${SQL_FILE_1}"
 run_migration "${SQL_FILE_2}"
+run_migration "${SQL_FILE_5}"
 
 # --- Hàm hỗ trợ khởi động dịch vụ (MLflow) ---
 
@@ -1,6 +1,6 @@
 import numpy as np
 import pandas as pd
-from sklearn.metrics import precision_recall_curve, roc_auc_score, auc, confusion_matrix
+from sklearn.metrics import precision_recall_curve, roc_auc_score, auc
 
 def split_oot(df: pd.DataFrame, time_col: str = "create_dt", test_ratio: float = 0.2):
     """Out-of-time split giữ thứ tự thời gian."""
@@ -18,8 +18,38 @@ def fraud_prob_from_model(model, X: pd.DataFrame) -> np.ndarray:
     p_no = model.predict(X).astype(float)
     return 1.0 - p_no
 
-def compute_thresholds(y_true_bin: np.ndarray, scores: np.ndarray, fpr_cap: float = 0.01, recall_tgt: float = 0.80):
-    """Trả về th_f1, th_fpr_cap (BLOCK), th_recall (REVIEW)."""
+# Hàm quét ROC một lần: sắp xếp điểm rồi cộng dồn, cho FP/TP/FPR/TPR tại mọi ngưỡng (O(n log n))
+def roc_sweep(y_true_bin: np.ndarray, scores: np.ndarray) -> pd.DataFrame:
+    """
+    Bảng ROC đầy đủ theo quy tắc dự đoán FRAUD khi score >= threshold; mỗi dòng là một giá trị score
+    khác nhau, tăng dần. fpr giữ đúng công thức cũ fp / (fp + tn + 1e-12) để chọn ngưỡng không đổi.
+    """
+    y = np.asarray(y_true_bin).astype(bool)
+    s = np.asarray(scores, dtype=float)
+    order = np.argsort(s, kind="mergesort")
+    s_sorted, y_sorted = s[order], y[order]
+    # vị trí bắt đầu của mỗi giá trị score khác nhau trong mảng đã sắp xếp
+    starts = np.flatnonzero(np.r_[True, s_sorted[1:] != s_sorted[:-1]]) if s.size else np.array([], dtype=int)
+    pos_below = np.r_[0, np.cumsum(y_sorted)][starts]      # số FRAUD có score < threshold
+    neg_below = starts - pos_below                          # số NO_FRAUD có score < threshold
+    n_pos, n_neg = int(y.sum()), int(y.size - y.sum())
+    tp, fp = n_pos - pos_below, n_neg - neg_below
+    return pd.DataFrame({
+        "threshold": s_sorted[starts],
+        "tp": tp,
+        "fp": fp,
+        "tpr": tp / max(n_pos, 1),
+        "fpr": fp / (n_neg + 1e-12),
+    })
+
+# Hàm chọn ngưỡng nhỏ nhất có FPR <= cap từ bảng roc_sweep (None nếu không ngưỡng nào đạt)
+def threshold_for_fpr(roc: pd.DataFrame, fpr_cap: float):
+    ok = np.flatnonzero(roc["fpr"].to_numpy() <= fpr_cap)
+    return float(roc["threshold"].iloc[ok[0]]) if ok.size else None
+
+def compute_thresholds(y_true_bin: np.ndarray, scores: np.ndarray, fpr_cap: float = 0.01, recall_tgt: float = 0.80,
+                       roc: pd.DataFrame = None):
+    """Trả về th_f1, th_fpr_cap (BLOCK), th_recall (REVIEW). roc: bảng roc_sweep đã tính sẵn (nếu có)."""
     prec, rec, th = precision_recall_curve(y_true_bin, scores)
 
     # F1-opt
@@ -27,14 +57,9 @@ def compute_thresholds(y_true_bin: np.ndarray, scores: np.ndarray, fpr_cap: floa
     th_f1 = float(th[int(np.nanargmax(f1))])
 
     # FPR <= cap: chọn ngưỡng nhỏ nhất thỏa điều kiện
-    th_cap = None
-    for t in sorted(np.unique(scores)):
-        yp = (scores >= t).astype(int)
-        tn, fp, fn, tp = confusion_matrix(y_true_bin, yp).ravel()
-        fpr = fp / (fp + tn + 1e-12)
-        if fpr <= fpr_cap:
-            th_cap = float(t)
-            break
+    if roc is None:
+        roc = roc_sweep(y_true_bin, scores)
+    th_cap = threshold_for_fpr(roc, fpr_cap)
 
     # Recall ≥ target: trong các điểm đạt recall, lấy precision cao nhất
     idx = np.where(rec[:-1] >= recall_tgt)[0]